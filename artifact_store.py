@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Хранилище артефактов книг (картинки сцен, book.json, PDF) по хэшу содержимого
+
+Файлы адресуются SHA-256 содержимого: одинаковый файл хранится один раз,
+а какой заказ какие файлы использует - записано в Postgres (order_artifacts).
+
+Хранилище включается явно (ARTIFACT_STORE); без него книги живут только
+в папках заказов на диске, под квотой janitor.py.
+
+Бэкенды:
+- local: папка на диске (ARTIFACT_DIR) - для локальной разработки
+  (на том же диске, что и папки заказов, поэтому в работе не нужна)
+- s3: любое S3-совместимое хранилище (AWS S3, MinIO, ...) - переживает
+  редеплой и доступно всем репликам
+
+Настройки (переменные окружения):
+    ARTIFACT_STORE=local|s3                 (пусто - хранилища нет)
+    ARTIFACT_DIR=artifacts
+    S3_ENDPOINT_URL=http://localhost:9000   (для MinIO; пусто - AWS)
+    S3_BUCKET, S3_PREFIX, S3_ACCESS_KEY, S3_SECRET_KEY, S3_REGION
+"""
+
+import hashlib
+import mimetypes
+import os
+import tempfile
+
+ARTIFACT_STORE = os.environ.get("ARTIFACT_STORE", "")
+ARTIFACT_DIR = os.environ.get("ARTIFACT_DIR", "artifacts")
+
+
+def content_hash(data):
+    """SHA-256 содержимого (hex)"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def guess_content_type(name):
+    """MIME-тип по имени файла"""
+    return mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+
+class LocalArtifactStore:
+    """Артефакты в папке: <root>/<ab>/<abcdef...>"""
+
+    def __init__(self, root=ARTIFACT_DIR):
+        self.root = root
+
+    def _path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def put(self, data, content_type=None):
+        """Сохраняет байты, возвращает хэш (повторное сохранение ничего не пишет)"""
+        digest = content_hash(data)
+        path = self._path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Пишем во временный файл и переименовываем - читатели не увидят половину файла
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        return digest
+
+    def get(self, digest):
+        """Байты артефакта (FileNotFoundError, если нет)"""
+        with open(self._path(digest), 'rb') as f:
+            return f.read()
+
+    def stat(self, digest):
+        """{'size': байт} или None, если артефакта нет"""
+        try:
+            return {'size': os.path.getsize(self._path(digest))}
+        except FileNotFoundError:
+            return None
+
+
+class S3ArtifactStore:
+    """Артефакты в S3-совместимом бакете: <prefix><abcdef...>"""
+
+    def __init__(self, bucket, prefix='artifacts/', endpoint_url=None,
+                 access_key=None, secret_key=None, region=None):
+        import boto3
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client(
+            's3',
+            endpoint_url=endpoint_url or None,
+            aws_access_key_id=access_key or None,
+            aws_secret_access_key=secret_key or None,
+            region_name=region or None,
+        )
+
+    def _key(self, digest):
+        return f"{self.prefix}{digest}"
+
+    def put(self, data, content_type=None):
+        """Загружает байты, возвращает хэш (если уже есть - не загружает)"""
+        digest = content_hash(data)
+        if self.stat(digest) is None:
+            self.client.put_object(
+                Bucket=self.bucket,
+                Key=self._key(digest),
+                Body=data,
+                ContentType=content_type or 'application/octet-stream',
+            )
+        return digest
+
+    def get(self, digest):
+        """Байты артефакта (FileNotFoundError, если нет)"""
+        from botocore.exceptions import ClientError
+
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self._key(digest))
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey'):
+                raise FileNotFoundError(f"Артефакт не найден: {digest}")
+            raise
+        return response['Body'].read()
+
+    def stat(self, digest):
+        """{'size': байт, 'content_type': ...} или None, если артефакта нет"""
+        from botocore.exceptions import ClientError
+
+        try:
+            response = self.client.head_object(Bucket=self.bucket, Key=self._key(digest))
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+        return {'size': response['ContentLength'], 'content_type': response.get('ContentType')}
+
+
+def get_artifact_store():
+    """Хранилище по настройкам из переменных окружения (None, если ARTIFACT_STORE не задан)"""
+    if not ARTIFACT_STORE:
+        return None
+    if ARTIFACT_STORE == 's3':
+        return S3ArtifactStore(
+            bucket=os.environ["S3_BUCKET"],
+            prefix=os.environ.get("S3_PREFIX", "artifacts/"),
+            endpoint_url=os.environ.get("S3_ENDPOINT_URL"),
+            access_key=os.environ.get("S3_ACCESS_KEY"),
+            secret_key=os.environ.get("S3_SECRET_KEY"),
+            region=os.environ.get("S3_REGION"),
+        )
+    if ARTIFACT_STORE == 'local':
+        return LocalArtifactStore(ARTIFACT_DIR)
+    raise ValueError(f"Неизвестное хранилище артефактов: {ARTIFACT_STORE} (доступны: local, s3)")
@@ -0,0 +1,577 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Асинхронная работа с PostgreSQL для хендлеров бота (asyncpg)
+
+Те же операции, что у Database из database.py, но через await - запросы
+к БД не блокируют event loop, пока бот обслуживает других пользователей.
+asyncpg сам готовит (PREPARE) и кэширует запросы на каждом подключении пула.
+
+Схему создаёт database.Database при импорте - здесь только запросы
+"""
+
+import asyncio
+import json
+import os
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Optional, Dict, List
+
+from database import DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX, STATS_REPORT_SQL, build_stats_report
+
+# Сколько подготовленных запросов хранить на одно подключение
+STATEMENT_CACHE_SIZE = int(os.environ.get("DB_STATEMENT_CACHE_SIZE", "256"))
+
+
+class AsyncDatabase:
+    """Класс для асинхронной работы с PostgreSQL базой данных"""
+
+    def __init__(self, database_url=DATABASE_URL):
+        self.database_url = database_url
+        self._pool = None
+        self._pool_lock = asyncio.Lock()
+
+    async def _get_pool(self):
+        """Пул подключений (создаётся при первом запросе)"""
+        if self._pool is None:
+            if not self.database_url:
+                raise Exception("❌ DATABASE_URL не установлен!")
+            async with self._pool_lock:
+                if self._pool is None:
+                    import asyncpg
+                    self._pool = await asyncpg.create_pool(
+                        self.database_url,
+                        min_size=DB_POOL_MIN,
+                        max_size=DB_POOL_MAX,
+                        statement_cache_size=STATEMENT_CACHE_SIZE,
+                    )
+        return self._pool
+
+    @asynccontextmanager
+    async def connection(self):
+        """Взять подключение из пула (возвращается после async with)"""
+        pool = await self._get_pool()
+        async with pool.acquire() as conn:
+            yield conn
+
+    @asynccontextmanager
+    async def transaction(self):
+        """Подключение в транзакции: COMMIT после async with, ROLLBACK при исключении"""
+        async with self.connection() as conn:
+            async with conn.transaction():
+                yield conn
+
+    async def execute(self, query, *args):
+        async with self.connection() as conn:
+            return await conn.execute(query, *args)
+
+    async def fetch(self, query, *args) -> List[Dict]:
+        async with self.connection() as conn:
+            return [dict(row) for row in await conn.fetch(query, *args)]
+
+    async def fetchrow(self, query, *args) -> Optional[Dict]:
+        async with self.connection() as conn:
+            row = await conn.fetchrow(query, *args)
+        return dict(row) if row else None
+
+    async def fetchval(self, query, *args):
+        async with self.connection() as conn:
+            return await conn.fetchval(query, *args)
+
+    async def notify(self, channel, payload=''):
+        """NOTIFY channel, payload"""
+        await self.execute('SELECT pg_notify($1, $2)', channel, payload)
+
+    async def listen(self, callbacks):
+        """
+        Отдельное (не из пула) подключение с LISTEN на каналы
+
+        Args:
+            callbacks: {канал: callback(payload)} - вызываются в event loop
+
+        Returns:
+            подключение asyncpg (закрыть - await conn.close())
+        """
+        if not self.database_url:
+            raise Exception("❌ DATABASE_URL не установлен!")
+        import asyncpg
+
+        conn = await asyncpg.connect(self.database_url)
+        for channel, callback in callbacks.items():
+            await conn.add_listener(
+                channel,
+                lambda _conn, _pid, _channel, payload, callback=callback: callback(payload)
+            )
+        return conn
+
+    async def close(self):
+        """Закрыть все подключения пула (при остановке бота)"""
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    # ===== РАБОТА С ПОЛЬЗОВАТЕЛЯМИ =====
+
+    async def add_user(self, user_id: int, username: str = None,
+                       first_name: str = None, last_name: str = None) -> bool:
+        """
+        Добавить пользователя (если нет) или обновить last_active
+
+        Returns:
+            True, если пользователь новый (его нужно посчитать в stats.new_users)
+        """
+        return await self.fetchval('''
+            INSERT INTO users (user_id, username, first_name, last_name)
+            VALUES ($1, $2, $3, $4)
+            ON CONFLICT (user_id) DO UPDATE SET
+                username = EXCLUDED.username,
+                first_name = EXCLUDED.first_name,
+                last_name = EXCLUDED.last_name,
+                last_active = CURRENT_TIMESTAMP
+            RETURNING (xmax = 0) AS inserted
+        ''', user_id, username, first_name, last_name)
+
+    async def get_user(self, user_id: int) -> Optional[Dict]:
+        """Получить пользователя"""
+        return await self.fetchrow('SELECT * FROM users WHERE user_id = $1', user_id)
+
+    async def get_user_stats(self, user_id: int) -> Dict:
+        """Статистика пользователя"""
+        row = await self.fetchrow('''
+            SELECT
+                COUNT(*) as total_orders,
+                SUM(CASE WHEN status = 'completed' THEN 1 ELSE 0 END) as completed_orders,
+                SUM(CASE WHEN status = 'paid' THEN 1 ELSE 0 END) as paid_orders
+            FROM orders WHERE user_id = $1
+        ''', user_id)
+        return row or {}
+
+    # ===== РАБОТА С ЗАКАЗАМИ =====
+
+    async def create_order(self, user_id: int, theme: str, child_name: str,
+                           child_age: int, gender: str, photo_description: str = None,
+                           plan: str = 'standard', photo_path: str = None) -> int:
+        """Создать заказ"""
+        async with self.transaction() as conn:
+            row = await conn.fetchrow('''
+                INSERT INTO orders (user_id, theme, child_name, child_age, gender, photo_description, plan, photo_path)
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+                RETURNING order_id, created_at::date AS day, status
+            ''', user_id, theme, child_name, child_age, gender, photo_description, plan, photo_path)
+            
+            order_id = row['order_id']
+            await self._rollup_add(conn, row['day'], theme, plan, row['status'], orders=1)
+
+        print(f"✅ Создан заказ #{order_id} для user {user_id}")
+        return order_id
+
+    async def get_order(self, order_id: int) -> Optional[Dict]:
+        """Получить заказ"""
+        return await self.fetchrow('SELECT * FROM orders WHERE order_id = $1', order_id)
+
+    async def update_order_status(self, order_id: int, status: str, pdf_path: str = None):
+        """Обновить статус заказа"""
+        async with self.transaction() as conn:
+            await self._set_order_status(conn, order_id, status, pdf_path)
+
+        print(f"✅ Заказ #{order_id} → статус: {status}")
+
+    async def refund_failed_order(self, order_id: int) -> Optional[Dict]:
+        """
+        Пометить failed заказ как возвращённый (refunded)
+
+        Returns:
+            {'user_id', 'status'} заказа до изменения или None, если заказа нет
+        """
+        async with self.transaction() as conn:
+            user_id = await conn.fetchval('SELECT user_id FROM orders WHERE order_id = $1', order_id)
+            if user_id is None:
+                return None
+
+            old = await self._set_order_status(conn, order_id, 'refunded', only_from='failed')
+
+        return {'user_id': user_id, 'status': old['status']}
+
+    async def get_failed_orders(self, limit: int = 10) -> List[Dict]:
+        """Последние failed заказы с именем пользователя (для админа)"""
+        return await self.fetch('''
+            SELECT o.order_id, o.user_id, o.created_at, u.first_name
+            FROM orders o
+            LEFT JOIN users u ON o.user_id = u.user_id
+            WHERE o.status = 'failed'
+            ORDER BY o.created_at DESC
+            LIMIT $1
+        ''', limit)
+
+    async def get_table_columns(self, table: str) -> List[Dict]:
+        """Колонки таблицы: [{'column_name', 'data_type'}] (для /dbinfo)"""
+        return await self.fetch('''
+            SELECT column_name, data_type
+            FROM information_schema.columns
+            WHERE table_name = $1
+            ORDER BY ordinal_position
+        ''', table)
+
+    async def _set_order_status(self, conn, order_id, status, pdf_path=None, only_from=None):
+        """Сменить статус заказа и перенести его в stats_rollup (см. Database._set_order_status)"""
+        row = await conn.fetchrow('''
+            SELECT status, theme, plan, created_at::date AS day,
+                   (SELECT COALESCE(SUM(amount), 0) FROM payments
+                    WHERE payments.order_id = orders.order_id AND payments.status = 'succeeded') AS revenue
+            FROM orders
+            WHERE order_id = $1
+            FOR UPDATE
+        ''', order_id)
+        if not row:
+            return None
+
+        old = dict(row)
+        if only_from is not None and old['status'] != only_from:
+            return old
+
+        if status == 'completed':
+            await conn.execute('''
+                UPDATE orders
+                SET status = $1, pdf_path = $2, completed_at = CURRENT_TIMESTAMP
+                WHERE order_id = $3
+            ''', status, pdf_path, order_id)
+        else:
+            await conn.execute('''
+                UPDATE orders
+                SET status = $1
+                WHERE order_id = $2
+            ''', status, order_id)
+
+        if old['status'] != status:
+            await self._rollup_add(conn, old['day'], old['theme'], old['plan'], old['status'],
+                                   orders=-1, revenue=-old['revenue'])
+            await self._rollup_add(conn, old['day'], old['theme'], old['plan'], status,
+                                   orders=1, revenue=old['revenue'])
+        return old
+
+    async def _rollup_add(self, conn, day, theme, plan, status, orders=0, revenue=0):
+        """Прибавить к строке stats_rollup (day, theme, plan, status)"""
+        await conn.execute('''
+            INSERT INTO stats_rollup (day, theme, plan, status, orders, revenue)
+            VALUES ($1, $2, $3, $4, $5, $6)
+            ON CONFLICT (day, theme, plan, status) DO UPDATE SET
+                orders = stats_rollup.orders + EXCLUDED.orders,
+                revenue = stats_rollup.revenue + EXCLUDED.revenue
+        ''', day, theme, plan or 'standard', status or 'pending', orders, int(revenue))
+
+    async def start_order_attempt(self, order_id: int) -> int:
+        """Начать новую попытку генерации заказа, вернуть её номер (1, 2, ...)"""
+        attempt = await self.fetchval('''
+            UPDATE orders
+            SET attempts = COALESCE(attempts, 0) + 1
+            WHERE order_id = $1
+            RETURNING attempts
+        ''', order_id)
+        return attempt or 1
+
+    async def set_order_pdf_file_id(self, order_id: int, file_id: Optional[str]):
+        """Запомнить file_id PDF в Telegram (None - сбросить)"""
+        await self.execute('UPDATE orders SET pdf_file_id = $1 WHERE order_id = $2', file_id, order_id)
+
+    async def get_user_orders(self, user_id: int, limit: int = 10) -> List[Dict]:
+        """Получить заказы пользователя"""
+        return await self.fetch('''
+            SELECT * FROM orders
+            WHERE user_id = $1
+            ORDER BY created_at DESC
+            LIMIT $2
+        ''', user_id, limit)
+
+    async def save_order_artifacts(self, order_id: int, artifacts: Dict[str, Dict]):
+        """Записать файлы заказа в хранилище: {имя: {'hash', 'size', 'content_type'}}"""
+        async with self.connection() as conn:
+            await conn.executemany('''
+                INSERT INTO order_artifacts (order_id, name, artifact_hash, size, content_type)
+                VALUES ($1, $2, $3, $4, $5)
+                ON CONFLICT (order_id, name) DO UPDATE SET
+                    artifact_hash = EXCLUDED.artifact_hash,
+                    size = EXCLUDED.size,
+                    content_type = EXCLUDED.content_type,
+                    created_at = CURRENT_TIMESTAMP
+            ''', [(order_id, name, info['hash'], info['size'], info.get('content_type'))
+                  for name, info in artifacts.items()])
+
+    async def get_order_artifacts(self, order_id: int) -> Dict[str, Dict]:
+        """Файлы заказа в хранилище: {имя: {'hash', 'size', 'content_type'}}"""
+        rows = await self.fetch('''
+            SELECT name, artifact_hash, size, content_type
+            FROM order_artifacts
+            WHERE order_id = $1
+        ''', order_id)
+        return {row['name']: {'hash': row['artifact_hash'], 'size': row['size'],
+                              'content_type': row['content_type']}
+                for row in rows}
+
+    # ===== РАБОТА С ПЛАТЕЖАМИ =====
+
+    async def create_payment(self, payment_id: str, order_id: int,
+                             user_id: int, amount: int, payment_url: str = None):
+        """Создать платёж"""
+        await self.execute('''
+            INSERT INTO payments (payment_id, order_id, user_id, amount, payment_url)
+            VALUES ($1, $2, $3, $4, $5)
+        ''', payment_id, order_id, user_id, amount, payment_url)
+
+        print(f"✅ Создан платёж {payment_id} для заказа #{order_id}")
+
+    async def update_payment_status(self, payment_id: str, status: str) -> bool:
+        """
+        Обновить статус платежа
+
+        Оплаченный (succeeded) платёж больше не меняется - поэтому одна и та же
+        оплата, пришедшая из уведомления, автопроверки и /check, обработается один раз.
+
+        Returns:
+            True, если статус изменился
+        """
+        async with self.transaction() as conn:
+            row = await conn.fetchrow('''
+                UPDATE payments
+                SET status = $1, paid_at = CASE WHEN $1 = 'succeeded' THEN CURRENT_TIMESTAMP ELSE paid_at END
+                WHERE payment_id = $2 AND status IS DISTINCT FROM 'succeeded' AND status IS DISTINCT FROM $1
+                RETURNING order_id, amount
+            ''', status, payment_id)
+
+            # Выручка - в строку stats_rollup, где заказ лежит сейчас (только при первом succeeded)
+            if row and status == 'succeeded':
+                order = await conn.fetchrow('''
+                    SELECT status, theme, plan, created_at::date AS day
+                    FROM orders WHERE order_id = $1
+                    FOR UPDATE
+                ''', row['order_id'])
+                if order:
+                    await self._rollup_add(conn, order['day'], order['theme'], order['plan'],
+                                           order['status'], revenue=row['amount'])
+
+        if row:
+            print(f"✅ Платёж {payment_id} → статус: {status}")
+        return row is not None
+
+    async def get_payment(self, payment_id: str) -> Optional[Dict]:
+        """Получить платёж"""
+        return await self.fetchrow('SELECT * FROM payments WHERE payment_id = $1', payment_id)
+
+    async def get_pending_payments(self) -> List[Dict]:
+        """Неоплаченные платежи для автопроверки: payment_id и возраст в секундах (age)"""
+        return await self.fetch('''
+            SELECT payment_id, EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - created_at)::float8 AS age
+            FROM payments
+            WHERE status = 'pending'
+        ''')
+
+    async def expire_pending_payments(self, deadline_minutes: int) -> List[str]:
+        """Помечает expired платежи, не оплаченные за deadline_minutes. Возвращает их id"""
+        rows = await self.fetch('''
+            UPDATE payments SET status = 'expired'
+            WHERE status = 'pending'
+              AND created_at < CURRENT_TIMESTAMP - make_interval(mins => $1)
+            RETURNING payment_id
+        ''', deadline_minutes)
+        return [row['payment_id'] for row in rows]
+
+    # ===== БЕСПЛАТНЫЕ КРЕДИТЫ =====
+
+    async def get_credits(self, user_id: int) -> int:
+        """Сколько бесплатных книг у пользователя"""
+        return await self.fetchval('SELECT balance FROM credits WHERE user_id = $1', user_id) or 0
+
+    async def add_credits(self, user_id: int, amount: int = 1) -> int:
+        """Начислить бесплатные книги, вернуть новый баланс"""
+        return await self.fetchval('''
+            INSERT INTO credits (user_id, balance)
+            VALUES ($1, $2)
+            ON CONFLICT (user_id) DO UPDATE SET
+                balance = credits.balance + EXCLUDED.balance,
+                updated_at = CURRENT_TIMESTAMP
+            RETURNING balance
+        ''', user_id, amount)
+
+    async def redeem_credit(self, user_id: int) -> Optional[int]:
+        """
+        Списать одну бесплатную книгу одним UPDATE (реплики не спишут её дважды)
+
+        Returns:
+            оставшийся баланс или None, если кредитов нет
+        """
+        return await self.fetchval('''
+            UPDATE credits
+            SET balance = balance - 1, updated_at = CURRENT_TIMESTAMP
+            WHERE user_id = $1 AND balance > 0
+            RETURNING balance
+        ''', user_id)
+
+    # ===== СТАТИЧНЫЕ КАРТИНКИ =====
+
+    async def get_static_asset_file_id(self, file_hash: str) -> Optional[str]:
+        """Получить file_id картинки по хэшу файла"""
+        return await self.fetchval('SELECT file_id FROM static_assets WHERE file_hash = $1', file_hash)
+
+    async def save_static_asset_file_id(self, file_hash: str, path: str, file_id: str):
+        """Запомнить file_id картинки"""
+        await self.execute('''
+            INSERT INTO static_assets (file_hash, path, file_id)
+            VALUES ($1, $2, $3)
+            ON CONFLICT (file_hash) DO UPDATE SET
+                path = EXCLUDED.path,
+                file_id = EXCLUDED.file_id,
+                updated_at = CURRENT_TIMESTAMP
+        ''', file_hash, path, file_id)
+
+    async def delete_static_asset(self, file_hash: str):
+        """Забыть file_id картинки (Telegram его больше не принимает)"""
+        await self.execute('DELETE FROM static_assets WHERE file_hash = $1', file_hash)
+
+    # ===== ОЧЕРЕДЬ ГЕНЕРАЦИИ =====
+
+    async def enqueue_generation_job(self, order_id: Optional[int], chat_id: int,
+                                     status_message_id: Optional[int], params: Dict,
+                                     channel: str) -> Optional[int]:
+        """
+        Поставить книгу в очередь и разбудить воркеры (NOTIFY channel)
+
+        Returns:
+            job_id или None, если задание для этого заказа уже есть
+        """
+        async with self.transaction() as conn:
+            job_id = await conn.fetchval('''
+                INSERT INTO generation_jobs (order_id, chat_id, status_message_id, params)
+                VALUES ($1, $2, $3, $4::jsonb)
+                ON CONFLICT (order_id) DO NOTHING
+                RETURNING job_id
+            ''', order_id, chat_id, status_message_id, json.dumps(params, ensure_ascii=False))
+            if job_id is not None:
+                # Уйдёт воркерам после COMMIT
+                await conn.execute('SELECT pg_notify($1, $2)', channel, str(job_id))
+        return job_id
+
+    async def claim_generation_job(self, worker: str, timeout_minutes: int,
+                                   max_attempts: int) -> Optional[Dict]:
+        """
+        Забрать следующее задание (параллельные воркеры не получат одно и то же)
+
+        Задание зависшего воркера (running дольше timeout_minutes) отдаётся заново
+        """
+        row = await self.fetchrow('''
+            UPDATE generation_jobs
+            SET status = 'running', worker = $1, attempts = attempts + 1, started_at = CURRENT_TIMESTAMP
+            WHERE job_id = (
+                SELECT job_id FROM generation_jobs
+                WHERE status = 'queued'
+                   OR (status = 'running' AND attempts < $3
+                       AND started_at < NOW() - make_interval(mins => $2))
+                ORDER BY job_id
+                FOR UPDATE SKIP LOCKED
+                LIMIT 1
+            )
+            RETURNING *
+        ''', worker, timeout_minutes, max_attempts)
+        if row:
+            row['params'] = json.loads(row['params'])
+        return row
+
+    async def fail_stale_generation_jobs(self, timeout_minutes: int, max_attempts: int,
+                                         channel: str) -> List[int]:
+        """
+        Задания, зависшие max_attempts раз, помечаются failed (бот сообщит об ошибке)
+
+        Заказ тоже становится failed - build_book, который обычно это делает, не завершился
+        """
+        async with self.transaction() as conn:
+            rows = await conn.fetch('''
+                UPDATE generation_jobs
+                SET status = 'failed', error = 'Генерация не завершилась (воркер остановился)',
+                    finished_at = CURRENT_TIMESTAMP
+                WHERE status = 'running' AND attempts >= $2
+                  AND started_at < NOW() - make_interval(mins => $1)
+                RETURNING job_id, order_id
+            ''', timeout_minutes, max_attempts)
+            for row in rows:
+                await self._set_order_status(conn, row['order_id'], 'failed', only_from='paid')
+                await conn.execute('SELECT pg_notify($1, $2)', channel, str(row['job_id']))
+        return [row['job_id'] for row in rows]
+
+    async def finish_generation_job(self, job_id: int, result: Dict, channel: str):
+        """Записать результат задания и сообщить боту (NOTIFY channel)"""
+        async with self.transaction() as conn:
+            await conn.execute('''
+                UPDATE generation_jobs
+                SET status = $2, pdf_path = $3, error = $4, overloaded = $5, finished_at = CURRENT_TIMESTAMP
+                WHERE job_id = $1
+            ''', job_id, 'done' if result['ok'] else 'failed', result.get('pdf_path'),
+                result.get('error'), bool(result.get('overloaded')))
+            await conn.execute('SELECT pg_notify($1, $2)', channel, str(job_id))
+
+    async def claim_generation_delivery(self, job_id: int) -> Optional[Dict]:
+        """Забрать готовый результат для отправки (ровно один раз)"""
+        row = await self.fetchrow('''
+            UPDATE generation_jobs
+            SET delivered_at = CURRENT_TIMESTAMP
+            WHERE job_id = $1 AND status IN ('done', 'failed') AND delivered_at IS NULL
+            RETURNING *
+        ''', job_id)
+        if row:
+            row['params'] = json.loads(row['params'])
+        return row
+
+    async def get_undelivered_generation_jobs(self) -> List[int]:
+        """Готовые задания, результат которых ещё не отправлен"""
+        rows = await self.fetch('''
+            SELECT job_id FROM generation_jobs
+            WHERE status IN ('done', 'failed') AND delivered_at IS NULL
+            ORDER BY job_id
+        ''')
+        return [row['job_id'] for row in rows]
+
+    # ===== СТАТИСТИКА =====
+
+    async def update_daily_stats(self, new_users: int = 0, total_orders: int = 0,
+                                 completed_orders: int = 0, revenue: int = 0, day=None):
+        """Обновить статистику за день (по умолчанию - за сегодня)"""
+        await self.execute('''
+            INSERT INTO stats (date, new_users, total_orders, completed_orders, revenue)
+            VALUES ($1, $2, $3, $4, $5)
+            ON CONFLICT (date) DO UPDATE SET
+                new_users = stats.new_users + EXCLUDED.new_users,
+                total_orders = stats.total_orders + EXCLUDED.total_orders,
+                completed_orders = stats.completed_orders + EXCLUDED.completed_orders,
+                revenue = stats.revenue + EXCLUDED.revenue
+        ''', day or datetime.now().date(), new_users, total_orders, completed_orders, revenue)
+
+    async def get_stats(self, days: int = 7) -> List[Dict]:
+        """Получить статистику за N дней"""
+        return await self.fetch('SELECT * FROM stats ORDER BY date DESC LIMIT $1', days)
+
+    async def get_stats_report(self) -> Dict:
+        """Сводка для /stats и /analytics - один запрос по stats_rollup (см. Database.get_stats_report)"""
+        return build_stats_report(await self.fetch(STATS_REPORT_SQL))
+
+    async def get_event_funnel(self, days: int = 7) -> Dict[str, Dict]:
+        """Воронка за N дней: {событие: {'events': сколько раз, 'users': сколько пользователей}}"""
+        rows = await self.fetch('''
+            SELECT event, COUNT(*) AS events, COUNT(DISTINCT user_id) AS users
+            FROM analytics_events
+            WHERE created_at > NOW() - make_interval(days => $1)
+            GROUP BY event
+        ''', days)
+        return {row['event']: {'events': row['events'], 'users': row['users']} for row in rows}
+
+    async def get_total_stats(self) -> Dict:
+        """Общая статистика"""
+        total = (await self.get_stats_report())['total']
+        total_orders = total['total_orders']
+        return {
+            'total_users': total['total_users'],
+            'total_orders': total_orders,
+            'completed_orders': total['completed_orders'],
+            'revenue': total['revenue'],
+            'conversion': (total['completed_orders'] / total_orders * 100) if total_orders > 0 else 0
+        }
+
+
+# Глобальный экземпляр (пул создаётся при первом запросе - уже внутри event loop)
+adb = AsyncDatabase()
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Варианты книги из одного набора иллюстраций:
+- screen: лёгкий PDF для Telegram (его получает пользователь)
+- print: PDF в полном разрешении для печати (по запросу)
+- preview: сжатые JPEG страниц для альбома send_media_group
+
+Всё нужное для пересборки сохраняется в book.json в папке книги,
+поэтому любой вариант можно перегенерировать без обращения к Replicate.
+publish_book/restore_book переносят папку книги в хранилище артефактов и обратно
+"""
+
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+MANIFEST_NAME = "book.json"
+
+# max_side: ограничение длинной стороны картинки (None - как есть)
+# quality: качество JPEG (None - берём картинку без перекодирования)
+# source: брать исходные PNG сцен как есть (без них вариант не собрать)
+BOOK_VARIANTS = {
+    'screen': {'kind': 'pdf', 'max_side': 1200, 'quality': 80},
+    'print': {'kind': 'pdf', 'max_side': None, 'quality': None, 'source': True},
+    'preview': {'kind': 'jpeg', 'max_side': 1024, 'quality': 70},
+}
+
+DEFAULT_VARIANTS = ('screen', 'preview')
+
+
+def save_manifest(output_dir, pdf_name, child_name, child_age, theme_title, scenes_data,
+                  outline_mode=None, pdf_budget_mb=None):
+    """
+    Сохраняет описание книги (book.json) - из него собираются все варианты
+
+    Пути к картинкам хранятся относительно папки книги
+    """
+    scenes = []
+    for scene in scenes_data:
+        entry = dict(scene)
+        entry['image'] = os.path.relpath(scene['image'], output_dir)
+        if scene.get('source'):
+            entry['source'] = os.path.relpath(scene['source'], output_dir)
+        scenes.append(entry)
+
+    manifest = {
+        'pdf_name': pdf_name,
+        'child_name': child_name,
+        'child_age': child_age,
+        'theme_title': theme_title,
+        'outline_mode': outline_mode,
+        'pdf_budget_mb': pdf_budget_mb,
+        'scenes': scenes,
+    }
+
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return path
+
+
+def load_manifest(output_dir):
+    """Загружает book.json, пути к картинкам - абсолютные"""
+    with open(os.path.join(output_dir, MANIFEST_NAME), 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+
+    for scene in manifest['scenes']:
+        scene['image'] = os.path.join(output_dir, scene['image'])
+        if scene.get('source'):
+            scene['source'] = os.path.join(output_dir, scene['source'])
+    return manifest
+
+
+def variant_paths(output_dir, manifest, variant):
+    """Куда сохраняется вариант: путь к PDF или список JPEG страниц"""
+    base_name = os.path.splitext(manifest['pdf_name'])[0]
+    if variant == 'screen':
+        return os.path.join(output_dir, manifest['pdf_name'])
+    if variant == 'print':
+        return os.path.join(output_dir, f"{base_name}_print.pdf")
+    if variant == 'preview':
+        return [os.path.join(output_dir, 'preview', f"page_{n + 1:02d}.jpg")
+                for n in range(len(manifest['scenes']))]
+    raise ValueError(f"Неизвестный вариант книги: {variant}")
+
+
+def is_fresh(paths, output_dir):
+    """Вариант уже собран и не старше book.json"""
+    manifest_mtime = os.path.getmtime(os.path.join(output_dir, MANIFEST_NAME))
+    paths = paths if isinstance(paths, list) else [paths]
+    return all(os.path.exists(p) and os.path.getmtime(p) >= manifest_mtime for p in paths)
+
+
+class MissingSourcesError(Exception):
+    """Для варианта нужны исходные PNG сцен, а их нет (удалены или не сохранялись)"""
+
+
+def has_sources(manifest):
+    """У всех сцен книги есть исходные PNG на диске"""
+    return all(scene.get('source') and os.path.exists(scene['source']) for scene in manifest['scenes'])
+
+
+def prepare_images(scenes, folder, spec):
+    """
+    Готовит картинки сцен под вариант: масштаб и качество из spec
+
+    Если quality не задано - используется иллюстрация как есть
+    (для source-вариантов - исходный PNG, без перекодирования)
+    """
+    if spec.get('source'):
+        if not has_sources({'scenes': scenes}):
+            raise MissingSourcesError("Нет исходных PNG сцен")
+        return [dict(scene, image=scene['source']) for scene in scenes]
+    if spec['quality'] is None:
+        return scenes
+
+    from PIL import Image
+    from pdf_budget import to_rgb, resize
+
+    os.makedirs(folder, exist_ok=True)
+    prepared = []
+    for scene in scenes:
+        source = scene.get('source') or scene['image']
+        image_path = os.path.join(folder, os.path.splitext(os.path.basename(scene['image']))[0] + ".jpg")
+        with Image.open(source) as img:
+            img = to_rgb(img)
+            if spec['max_side']:
+                img = resize(img, spec['max_side'] / max(img.size))
+            img.save(image_path, 'JPEG', quality=spec['quality'], optimize=True)
+        prepared.append(dict(scene, image=image_path))
+    return prepared
+
+
+def render_variant(output_dir, variant, manifest=None, force=False, buffer=None):
+    """
+    Собирает один вариант книги (или берёт уже собранный)
+
+    Args:
+        buffer: io.BytesIO - собрать PDF в память, а не на диск (кэш не используется)
+
+    Returns:
+        путь к PDF, buffer или список путей к JPEG страниц
+    """
+    from pdf_generator import create_book_from_data
+
+    manifest = manifest or load_manifest(output_dir)
+    spec = BOOK_VARIANTS[variant]
+    paths = variant_paths(output_dir, manifest, variant)
+
+    if buffer is None and not force and is_fresh(paths, output_dir):
+        print(f"♻️ Вариант {variant} уже собран - беру из кэша")
+        return paths
+
+    scenes = manifest['scenes']
+
+    if spec['kind'] == 'jpeg':
+        folder = os.path.dirname(paths[0])
+        prepared = prepare_images(scenes, folder, spec)
+        for scene, path in zip(prepared, paths):
+            os.replace(scene['image'], path)
+        print(f"🖼️ Превью: {len(paths)} страниц")
+        return paths
+
+    target = paths if buffer is None else buffer
+
+    def build_pdf(book_scenes):
+        if buffer is not None:
+            # Подгонка под бюджет собирает PDF несколько раз - начинаем буфер заново
+            buffer.seek(0)
+            buffer.truncate()
+        create_book_from_data(manifest['child_name'], manifest['child_age'], book_scenes, target,
+                              manifest['theme_title'], outline_mode=manifest.get('outline_mode'))
+        return target
+
+    if variant == 'screen' and manifest.get('pdf_budget_mb'):
+        # Подбираем разрешение и качество картинок под бюджет размера PDF
+        from pdf_budget import fit_scenes_to_budget
+        fit_scenes_to_budget(scenes, int(manifest['pdf_budget_mb'] * 1024 * 1024), output_dir,
+                             build_pdf=build_pdf)
+    else:
+        build_pdf(prepare_images(scenes, os.path.join(output_dir, variant), spec))
+
+    if buffer is not None:
+        buffer.seek(0)
+    return target
+
+
+def render_variants(output_dir, variants=DEFAULT_VARIANTS, force=False, buffers=None):
+    """
+    Собирает несколько вариантов книги параллельно
+
+    Args:
+        buffers: {вариант: io.BytesIO} - какие PDF собрать в память
+
+    Returns:
+        {вариант: путь к PDF, буфер или список JPEG}
+    """
+    manifest = load_manifest(output_dir)
+    buffers = buffers or {}
+    with ThreadPoolExecutor(max_workers=len(variants) or 1) as pool:
+        futures = {variant: pool.submit(render_variant, output_dir, variant, manifest, force,
+                                        buffers.get(variant))
+                   for variant in variants}
+        return {variant: future.result() for variant, future in futures.items()}
+
+
+def drop_sources(output_dir):
+    """
+    Удаляет исходные PNG сцен (<сцена>_src.png) после сборки вариантов
+
+    Из book.json убираются ссылки на них - screen и preview дальше собираются
+    из сжатых иллюстраций, а print больше не собрать (MissingSourcesError).
+    Время изменения book.json сохраняется: уже собранные варианты остаются в кэше.
+
+    Returns:
+        сколько байт освобождено
+    """
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    with open(path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+
+    reclaimed = 0
+    for scene in manifest['scenes']:
+        source = scene.pop('source', None)
+        if source and os.path.exists(os.path.join(output_dir, source)):
+            reclaimed += os.path.getsize(os.path.join(output_dir, source))
+            os.remove(os.path.join(output_dir, source))
+
+    stat = os.stat(path)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    return reclaimed
+
+
+def book_files(output_dir, manifest):
+    """Файлы книги, нужные для пересборки: {имя в папке книги: путь}"""
+    names = [MANIFEST_NAME]
+    for scene in manifest['scenes']:
+        names.append(os.path.relpath(scene['image'], output_dir))
+        if scene.get('source'):
+            names.append(os.path.relpath(scene['source'], output_dir))
+    names.append(manifest['pdf_name'])
+    return {name: os.path.join(output_dir, name) for name in names}
+
+
+def publish_book(store, output_dir, pdf_buffer=None):
+    """
+    Загружает книгу в хранилище артефактов (файлы - параллельно)
+
+    Args:
+        store: хранилище из artifact_store
+        pdf_buffer: screen PDF, если он собран в памяти
+
+    Returns:
+        {имя файла: {'hash', 'size', 'content_type'}}
+    """
+    from artifact_store import guess_content_type
+
+    manifest = load_manifest(output_dir)
+    files = book_files(output_dir, manifest)
+
+    def upload(name, path):
+        if name == manifest['pdf_name'] and pdf_buffer is not None:
+            data = pdf_buffer.getvalue()
+        elif os.path.exists(path):
+            with open(path, 'rb') as f:
+                data = f.read()
+        else:
+            return None
+        content_type = guess_content_type(name)
+        return {'hash': store.put(data, content_type), 'size': len(data), 'content_type': content_type}
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        futures = {name: pool.submit(upload, name, path) for name, path in files.items()}
+        artifacts = {name: future.result() for name, future in futures.items()}
+
+    artifacts = {name: info for name, info in artifacts.items() if info}
+    print(f"☁️ Книга сохранена в хранилище: {len(artifacts)} файлов")
+    return artifacts
+
+
+def restore_book(store, artifacts, output_dir):
+    """
+    Восстанавливает папку книги из хранилища (например, после редеплоя)
+
+    Уже существующие файлы нужного размера не скачиваются
+
+    Args:
+        artifacts: {имя файла: {'hash', 'size', ...}} - из publish_book / order_artifacts
+    """
+    for name, info in artifacts.items():
+        path = os.path.join(output_dir, name)
+        if os.path.exists(path) and os.path.getsize(path) == info['size']:
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(store.get(info['hash']))
+        os.replace(tmp_path, path)
+    return output_dir
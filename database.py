@@ -6,129 +6,215 @@ PostgreSQL на Railway (как в Sefirum!)
 """
 
 import os
+import time
+import threading
 import psycopg2
+from psycopg2.pool import PoolError, ThreadedConnectionPool
 from psycopg2.extras import RealDictCursor
+from contextlib import contextmanager
 from datetime import datetime
 from typing import Optional, Dict, List
 
 # Подключение к PostgreSQL
 DATABASE_URL = os.environ.get("DATABASE_URL", "")
 
+# Пул подключений: сколько держать открытыми и сколько максимум
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", "10"))
+
+# Подключение, простоявшее в пуле дольше - проверяется SELECT 1 перед выдачей
+DB_POOL_CHECK_AFTER = 30
+
+# Сколько секунд ждать свободное подключение, когда заняты все DB_POOL_MAX
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "30"))
+
+# Сводка по stats_rollup: строка на каждый план + итоговая строка (is_total)
+STATS_REPORT_SQL = '''
+    SELECT
+        plan,
+        GROUPING(plan) = 1 AS is_total,
+        COALESCE(SUM(orders), 0) AS total_orders,
+        COALESCE(SUM(orders) FILTER (WHERE status IN ('paid', 'completed')), 0) AS paid_orders,
+        COALESCE(SUM(orders) FILTER (WHERE status = 'completed'), 0) AS completed_orders,
+        COALESCE(SUM(orders) FILTER (WHERE status = 'pending'), 0) AS pending_orders,
+        COALESCE(SUM(orders) FILTER (WHERE status = 'failed'), 0) AS failed_orders,
+        COALESCE(SUM(orders) FILTER (WHERE status = 'refunded'), 0) AS refunded_orders,
+        COALESCE(SUM(orders) FILTER (WHERE day = CURRENT_DATE), 0) AS orders_today,
+        COALESCE(SUM(revenue) FILTER (WHERE status <> 'refunded'), 0) AS revenue,
+        (SELECT COALESCE(SUM(new_users), 0) FROM stats) AS total_users
+    FROM stats_rollup
+    GROUP BY ROLLUP (plan)
+'''
+
+
+def build_stats_report(rows) -> Dict:
+    """Строки STATS_REPORT_SQL -> {'total': {...}, 'by_plan': {plan: {...}}}"""
+    report = {'total': None, 'by_plan': {}}
+    for row in rows:
+        row = {key: (int(value) if key not in ('plan', 'is_total') else value)
+               for key, value in dict(row).items()}
+        if row.pop('is_total'):
+            report['total'] = row
+        else:
+            report['by_plan'][row['plan']] = row
+    return report
+
+
 class Database:
     """Класс для работы с PostgreSQL базой данных"""
     
     def __init__(self):
         self.database_url = DATABASE_URL
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        # getconn не ждёт, а сразу бросает PoolError, если все подключения заняты -
+        # очередь за подключением держим сами
+        self._pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+        self._returned_at = {}  # id(conn) -> когда вернули в пул
         self.init_database()
     
     def get_connection(self):
-        """Получить подключение к PostgreSQL"""
+        """
+        Получить отдельное подключение к PostgreSQL (вне пула)
+        
+        Для обычных запросов используйте connection() / transaction()
+        """
         if not self.database_url:
             raise Exception("❌ DATABASE_URL не установлен!")
         return psycopg2.connect(self.database_url)
     
+    def _get_pool(self):
+        """Пул подключений (создаётся при первом запросе)"""
+        if self._pool is None:
+            if not self.database_url:
+                raise Exception("❌ DATABASE_URL не установлен!")
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, self.database_url)
+        return self._pool
+    
+    def _is_alive(self, conn) -> bool:
+        """Проверка подключения перед выдачей из пула"""
+        if conn.closed:
+            return False
+        returned_at = self._returned_at.get(id(conn))
+        if returned_at and time.monotonic() - returned_at < DB_POOL_CHECK_AFTER:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+    
+    @contextmanager
+    def connection(self):
+        """
+        Взять подключение из пула и вернуть его после with
+        
+        Незавершённая транзакция откатывается, сломанное подключение
+        закрывается и не возвращается в пул. Если все подключения заняты -
+        ждём свободное до DB_POOL_TIMEOUT секунд, потом PoolError
+        """
+        pool = self._get_pool()
+        if not self._pool_slots.acquire(timeout=DB_POOL_TIMEOUT):
+            raise PoolError(f"Нет свободного подключения к БД за {DB_POOL_TIMEOUT:.0f} сек")
+        
+        try:
+            conn = pool.getconn()
+            while not self._is_alive(conn):
+                self._discard(pool, conn)
+                conn = pool.getconn()
+            
+            broken = False
+            try:
+                yield conn
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                broken = True
+                raise
+            finally:
+                if not broken and not conn.closed:
+                    try:
+                        conn.rollback()
+                    except psycopg2.Error:
+                        broken = True
+                if broken or conn.closed:
+                    self._discard(pool, conn)
+                else:
+                    self._returned_at[id(conn)] = time.monotonic()
+                    pool.putconn(conn)
+        finally:
+            self._pool_slots.release()
+    
+    def _discard(self, pool, conn):
+        """Закрыть подключение и забыть его (id объекта может достаться новому подключению)"""
+        self._returned_at.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+    
+    @contextmanager
+    def transaction(self, cursor_factory=None):
+        """
+        Курсор в транзакции: COMMIT после with, ROLLBACK при исключении
+        
+        with db.transaction() as cursor:
+            cursor.execute(...)
+        """
+        with self.connection() as conn:
+            cursor = conn.cursor(cursor_factory=cursor_factory)
+            try:
+                yield cursor
+                conn.commit()
+            finally:
+                cursor.close()
+    
+    def close(self):
+        """Закрыть все подключения пула (при остановке бота)"""
+        if self._pool is not None:
+            self._pool.closeall()
+            self._pool = None
+            self._returned_at.clear()
+    
     def init_database(self):
         """Создать таблицы если не существуют"""
         if not self.database_url:
             print("⚠️ PostgreSQL не настроена (нет DATABASE_URL)")
             return
         
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # Таблица пользователей
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id BIGINT PRIMARY KEY,
-                username VARCHAR(255),
-                first_name VARCHAR(255),
-                last_name VARCHAR(255),
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Таблица заказов
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS orders (
-                order_id SERIAL PRIMARY KEY,
-                user_id BIGINT NOT NULL,
-                theme VARCHAR(100) NOT NULL,
-                child_name VARCHAR(100) NOT NULL,
-                child_age INTEGER NOT NULL,
-                gender VARCHAR(10) NOT NULL,
-                photo_description TEXT,
-                status VARCHAR(50) DEFAULT 'pending',
-                pdf_path TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                completed_at TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            )
-        ''')
-        
-        # Таблица платежей
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS payments (
-                payment_id VARCHAR(255) PRIMARY KEY,
-                order_id INTEGER NOT NULL,
-                user_id BIGINT NOT NULL,
-                amount INTEGER NOT NULL,
-                status VARCHAR(50) DEFAULT 'pending',
-                payment_url TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                paid_at TIMESTAMP,
-                FOREIGN KEY (order_id) REFERENCES orders(order_id),
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            )
-        ''')
-        
-        # Таблица статистики
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS stats (
-                date DATE PRIMARY KEY,
-                new_users INTEGER DEFAULT 0,
-                total_orders INTEGER DEFAULT 0,
-                completed_orders INTEGER DEFAULT 0,
-                revenue INTEGER DEFAULT 0
-            )
-        ''')
+        # Схема описана в migrations.py: применяются только ещё не применённые миграции
+        from migrations import apply_migrations
+        apply_migrations(self)
         
-        conn.commit()
-        cursor.close()
-        conn.close()
         print("✅ PostgreSQL база данных инициализирована!")
     
     # ===== РАБОТА С ПОЛЬЗОВАТЕЛЯМИ =====
     
     def add_user(self, user_id: int, username: str = None, 
-                 first_name: str = None, last_name: str = None):
-        """Добавить пользователя (если нет) или обновить last_active"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO users (user_id, username, first_name, last_name)
-            VALUES (%s, %s, %s, %s)
-            ON CONFLICT (user_id) DO UPDATE SET
-                username = EXCLUDED.username,
-                first_name = EXCLUDED.first_name,
-                last_name = EXCLUDED.last_name,
-                last_active = CURRENT_TIMESTAMP
-        ''', (user_id, username, first_name, last_name))
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
+                 first_name: str = None, last_name: str = None) -> bool:
+        """
+        Добавить пользователя (если нет) или обновить last_active
+
+        Returns:
+            True, если пользователь новый (его нужно посчитать в stats.new_users)
+        """
+        with self.transaction() as cursor:
+            cursor.execute('''
+                INSERT INTO users (user_id, username, first_name, last_name)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    username = EXCLUDED.username,
+                    first_name = EXCLUDED.first_name,
+                    last_name = EXCLUDED.last_name,
+                    last_active = CURRENT_TIMESTAMP
+                RETURNING (xmax = 0) AS inserted
+            ''', (user_id, username, first_name, last_name))
+            return cursor.fetchone()[0]
     
     def get_user(self, user_id: int) -> Optional[Dict]:
         """Получить пользователя"""
-        conn = self.get_connection()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cursor.execute('SELECT * FROM users WHERE user_id = %s', (user_id,))
-        row = cursor.fetchone()
-        cursor.close()
-        conn.close()
+        with self.transaction(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute('SELECT * FROM users WHERE user_id = %s', (user_id,))
+            row = cursor.fetchone()
         
         if row:
             return dict(row)
@@ -136,54 +222,43 @@ class Database:
     
     def get_user_stats(self, user_id: int) -> Dict:
         """Статистика пользователя"""
-        conn = self.get_connection()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cursor.execute('''
-            SELECT 
-                COUNT(*) as total_orders,
-                SUM(CASE WHEN status = 'completed' THEN 1 ELSE 0 END) as completed_orders,
-                SUM(CASE WHEN status = 'paid' THEN 1 ELSE 0 END) as paid_orders
-            FROM orders WHERE user_id = %s
-        ''', (user_id,))
-        
-        row = cursor.fetchone()
-        cursor.close()
-        conn.close()
+        with self.transaction(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute('''
+                SELECT 
+                    COUNT(*) as total_orders,
+                    SUM(CASE WHEN status = 'completed' THEN 1 ELSE 0 END) as completed_orders,
+                    SUM(CASE WHEN status = 'paid' THEN 1 ELSE 0 END) as paid_orders
+                FROM orders WHERE user_id = %s
+            ''', (user_id,))
+            
+            row = cursor.fetchone()
         
         return dict(row) if row else {}
     
     # ===== РАБОТА С ЗАКАЗАМИ =====
     
     def create_order(self, user_id: int, theme: str, child_name: str, 
-                    child_age: int, gender: str, photo_description: str = None) -> int:
+                    child_age: int, gender: str, photo_description: str = None,
+                    plan: str = 'standard', photo_path: str = None) -> int:
         """Создать заказ"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO orders (user_id, theme, child_name, child_age, gender, photo_description)
-            VALUES (%s, %s, %s, %s, %s, %s)
-            RETURNING order_id
-        ''', (user_id, theme, child_name, child_age, gender, photo_description))
-        
-        order_id = cursor.fetchone()[0]
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with self.transaction() as cursor:
+            cursor.execute('''
+                INSERT INTO orders (user_id, theme, child_name, child_age, gender, photo_description, plan, photo_path)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                RETURNING order_id, created_at::date, status
+            ''', (user_id, theme, child_name, child_age, gender, photo_description, plan, photo_path))
+            
+            order_id, day, status = cursor.fetchone()
+            self._rollup_add(cursor, day, theme, plan, status, orders=1)
         
         print(f"✅ Создан заказ #{order_id} для user {user_id}")
         return order_id
     
     def get_order(self, order_id: int) -> Optional[Dict]:
         """Получить заказ"""
-        conn = self.get_connection()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cursor.execute('SELECT * FROM orders WHERE order_id = %s', (order_id,))
-        row = cursor.fetchone()
-        cursor.close()
-        conn.close()
+        with self.transaction(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute('SELECT * FROM orders WHERE order_id = %s', (order_id,))
+            row = cursor.fetchone()
         
         if row:
             return dict(row)
@@ -191,8 +266,53 @@ class Database:
     
     def update_order_status(self, order_id: int, status: str, pdf_path: str = None):
         """Обновить статус заказа"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        with self.transaction() as cursor:
+            self._set_order_status(cursor, order_id, status, pdf_path)
+        
+        print(f"✅ Заказ #{order_id} → статус: {status}")
+    
+    def refund_failed_order(self, order_id: int) -> Optional[Dict]:
+        """
+        Пометить failed заказ как возвращённый (refunded)
+        
+        Returns:
+            {'user_id', 'status'} заказа до изменения или None, если заказа нет
+        """
+        with self.transaction() as cursor:
+            cursor.execute('SELECT user_id FROM orders WHERE order_id = %s', (order_id,))
+            row = cursor.fetchone()
+            if not row:
+                return None
+            
+            old = self._set_order_status(cursor, order_id, 'refunded', only_from='failed')
+        
+        return {'user_id': row[0], 'status': old['status']}
+    
+    def _set_order_status(self, cursor, order_id, status, pdf_path=None, only_from=None):
+        """
+        Сменить статус заказа и перенести его в stats_rollup (внутри транзакции)
+        
+        Заказ вместе с оплаченной суммой переезжает из строки старого статуса
+        в строку нового. only_from - менять, только если текущий статус такой.
+        
+        Returns:
+            прежние {'status', 'theme', 'plan', 'day', 'revenue'} или None, если заказа нет
+        """
+        cursor.execute('''
+            SELECT status, theme, plan, created_at::date,
+                   (SELECT COALESCE(SUM(amount), 0) FROM payments
+                    WHERE payments.order_id = orders.order_id AND payments.status = 'succeeded')
+            FROM orders
+            WHERE order_id = %s
+            FOR UPDATE
+        ''', (order_id,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        
+        old = dict(zip(('status', 'theme', 'plan', 'day', 'revenue'), row))
+        if only_from is not None and old['status'] != only_from:
+            return old
         
         if status == 'completed':
             cursor.execute('''
@@ -207,87 +327,197 @@ class Database:
                 WHERE order_id = %s
             ''', (status, order_id))
         
-        conn.commit()
-        cursor.close()
-        conn.close()
+        if old['status'] != status:
+            self._rollup_add(cursor, old['day'], old['theme'], old['plan'], old['status'],
+                             orders=-1, revenue=-old['revenue'])
+            self._rollup_add(cursor, old['day'], old['theme'], old['plan'], status,
+                             orders=1, revenue=old['revenue'])
+        return old
+    
+    def _rollup_add(self, cursor, day, theme, plan, status, orders=0, revenue=0):
+        """Прибавить к строке stats_rollup (day, theme, plan, status)"""
+        cursor.execute('''
+            INSERT INTO stats_rollup (day, theme, plan, status, orders, revenue)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            ON CONFLICT (day, theme, plan, status) DO UPDATE SET
+                orders = stats_rollup.orders + EXCLUDED.orders,
+                revenue = stats_rollup.revenue + EXCLUDED.revenue
+        ''', (day, theme, plan or 'standard', status or 'pending', orders, revenue))
+    
+    def start_order_attempt(self, order_id: int) -> int:
+        """Начать новую попытку генерации заказа, вернуть её номер (1, 2, ...)"""
+        with self.transaction() as cursor:
+            cursor.execute('''
+                UPDATE orders 
+                SET attempts = COALESCE(attempts, 0) + 1
+                WHERE order_id = %s
+                RETURNING attempts
+            ''', (order_id,))
+            
+            row = cursor.fetchone()
         
-        print(f"✅ Заказ #{order_id} → статус: {status}")
+        return row[0] if row else 1
+    
+    def set_order_pdf_file_id(self, order_id: int, file_id: Optional[str]):
+        """Запомнить file_id PDF в Telegram (None - сбросить)"""
+        with self.transaction() as cursor:
+            cursor.execute('''
+                UPDATE orders 
+                SET pdf_file_id = %s
+                WHERE order_id = %s
+            ''', (file_id, order_id))
+    
+    def get_protected_pdf_paths(self, days: int) -> List[str]:
+        """PDF, которые нельзя удалять с диска: недавние и ещё не отправленные в Telegram"""
+        with self.transaction() as cursor:
+            cursor.execute('''
+                SELECT pdf_path FROM orders
+                WHERE pdf_path IS NOT NULL
+                  AND (pdf_file_id IS NULL OR completed_at > NOW() - make_interval(days => %s))
+            ''', (days,))
+            
+            rows = cursor.fetchall()
+        
+        return [row[0] for row in rows]
     
     def get_user_orders(self, user_id: int, limit: int = 10) -> List[Dict]:
         """Получить заказы пользователя"""
-        conn = self.get_connection()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cursor.execute('''
-            SELECT * FROM orders 
-            WHERE user_id = %s 
-            ORDER BY created_at DESC 
-            LIMIT %s
-        ''', (user_id, limit))
-        
-        rows = cursor.fetchall()
-        cursor.close()
-        conn.close()
+        with self.transaction(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute('''
+                SELECT * FROM orders 
+                WHERE user_id = %s 
+                ORDER BY created_at DESC 
+                LIMIT %s
+            ''', (user_id, limit))
+            
+            rows = cursor.fetchall()
         
         return [dict(row) for row in rows]
     
+    def save_order_artifacts(self, order_id: int, artifacts: Dict[str, Dict]):
+        """Записать файлы заказа в хранилище: {имя: {'hash', 'size', 'content_type'}}"""
+        with self.transaction() as cursor:
+            cursor.executemany('''
+                INSERT INTO order_artifacts (order_id, name, artifact_hash, size, content_type)
+                VALUES (%s, %s, %s, %s, %s)
+                ON CONFLICT (order_id, name) DO UPDATE SET
+                    artifact_hash = EXCLUDED.artifact_hash,
+                    size = EXCLUDED.size,
+                    content_type = EXCLUDED.content_type,
+                    created_at = CURRENT_TIMESTAMP
+            ''', [(order_id, name, info['hash'], info['size'], info.get('content_type'))
+                  for name, info in artifacts.items()])
+    
+    def get_order_artifacts(self, order_id: int) -> Dict[str, Dict]:
+        """Файлы заказа в хранилище: {имя: {'hash', 'size', 'content_type'}}"""
+        with self.transaction() as cursor:
+            cursor.execute('''
+                SELECT name, artifact_hash, size, content_type
+                FROM order_artifacts
+                WHERE order_id = %s
+            ''', (order_id,))
+            
+            rows = cursor.fetchall()
+        
+        return {name: {'hash': artifact_hash, 'size': size, 'content_type': content_type}
+                for name, artifact_hash, size, content_type in rows}
+    
     # ===== РАБОТА С ПЛАТЕЖАМИ =====
     
     def create_payment(self, payment_id: str, order_id: int, 
                       user_id: int, amount: int, payment_url: str = None):
         """Создать платёж"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO payments (payment_id, order_id, user_id, amount, payment_url)
-            VALUES (%s, %s, %s, %s, %s)
-        ''', (payment_id, order_id, user_id, amount, payment_url))
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with self.transaction() as cursor:
+            cursor.execute('''
+                INSERT INTO payments (payment_id, order_id, user_id, amount, payment_url)
+                VALUES (%s, %s, %s, %s, %s)
+            ''', (payment_id, order_id, user_id, amount, payment_url))
         
         print(f"✅ Создан платёж {payment_id} для заказа #{order_id}")
     
     def update_payment_status(self, payment_id: str, status: str):
         """Обновить статус платежа"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        if status == 'succeeded':
-            cursor.execute('''
-                UPDATE payments 
-                SET status = %s, paid_at = CURRENT_TIMESTAMP
-                WHERE payment_id = %s
-            ''', (status, payment_id))
-        else:
-            cursor.execute('''
-                UPDATE payments 
-                SET status = %s
-                WHERE payment_id = %s
-            ''', (status, payment_id))
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with self.transaction() as cursor:
+            if status == 'succeeded':
+                cursor.execute('''
+                    UPDATE payments 
+                    SET status = %s, paid_at = CURRENT_TIMESTAMP
+                    WHERE payment_id = %s AND status IS DISTINCT FROM 'succeeded'
+                    RETURNING order_id, amount
+                ''', (status, payment_id))
+                row = cursor.fetchone()
+                
+                # Выручка - в строку stats_rollup, где заказ лежит сейчас (только при первом succeeded)
+                if row:
+                    order_id, amount = row
+                    cursor.execute('''
+                        SELECT status, theme, plan, created_at::date
+                        FROM orders WHERE order_id = %s
+                        FOR UPDATE
+                    ''', (order_id,))
+                    order = cursor.fetchone()
+                    if order:
+                        order_status, theme, plan, day = order
+                        self._rollup_add(cursor, day, theme, plan, order_status, revenue=amount)
+            else:
+                cursor.execute('''
+                    UPDATE payments 
+                    SET status = %s
+                    WHERE payment_id = %s
+                ''', (status, payment_id))
         
         print(f"✅ Платёж {payment_id} → статус: {status}")
     
     def get_payment(self, payment_id: str) -> Optional[Dict]:
         """Получить платёж"""
-        conn = self.get_connection()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cursor.execute('SELECT * FROM payments WHERE payment_id = %s', (payment_id,))
-        row = cursor.fetchone()
-        cursor.close()
-        conn.close()
+        with self.transaction(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute('SELECT * FROM payments WHERE payment_id = %s', (payment_id,))
+            row = cursor.fetchone()
         
         if row:
             return dict(row)
         return None
     
+    # ===== БЕСПЛАТНЫЕ КРЕДИТЫ =====
+    
+    def seed_credits(self, grants: Dict[int, int]):
+        """Начислить стартовые кредиты {user_id: книг} - только тем, у кого записи ещё нет"""
+        if not grants:
+            return
+        with self.transaction() as cursor:
+            cursor.executemany('''
+                INSERT INTO credits (user_id, balance)
+                VALUES (%s, %s)
+                ON CONFLICT (user_id) DO NOTHING
+            ''', list(grants.items()))
+    
+    # ===== СТАТИЧНЫЕ КАРТИНКИ =====
+    
+    def get_static_asset_file_id(self, file_hash: str) -> Optional[str]:
+        """Получить file_id картинки по хэшу файла"""
+        with self.transaction() as cursor:
+            cursor.execute('SELECT file_id FROM static_assets WHERE file_hash = %s', (file_hash,))
+            row = cursor.fetchone()
+        
+        return row[0] if row else None
+    
+    def save_static_asset_file_id(self, file_hash: str, path: str, file_id: str):
+        """Запомнить file_id картинки"""
+        with self.transaction() as cursor:
+            cursor.execute('''
+                INSERT INTO static_assets (file_hash, path, file_id)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (file_hash) DO UPDATE SET
+                    path = EXCLUDED.path,
+                    file_id = EXCLUDED.file_id,
+                    updated_at = CURRENT_TIMESTAMP
+            ''', (file_hash, path, file_id))
+    
+    def delete_static_asset(self, file_hash: str):
+        """Забыть file_id картинки (Telegram его больше не принимает)"""
+        with self.transaction() as cursor:
+            cursor.execute('DELETE FROM static_assets WHERE file_hash = %s', (file_hash,))
+    
     # ===== СТАТИСТИКА =====
     
     def update_daily_stats(self, new_users: int = 0, total_orders: int = 0, 
@@ -295,70 +525,55 @@ class Database:
         """Обновить статистику за день"""
         today = datetime.now().date()
         
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO stats (date, new_users, total_orders, completed_orders, revenue)
-            VALUES (%s, %s, %s, %s, %s)
-            ON CONFLICT (date) DO UPDATE SET
-                new_users = stats.new_users + EXCLUDED.new_users,
-                total_orders = stats.total_orders + EXCLUDED.total_orders,
-                completed_orders = stats.completed_orders + EXCLUDED.completed_orders,
-                revenue = stats.revenue + EXCLUDED.revenue
-        ''', (today, new_users, total_orders, completed_orders, revenue))
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with self.transaction() as cursor:
+            cursor.execute('''
+                INSERT INTO stats (date, new_users, total_orders, completed_orders, revenue)
+                VALUES (%s, %s, %s, %s, %s)
+                ON CONFLICT (date) DO UPDATE SET
+                    new_users = stats.new_users + EXCLUDED.new_users,
+                    total_orders = stats.total_orders + EXCLUDED.total_orders,
+                    completed_orders = stats.completed_orders + EXCLUDED.completed_orders,
+                    revenue = stats.revenue + EXCLUDED.revenue
+            ''', (today, new_users, total_orders, completed_orders, revenue))
     
     def get_stats(self, days: int = 7) -> List[Dict]:
         """Получить статистику за N дней"""
-        conn = self.get_connection()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cursor.execute('''
-            SELECT * FROM stats 
-            ORDER BY date DESC 
-            LIMIT %s
-        ''', (days,))
-        
-        rows = cursor.fetchall()
-        cursor.close()
-        conn.close()
+        with self.transaction(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute('''
+                SELECT * FROM stats 
+                ORDER BY date DESC 
+                LIMIT %s
+            ''', (days,))
+            
+            rows = cursor.fetchall()
         
         return [dict(row) for row in rows]
     
+    def get_stats_report(self) -> Dict:
+        """
+        Сводка для /stats и /analytics - один запрос по stats_rollup
+        
+        Returns:
+            {'total': {...}, 'by_plan': {plan: {...}}}, где {...} - total_orders,
+            paid_orders (paid + completed), completed_orders, pending_orders,
+            failed_orders, refunded_orders, orders_today, revenue, total_users
+        """
+        with self.transaction(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(STATS_REPORT_SQL)
+            rows = cursor.fetchall()
+        
+        return build_stats_report(rows)
+    
     def get_total_stats(self) -> Dict:
         """Общая статистика"""
-        conn = self.get_connection()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        
-        # Всего пользователей
-        cursor.execute('SELECT COUNT(*) as total_users FROM users')
-        total_users = cursor.fetchone()['total_users']
-        
-        # Всего заказов
-        cursor.execute('SELECT COUNT(*) as total_orders FROM orders')
-        total_orders = cursor.fetchone()['total_orders']
-        
-        # Завершённых заказов
-        cursor.execute("SELECT COUNT(*) as completed FROM orders WHERE status = 'completed'")
-        completed = cursor.fetchone()['completed']
-        
-        # Выручка
-        cursor.execute("SELECT COALESCE(SUM(amount), 0) as revenue FROM payments WHERE status = 'succeeded'")
-        revenue = cursor.fetchone()['revenue']
-        
-        cursor.close()
-        conn.close()
-        
+        total = self.get_stats_report()['total']
+        total_orders = total['total_orders']
         return {
-            'total_users': total_users,
+            'total_users': total['total_users'],
             'total_orders': total_orders,
-            'completed_orders': completed,
-            'revenue': revenue,
-            'conversion': (completed / total_orders * 100) if total_orders > 0 else 0
+            'completed_orders': total['completed_orders'],
+            'revenue': total['revenue'],
+            'conversion': (total['completed_orders'] / total_orders * 100) if total_orders > 0 else 0
         }
 
 
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Журнал событий воронки (start, theme_chosen, photo_uploaded, payment_created, ...)
+
+log() только кладёт событие в память - без запроса к БД на каждый клик.
+flush() пишет накопленное в таблицу analytics_events одним COPY: по job_queue
+раз в EVENT_FLUSH_INTERVAL секунд, сразу при EVENT_BATCH_SIZE событиях
+и при остановке бота. Поэтому аналитика переживает перезапуски.
+"""
+
+import asyncio
+import logging
+import os
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Как часто сбрасывать события в БД (сек) и при каком размере пачки - сразу
+EVENT_FLUSH_INTERVAL = int(os.environ.get("EVENT_FLUSH_INTERVAL", "5"))
+EVENT_BATCH_SIZE = int(os.environ.get("EVENT_BATCH_SIZE", "500"))
+
+# Если БД недоступна - держим в памяти не больше стольких событий (старые отбрасываются)
+EVENT_BUFFER_LIMIT = 50_000
+
+EVENT_COLUMNS = ('event', 'user_id', 'created_at')
+
+
+class EventLog:
+    """Буфер событий аналитики с пакетной записью в Postgres"""
+
+    def __init__(self, adb, batch_size=EVENT_BATCH_SIZE):
+        self.adb = adb
+        self.batch_size = batch_size
+        self._buffer = []
+        self._flush_lock = asyncio.Lock()
+        self._job_queue = None
+
+    def log(self, event, user_id=None):
+        """Запоминает событие (вызывать из хендлеров, в event loop бота)"""
+        self._buffer.append((event, user_id, datetime.now()))
+        if len(self._buffer) >= self.batch_size and self._job_queue is not None:
+            # Пачка набралась - сбрасываем, не дожидаясь таймера
+            self._job_queue.run_once(self.flush_job, when=0, name='event_log_flush_now')
+
+    async def flush(self):
+        """Записывает накопленные события в analytics_events. Возвращает их число"""
+        async with self._flush_lock:
+            if not self._buffer:
+                return 0
+            events, self._buffer = self._buffer, []
+            try:
+                async with self.adb.connection() as conn:
+                    await conn.copy_records_to_table('analytics_events', records=events, columns=EVENT_COLUMNS)
+            except Exception as e:
+                # Возвращаем события в начало буфера - запишем со следующей попыткой
+                self._buffer = (events + self._buffer)[-EVENT_BUFFER_LIMIT:]
+                logger.error(f"📊 События аналитики не записаны ({len(events)} шт.), повторю позже: {e}")
+                return 0
+            return len(events)
+
+    async def flush_job(self, context):
+        """Callback для job_queue"""
+        await self.flush()
+
+    def start(self, job_queue, interval=EVENT_FLUSH_INTERVAL):
+        """Запускает периодическую запись через job_queue"""
+        self._job_queue = job_queue
+        job_queue.run_repeating(self.flush_job, interval=interval, first=interval, name='event_log_flush')
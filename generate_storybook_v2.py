@@ -18,6 +18,10 @@ import pymorphy3
 REPLICATE_API_TOKEN = os.environ.get("REPLICATE_API_TOKEN", "")
 ANTHROPIC_API_KEY = os.environ.get("ANTHROPIC_API_KEY", "")
 
+# Хранить исходные PNG сцен после сборки книги - из них собирается печатный PDF (print).
+# Место на диске ограничивает janitor.py; false - удалять сразу (print будет недоступен)
+KEEP_SOURCE_IMAGES = os.environ.get("KEEP_SOURCE_IMAGES", "true").lower() == "true"
+
 if not ANTHROPIC_API_KEY:
     print("❌ ANTHROPIC_API_KEY не установлен!")
 else:
@@ -231,7 +235,11 @@ def clean_prompt_from_nsfw_triggers(prompt, level=1):
     return cleaned
 
 
-def generate_illustration(prompt, output_path, photo_path=None, use_pulid=False):
+def source_path_for(image_path):
+    """Путь к исходному PNG иллюстрации (если сохранён через keep_source)"""
+    return os.path.splitext(image_path)[0] + "_src.png"
+
+def generate_illustration(prompt, output_path, photo_path=None, use_pulid=False, keep_source=False):
     """
     Генерирует иллюстрацию через Flux Pro или PuLID
     ✅ ИСПРАВЛЕНО: Использует вертикальный формат 3:4 (768x1024)
@@ -243,6 +251,8 @@ def generate_illustration(prompt, output_path, photo_path=None, use_pulid=False)
         output_path: путь куда сохранить изображение
         photo_path: путь к фото ребёнка (для PuLID)
         use_pulid: использовать ли PuLID (True для premium тарифа)
+        keep_source: сохранить исходный PNG рядом (<имя>_src.png) - нужен
+                     для печатного PDF и подгонки под бюджет размера (pdf_budget.py)
     """
     if use_pulid and photo_path and os.path.exists(photo_path):
         print(f"   🎭 Генерирую с PuLID (максимальная похожесть)...")
@@ -414,8 +424,11 @@ def generate_illustration(prompt, output_path, photo_path=None, use_pulid=False)
                 jpeg_path = output_path.replace('.png', '.jpg')
                 img.save(jpeg_path, 'JPEG', quality=90, optimize=True)
                 
-                # Заменяем PNG на JPEG
-                os.remove(output_path)
+                # Заменяем PNG на JPEG (исходник оставляем, если нужен)
+                if keep_source:
+                    os.replace(output_path, source_path_for(output_path))
+                else:
+                    os.remove(output_path)
                 os.rename(jpeg_path, output_path)
                 
                 new_size = os.path.getsize(output_path)
@@ -478,7 +491,13 @@ def create_storybook_v2(
     theme_id='robot_city',  # ID темы
     photo_path=None,
     story_id=None,
-    plan='standard'  # ✅ НОВОЕ: 'standard' или 'premium'
+    plan='standard',  # ✅ НОВОЕ: 'standard' или 'premium'
+    outline_mode=None,  # Обводка текста в PDF: 'overdraw' или 'stroke' (None - из PDF_OUTLINE_MODE)
+    pdf_budget_mb=None,  # Целевой размер PDF в MB (None - из PDF_BUDGET_MB, пусто - без подгонки)
+    variants=None,  # Какие варианты книги собрать сразу (None - book_formats.DEFAULT_VARIANTS)
+    on_scene_ready=None,  # Вызывается после каждой готовой иллюстрации
+    pdf_buffer=None,  # io.BytesIO - собрать screen PDF в память вместо файла
+    workspace_dir=None  # Своя папка заказа (workspace.workspace_path) вместо storybook_<имя>_<тема>
 ):
     """
     Создаёт персональную книгу - ВЕРСИЯ 2 (все темы)
@@ -493,8 +512,25 @@ def create_storybook_v2(
     - photo_path: путь к фото (опционально для standard, обязательно для premium)
     - story_id: ID конкретной истории или None (случайная)
     - plan: 'standard' (обычный Flux) или 'premium' (PuLID с максимальной похожестью)
+    - outline_mode: обводка текста в PDF - 'overdraw' (15 слоёв) или 'stroke' (контур PDF)
+    - pdf_budget_mb: бюджет размера PDF - картинки подбираются так, чтобы PDF
+      получился чуть меньше (например, 20 для лимита Telegram)
+    - variants: варианты книги из book_formats.BOOK_VARIANTS - 'screen' (PDF для
+      Telegram), 'print' (PDF для печати), 'preview' (JPEG для альбома);
+      остальные можно собрать позже через book_formats.render_variant
+    - on_scene_ready: функция(номер сцены, всего сцен, путь к картинке) - для показа
+      прогресса; вызывается из того же потока, ошибки в ней не прерывают генерацию
+    - pdf_buffer: io.BytesIO, куда записать screen PDF - файл на диск тогда не пишется
+      (его всегда можно пересобрать из book.json)
+    - workspace_dir: папка заказа; книга собирается в <папка>.partial и появляется
+      по этому пути только целиком (при ошибке остаётся .partial - см. workspace.discard_workspace)
+    
+    Возвращает путь к screen PDF (при pdf_buffer - путь, по которому он пересобирается)
     """
     
+    if pdf_budget_mb is None and os.environ.get("PDF_BUDGET_MB"):
+        pdf_budget_mb = float(os.environ["PDF_BUDGET_MB"])
+    
     # Загружаем все темы
     with open('all_themes_stories.json', 'r', encoding='utf-8') as f:
         all_themes = json.load(f)
@@ -594,8 +630,13 @@ def create_storybook_v2(
     }
     
     # Создаём папку для результатов
-    output_dir = f"storybook_{child_name}_{theme_id}"
-    os.makedirs(output_dir, exist_ok=True)
+    if workspace_dir:
+        # Заказ собирается в своей папке и публикуется целиком в конце
+        from workspace import begin_workspace
+        output_dir = begin_workspace(workspace_dir)
+    else:
+        output_dir = f"storybook_{child_name}_{theme_id}"
+        os.makedirs(output_dir, exist_ok=True)
     
     # Генерируем иллюстрации
     print("🎨 Генерирую 10 вертикальных иллюстраций 3:4...")
@@ -649,14 +690,25 @@ def create_storybook_v2(
         
         # ✅ Генерируем с учётом тарифа
         use_pulid = (plan == 'premium')  # Премиум использует PuLID для похожести
-        generate_illustration(prompt, image_path, photo_path=photo_path, use_pulid=use_pulid)
+        # Исходник нужен для печатного PDF и подгонки под бюджет
+        generate_illustration(prompt, image_path, photo_path=photo_path, use_pulid=use_pulid,
+                              keep_source=True)
         
-        scenes_data.append({
+        scene_data = {
             "number": scene_num,
             "title": scene_title,
             "text": text,
             "image": image_path
-        })
+        }
+        if os.path.exists(source_path_for(image_path)):
+            scene_data["source"] = source_path_for(image_path)
+        scenes_data.append(scene_data)
+        
+        if on_scene_ready:
+            try:
+                on_scene_ready(scene_num, len(scenes), image_path)
+            except Exception as e:
+                print(f"   ⚠️ Ошибка в on_scene_ready: {e}")
         
         # ✅ Задержка между запросами для избежания rate limit
         # Если баланс Replicate < $5, лимит 6 запросов/минуту
@@ -671,7 +723,6 @@ def create_storybook_v2(
     
     # Создаём PDF
     print("📄 Создаю PDF книгу с вертикальными изображениями...")
-    from pdf_generator import create_book_from_data
     
     # Название файла зависит от темы
     theme_names_ru = {
@@ -700,8 +751,28 @@ def create_storybook_v2(
     theme_suffix = theme_names_ru.get(theme_id, theme_id)
     theme_title = theme_titles.get(theme_id, theme_id.upper())
     
-    pdf_path = os.path.join(output_dir, f"{child_name}_{theme_suffix}.pdf")
-    create_book_from_data(child_name, child_age, scenes_data, pdf_path, theme_title)
+    # Сохраняем описание книги - из него любой вариант пересобирается без Replicate
+    from book_formats import save_manifest, render_variants, drop_sources, DEFAULT_VARIANTS
+    pdf_name = f"{child_name}_{theme_suffix}.pdf"
+    save_manifest(output_dir, pdf_name, child_name, child_age,
+                  theme_title, scenes_data, outline_mode=outline_mode, pdf_budget_mb=pdf_budget_mb)
+    
+    variants = tuple(variants or DEFAULT_VARIANTS)
+    if 'screen' not in variants:
+        variants = ('screen',) + variants
+    rendered = render_variants(output_dir, variants, force=True,
+                               buffers={'screen': pdf_buffer} if pdf_buffer is not None else None)
+    pdf_path = os.path.join(output_dir, pdf_name)
+    
+    # Без печатного PDF ~10 полноразмерных PNG в папке заказа не нужны
+    if not KEEP_SOURCE_IMAGES:
+        reclaimed = drop_sources(output_dir)
+        print(f"🧹 Исходники сцен удалены ({reclaimed / 1024 / 1024:.1f} MB)")
+    
+    if workspace_dir:
+        from workspace import publish_workspace
+        output_dir = publish_workspace(workspace_dir)
+        pdf_path = os.path.join(output_dir, pdf_name)
     
     print()
     print("="*60)
@@ -709,7 +780,8 @@ def create_storybook_v2(
     print("="*60)
     print()
     print(f"📁 Папка: {output_dir}/")
-    print(f"📄 PDF: {pdf_path}")
+    print(f"📄 PDF: {pdf_path}" + (" (в памяти)" if pdf_buffer is not None else ""))
+    print(f"📚 Варианты: {', '.join(rendered)}")
     print(f"📐 Формат изображений: 3:4 (768x1024) - вертикальный")
     print()
     print(f"💰 Себестоимость: ~151₽ (Flux Pro + Claude)")
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Сборка книги заказа - общий код для бота и воркеров генерации
+
+GENERATION_MODE=inline - книга собирается в процессе бота (как раньше)
+GENERATION_MODE=queue  - бот только кладёт задание в generation_jobs, а книги
+собирают отдельные процессы generation_worker.py (сколько угодно). Связь через
+Postgres: NOTIFY generation_jobs будит воркеры, NOTIFY generation_progress и
+generation_done сообщают боту о прогрессе и готовности.
+
+В режиме queue у бота и воркеров могут быть разные диски, поэтому фото ребёнка
+и готовая книга передаются через хранилище артефактов (ARTIFACT_STORE=s3;
+без хранилища бот и воркеры должны видеть один диск).
+"""
+
+import asyncio
+import io
+import logging
+import os
+
+from book_formats import publish_book
+from generate_storybook_v2 import create_storybook_v2
+from workspace import workspace_path, discard_workspace, new_photo_path, remove_photo
+
+logger = logging.getLogger(__name__)
+
+GENERATION_MODE = os.environ.get("GENERATION_MODE", "inline")
+
+# 📄 Собирать PDF в памяти и отправлять без записи на диск (для read-only/эфемерных дисков)
+PDF_IN_MEMORY = os.environ.get("PDF_IN_MEMORY", "false").lower() == "true"
+
+# Каналы LISTEN/NOTIFY
+JOBS_CHANNEL = 'generation_jobs'
+PROGRESS_CHANNEL = 'generation_progress'
+DONE_CHANNEL = 'generation_done'
+
+# Задание, которое выполняется дольше, считается брошенным (воркер упал)
+JOB_TIMEOUT_MINUTES = int(os.environ.get("GENERATION_JOB_TIMEOUT_MINUTES", "30"))
+JOB_MAX_ATTEMPTS = 3
+
+
+def is_overloaded_error(error):
+    """Ошибка 529 - API перегружен (пользователю выдаётся бесплатный кредит)"""
+    return "529" in error or "overloaded" in error.lower()
+
+
+def order_plan(user_data):
+    """План заказа по выбранной версии: 'premium' или 'standard'"""
+    return 'premium' if user_data.get('version') == 'premium' else 'standard'
+
+
+def job_params(user_data, user_id):
+    """Параметры книги из user_data разговора"""
+    return {
+        'user_id': user_id,
+        'name': user_data['name'],
+        'age': user_data['age'],
+        'gender': user_data['gender'],
+        'theme': user_data['theme'],
+        'plan': order_plan(user_data),
+        'photo_path': user_data.get('photo_path'),
+    }
+
+
+def order_params(order):
+    """Параметры книги из заказа в БД (когда user_data разговора недоступны)"""
+    return {
+        'user_id': order['user_id'],
+        'name': order['child_name'],
+        'age': order['child_age'],
+        'gender': order['gender'],
+        'theme': order['theme'],
+        'plan': order.get('plan') or 'standard',
+        'photo_path': order.get('photo_path'),
+    }
+
+
+def upload_photo(artifact_store, photo_path):
+    """Фото ребёнка -> хранилище артефактов (для воркера на другой машине). Возвращает хэш"""
+    with open(photo_path, 'rb') as f:
+        return artifact_store.put(f.read(), 'image/jpeg')
+
+
+def download_photo(artifact_store, photo_hash, user_id):
+    """Фото ребёнка из хранилища -> temp_photos/. Возвращает путь"""
+    photo_path = new_photo_path(user_id)
+    with open(photo_path, 'wb') as f:
+        f.write(artifact_store.get(photo_hash))
+    return photo_path
+
+
+async def build_book(adb, order_id, params, on_scene_ready=None, pdf_buffer=None):
+    """
+    Собирает книгу заказа и записывает результат в заказ
+
+    Фото ребёнка удаляется в любом случае, недособранная книга - при ошибке.
+    При ошибке 529 пользователю начисляется бесплатный кредит.
+
+    Returns:
+        {'ok': True, 'pdf_path'} или {'ok': False, 'error', 'overloaded'}
+    """
+    photo_path = params.get('photo_path')
+    logger.info(f"🎨 Генерация заказа #{order_id}: plan={params['plan']}, photo={'есть' if photo_path else 'нет'}")
+
+    # Своя папка на каждую попытку заказа - параллельные книги не мешают друг другу
+    attempt = await adb.start_order_attempt(order_id) if order_id else 1
+    book_dir = workspace_path(order_id, attempt)
+
+    try:
+        # ГЕНЕРИРУЕМ КНИГУ (в отдельном потоке - event loop продолжает работать)
+        pdf_path = await asyncio.to_thread(
+            create_storybook_v2,
+            child_name=params['name'],
+            child_age=params['age'],
+            gender=params['gender'],
+            theme_id=params['theme'],
+            photo_path=photo_path,
+            plan=params['plan'],  # ✅ ПЕРЕДАЁМ ПЛАН ДЛЯ PREMIUM ПЕРСОНАЖА
+            on_scene_ready=on_scene_ready,
+            pdf_buffer=pdf_buffer,
+            workspace_dir=book_dir
+        )
+
+        # Обновляем заказ в БД
+        if order_id:
+            await adb.update_order_status(order_id, 'completed', pdf_path)
+
+        remove_photo(photo_path)
+        return {'ok': True, 'pdf_path': pdf_path}
+
+    except Exception as e:
+        logger.error(f"❌ Ошибка генерации заказа #{order_id}: {e}", exc_info=True)
+
+        # Недособранная книга и фото больше не нужны (при повторе будет новая попытка)
+        discard_workspace(book_dir)
+        remove_photo(photo_path)
+
+        error = str(e)
+        overloaded = is_overloaded_error(error)
+
+        # ✅ ВАЖНО: Помечаем заказ как неудачный
+        if order_id:
+            await adb.update_order_status(order_id, 'failed')
+            logger.info(f"❌ Заказ #{order_id} помечен как failed")
+
+        # ✅ Если ошибка 529 - автоматически даём бесплатный кредит
+        if overloaded:
+            await adb.add_credits(params['user_id'])
+            logger.info(f"🎁 Автоматически выдан бесплатный кредит пользователю {params['user_id']} из-за перегрузки")
+
+        return {'ok': False, 'error': error, 'overloaded': overloaded}
+
+
+async def publish_order_book(adb, artifact_store, order_id, pdf_path, pdf_buffer=None):
+    """
+    Загружает готовую книгу в хранилище артефактов и записывает файлы в заказ
+
+    Книга уже готова и заказ completed - ошибка хранилища только логируется
+    (книга остаётся на диске, её можно отправить и без хранилища).
+
+    Returns:
+        True, если книга загружена
+    """
+    if artifact_store is None or not pdf_path:
+        return False
+    try:
+        artifacts = await asyncio.to_thread(publish_book, artifact_store, os.path.dirname(pdf_path), pdf_buffer)
+        if order_id and artifacts:
+            await adb.save_order_artifacts(order_id, artifacts)
+        return True
+    except Exception as e:
+        logger.error(f"☁️ Книга заказа #{order_id} не загружена в хранилище: {e}", exc_info=True)
+        return False
+
+
+async def load_order_pdf(adb, artifact_store, order_id, pdf_path):
+    """
+    PDF готового заказа в памяти, если его нет на локальном диске
+
+    (книгу собрал воркер на другой машине или PDF собирался в памяти)
+
+    Returns:
+        io.BytesIO или None, если PDF есть на диске или его нет в хранилище
+    """
+    if artifact_store is None or not order_id or (pdf_path and os.path.exists(pdf_path)):
+        return None
+    artifacts = await adb.get_order_artifacts(order_id)
+    info = artifacts.get(os.path.basename(pdf_path or ''))
+    if not info:
+        return None
+    data = await asyncio.to_thread(artifact_store.get, info['hash'])
+    return io.BytesIO(data)
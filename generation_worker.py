@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Воркер генерации книг (GENERATION_MODE=queue)
+
+Берёт задания из generation_jobs, собирает книги и записывает результат.
+С Telegram не работает: прогресс и готовность уходят боту через
+NOTIFY generation_progress / generation_done, а PDF - через хранилище артефактов.
+
+Воркеров можно запустить сколько угодно - одно задание достанется
+только одному (FOR UPDATE SKIP LOCKED). Новые задания будят воркер через
+LISTEN generation_jobs; раз в WORKER_POLL_INTERVAL секунд очередь проверяется
+и без уведомления (на случай потерянного NOTIFY).
+Раз в JANITOR_INTERVAL секунд воркер убирает свой диск (janitor.py).
+
+Запуск:
+    python generation_worker.py
+"""
+
+import asyncio
+import io
+import json
+import logging
+import os
+import signal
+import socket
+import time
+
+from artifact_store import get_artifact_store
+from async_database import adb
+from janitor import janitor_pass, JANITOR_INTERVAL
+from generation_jobs import (
+    PDF_IN_MEMORY, JOBS_CHANNEL, PROGRESS_CHANNEL, DONE_CHANNEL,
+    JOB_TIMEOUT_MINUTES, JOB_MAX_ATTEMPTS, build_book, publish_order_book, download_photo
+)
+
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+WORKER_POLL_INTERVAL = int(os.environ.get("WORKER_POLL_INTERVAL", "30"))
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+async def process_job(job, artifact_store):
+    """Собирает книгу одного задания и сообщает результат боту"""
+    job_id, order_id = job['job_id'], job['order_id']
+    params = dict(job['params'])
+    logger.info(f"🏭 Задание #{job_id}: заказ #{order_id} (попытка {job['attempts']})")
+
+    loop = asyncio.get_running_loop()
+
+    def on_scene_ready(done, total, image_path):
+        # Из потока генерации: бот сам поправит статусное сообщение
+        if job['status_message_id']:
+            payload = json.dumps({'chat_id': job['chat_id'], 'message_id': job['status_message_id'],
+                                  'done': done, 'total': total})
+            asyncio.run_coroutine_threadsafe(adb.notify(PROGRESS_CHANNEL, payload), loop)
+
+    try:
+        if params.get('photo_hash'):
+            params['photo_path'] = await asyncio.to_thread(
+                download_photo, artifact_store, params['photo_hash'], params['user_id'])
+        pdf_buffer = io.BytesIO() if PDF_IN_MEMORY else None
+        result = await build_book(adb, order_id, params,
+                                  on_scene_ready=on_scene_ready, pdf_buffer=pdf_buffer)
+        if result['ok']:
+            # Бот может работать на другой машине - PDF он возьмёт из хранилища
+            await publish_order_book(adb, artifact_store, order_id, result['pdf_path'], pdf_buffer)
+    except Exception as e:
+        logger.error(f"❌ Задание #{job_id} не выполнено: {e}", exc_info=True)
+        result = {'ok': False, 'error': str(e), 'overloaded': False}
+
+    if result['ok'] and order_id:
+        await adb.update_daily_stats(completed_orders=1)
+
+    await adb.finish_generation_job(job_id, result, DONE_CHANNEL)
+    logger.info(f"{'✅' if result['ok'] else '❌'} Задание #{job_id} завершено")
+
+
+async def main():
+    artifact_store = get_artifact_store()
+    if artifact_store is None:
+        logger.warning("⚠️ ARTIFACT_STORE не задан - фото и книги передаются через общий диск с ботом")
+    stopping = asyncio.Event()
+    wake_up = asyncio.Event()
+
+    # Останавливаемся мягко: текущая книга дособирается
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stopping.set)
+
+    listener = await adb.listen({JOBS_CHANNEL: lambda payload: wake_up.set()})
+    logger.info(f"🏭 Воркер генерации {WORKER_ID} запущен")
+    next_janitor = 0
+
+    try:
+        while not stopping.is_set():
+            # Сбрасываем до запроса - NOTIFY, пришедший во время запроса, не потеряется
+            wake_up.clear()
+
+            # 🧹 Папки книг и скачанные фото на диске воркера (между книгами - не мешает сборке)
+            if time.monotonic() >= next_janitor:
+                next_janitor = time.monotonic() + JANITOR_INTERVAL
+                try:
+                    await janitor_pass()
+                except Exception as e:
+                    logger.error(f"🧹 Уборка не удалась: {e}")
+
+            for job_id in await adb.fail_stale_generation_jobs(JOB_TIMEOUT_MINUTES, JOB_MAX_ATTEMPTS, DONE_CHANNEL):
+                logger.warning(f"⚠️ Задание #{job_id} брошено {JOB_MAX_ATTEMPTS} раз - помечено failed")
+
+            job = await adb.claim_generation_job(WORKER_ID, JOB_TIMEOUT_MINUTES, JOB_MAX_ATTEMPTS)
+            if job:
+                await process_job(job, artifact_store)
+                continue
+
+            # Заданий нет - ждём NOTIFY, остановки или таймаута
+            waiters = [asyncio.create_task(wake_up.wait()), asyncio.create_task(stopping.wait())]
+            await asyncio.wait(waiters, timeout=WORKER_POLL_INTERVAL, return_when=asyncio.FIRST_COMPLETED)
+            for waiter in waiters:
+                waiter.cancel()
+    finally:
+        await listener.close()
+        await adb.close()
+        logger.info(f"🔌 Воркер генерации {WORKER_ID} остановлен")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
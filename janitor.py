@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Уборка диска: квота на папки книг и удаление забытых фото
+
+- Папки книг (storybook_*, в том числе storybook_order_* из workspace.py и
+  брошенные .partial) удаляются по LRU - давно не тронутые первыми, -
+  пока общий размер не влезет в DISK_QUOTA_MB
+- PDF недавних заказов и заказов, которые ещё не отправлены в Telegram,
+  остаются: у таких папок удаляются только картинки и варианты
+  (их можно восстановить из хранилища артефактов)
+- Фото из temp_photos/ старше TEMP_PHOTO_MAX_AGE_HOURS удаляются
+
+Запускается по job_queue бота (см. janitor_job) и в цикле generation_worker.py
+(у воркера на другой машине свой диск)
+"""
+
+import asyncio
+import glob
+import logging
+import os
+import shutil
+import time
+
+logger = logging.getLogger(__name__)
+
+DISK_QUOTA_MB = float(os.environ.get("DISK_QUOTA_MB", "2048"))
+KEEP_RECENT_DAYS = int(os.environ.get("KEEP_RECENT_DAYS", "7"))
+TEMP_PHOTO_MAX_AGE_HOURS = int(os.environ.get("TEMP_PHOTO_MAX_AGE_HOURS", "24"))
+JANITOR_INTERVAL = int(os.environ.get("JANITOR_INTERVAL", "3600"))
+
+BOOKS_PATTERN = "storybook_*"
+TEMP_PHOTOS_DIR = "temp_photos"
+
+# Папки, в которые писали недавно, считаем занятыми генерацией
+ACTIVE_GRACE_SECONDS = 2 * 3600
+
+
+def folder_usage(path):
+    """(размер в байтах, время последнего изменения файлов) папки"""
+    total, last_used = 0, None
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                stat = os.stat(os.path.join(root, name))
+            except FileNotFoundError:
+                continue
+            total += stat.st_size
+            last_used = max(last_used or 0, stat.st_mtime)
+    if last_used is None:
+        last_used = os.path.getmtime(path)  # Пустая папка
+    return total, last_used
+
+
+def remove_orphan_photos(max_age_hours=TEMP_PHOTO_MAX_AGE_HOURS, now=None):
+    """Удаляет фото детей, которые не удалились после генерации. Возвращает (шт, байт)"""
+    now = now or time.time()
+    removed, reclaimed = 0, 0
+    for path in glob.glob(os.path.join(TEMP_PHOTOS_DIR, "*")):
+        try:
+            stat = os.stat(path)
+            if os.path.isfile(path) and now - stat.st_mtime > max_age_hours * 3600:
+                os.remove(path)
+                removed += 1
+                reclaimed += stat.st_size
+        except FileNotFoundError:
+            continue
+    return removed, reclaimed
+
+
+def trim_folder(path, keep):
+    """Удаляет из папки всё, кроме файлов из keep. Возвращает освобождённые байты"""
+    reclaimed = 0
+    for root, dirs, files in os.walk(path, topdown=False):
+        for name in files:
+            file_path = os.path.join(root, name)
+            if os.path.abspath(file_path) in keep:
+                continue
+            try:
+                reclaimed += os.path.getsize(file_path)
+                os.remove(file_path)
+            except FileNotFoundError:
+                continue
+        for name in dirs:
+            try:
+                os.rmdir(os.path.join(root, name))
+            except OSError:
+                pass  # В папке остался сохраняемый PDF
+    return reclaimed
+
+
+def enforce_quota(quota_bytes, protected_pdfs, now=None):
+    """
+    Освобождает место по LRU, пока папки книг не влезут в квоту
+
+    Args:
+        quota_bytes: сколько места могут занимать папки книг
+        protected_pdfs: абсолютные пути PDF, которые нельзя удалять
+
+    Returns:
+        (удалено папок, освобождено байт, занято после уборки)
+    """
+    now = now or time.time()
+    folders = []
+    for path in glob.glob(BOOKS_PATTERN):
+        if os.path.isdir(path):
+            size, last_used = folder_usage(path)
+            folders.append((last_used, size, path))
+
+    used = sum(size for _, size, _ in folders)
+    removed, reclaimed = 0, 0
+
+    for last_used, size, path in sorted(folders):
+        if used <= quota_bytes:
+            break
+        if now - last_used < ACTIVE_GRACE_SECONDS:
+            continue  # Возможно, книга ещё собирается
+
+        folder = os.path.abspath(path)
+        keep = {pdf for pdf in protected_pdfs if pdf.startswith(folder + os.sep)}
+        if keep:
+            freed = trim_folder(path, keep)
+        else:
+            shutil.rmtree(path, ignore_errors=True)
+            freed = size
+            removed += 1
+        used -= freed
+        reclaimed += freed
+
+    return removed, reclaimed, used
+
+
+def run_janitor(db, quota_mb=DISK_QUOTA_MB):
+    """
+    Одна уборка: забытые фото + квота на папки книг
+
+    Returns:
+        {'photos_removed', 'folders_removed', 'reclaimed_bytes', 'used_bytes'}
+    """
+    photos_removed, photos_reclaimed = remove_orphan_photos()
+
+    try:
+        protected = {os.path.abspath(path) for path in db.get_protected_pdf_paths(KEEP_RECENT_DAYS)}
+    except Exception as e:
+        # Без БД не знаем, какие PDF нужны - книги не трогаем
+        logger.error(f"🧹 Уборка папок книг пропущена - нет списка заказов: {e}")
+        return {'photos_removed': photos_removed, 'folders_removed': 0,
+                'reclaimed_bytes': photos_reclaimed, 'used_bytes': None}
+
+    folders_removed, folders_reclaimed, used = enforce_quota(int(quota_mb * 1024 * 1024), protected)
+    return {
+        'photos_removed': photos_removed,
+        'folders_removed': folders_removed,
+        'reclaimed_bytes': photos_reclaimed + folders_reclaimed,
+        'used_bytes': used,
+    }
+
+
+async def janitor_job(context):
+    """Периодическая уборка диска (callback для job_queue)"""
+    await janitor_pass()
+
+
+async def janitor_pass():
+    """Уборка в потоке (event loop не блокируется) с отчётом в лог"""
+    from database import db
+
+    report = await asyncio.to_thread(run_janitor, db)
+    used = report['used_bytes']
+    logger.info(
+        f"🧹 Уборка: освобождено {report['reclaimed_bytes'] / 1024 / 1024:.1f} MB, "
+        f"папок удалено {report['folders_removed']}, фото удалено {report['photos_removed']}"
+        + (f", занято {used / 1024 / 1024:.1f} MB из {DISK_QUOTA_MB:.0f} MB" if used is not None else "")
+    )
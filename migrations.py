@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Миграции схемы PostgreSQL
+
+Каждая миграция - номер, название и список SQL. Применённые номера
+записываются в schema_version, поэтому при старте бота выполняются
+только новые миграции (обычно - ни одной).
+
+Все новые миграции применяются в одной транзакции под advisory lock,
+так что две реплики, стартующие одновременно, не применят их дважды.
+
+Новая миграция - новый элемент в конце MIGRATIONS; старые не меняются.
+
+Запуск вручную:
+    python migrations.py
+"""
+
+# Ключ pg_advisory_xact_lock для миграций (любое постоянное число)
+MIGRATION_LOCK_ID = 7_240_001
+
+MIGRATIONS = [
+    (1, "Базовые таблицы", [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            username VARCHAR(255),
+            first_name VARCHAR(255),
+            last_name VARCHAR(255),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS orders (
+            order_id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            theme VARCHAR(100) NOT NULL,
+            child_name VARCHAR(100) NOT NULL,
+            child_age INTEGER NOT NULL,
+            gender VARCHAR(10) NOT NULL,
+            photo_description TEXT,
+            status VARCHAR(50) DEFAULT 'pending',
+            pdf_path TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            completed_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS payments (
+            payment_id VARCHAR(255) PRIMARY KEY,
+            order_id INTEGER NOT NULL,
+            user_id BIGINT NOT NULL,
+            amount INTEGER NOT NULL,
+            status VARCHAR(50) DEFAULT 'pending',
+            payment_url TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            paid_at TIMESTAMP,
+            FOREIGN KEY (order_id) REFERENCES orders(order_id),
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS stats (
+            date DATE PRIMARY KEY,
+            new_users INTEGER DEFAULT 0,
+            total_orders INTEGER DEFAULT 0,
+            completed_orders INTEGER DEFAULT 0,
+            revenue INTEGER DEFAULT 0
+        )
+        ''',
+    ]),
+
+    (2, "file_id PDF, попытки генерации, артефакты, статичные картинки", [
+        'ALTER TABLE orders ADD COLUMN IF NOT EXISTS pdf_file_id TEXT',
+        'ALTER TABLE orders ADD COLUMN IF NOT EXISTS attempts INTEGER DEFAULT 0',
+        '''
+        CREATE TABLE IF NOT EXISTS order_artifacts (
+            order_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            artifact_hash VARCHAR(64) NOT NULL,
+            size BIGINT NOT NULL,
+            content_type VARCHAR(100),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (order_id, name),
+            FOREIGN KEY (order_id) REFERENCES orders(order_id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS static_assets (
+            file_hash VARCHAR(64) PRIMARY KEY,
+            path TEXT,
+            file_id TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+
+    (3, "Индексы для заказов и платежей", [
+        # get_user_orders: WHERE user_id ORDER BY created_at DESC
+        'CREATE INDEX IF NOT EXISTS idx_orders_user_created ON orders (user_id, created_at)',
+        # Подсчёты по статусам в /stats и /analytics, список failed заказов
+        'CREATE INDEX IF NOT EXISTS idx_orders_status ON orders (status)',
+        'CREATE INDEX IF NOT EXISTS idx_payments_order ON payments (order_id)',
+        'CREATE INDEX IF NOT EXISTS idx_payments_status ON payments (status)',
+    ]),
+
+    (4, "План заказа и сводная статистика stats_rollup", [
+        "ALTER TABLE orders ADD COLUMN IF NOT EXISTS plan VARCHAR(20) DEFAULT 'standard'",
+        # Заказы и выручка по (день заказа, тема, план, текущий статус);
+        # Database меняет строки вместе со статусами заказов и платежей
+        '''
+        CREATE TABLE IF NOT EXISTS stats_rollup (
+            day DATE NOT NULL,
+            theme VARCHAR(100) NOT NULL,
+            plan VARCHAR(20) NOT NULL,
+            status VARCHAR(50) NOT NULL,
+            orders INTEGER NOT NULL DEFAULT 0,
+            revenue BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, theme, plan, status)
+        )
+        ''',
+        # Заполняем по уже существующим заказам
+        '''
+        INSERT INTO stats_rollup (day, theme, plan, status, orders, revenue)
+        SELECT
+            COALESCE(o.created_at, CURRENT_TIMESTAMP)::date,
+            o.theme,
+            COALESCE(o.plan, 'standard'),
+            COALESCE(o.status, 'pending'),
+            COUNT(*),
+            COALESCE(SUM(p.revenue), 0)
+        FROM orders o
+        LEFT JOIN (
+            SELECT order_id, SUM(amount) AS revenue
+            FROM payments
+            WHERE status = 'succeeded'
+            GROUP BY order_id
+        ) p ON p.order_id = o.order_id
+        GROUP BY 1, 2, 3, 4
+        ON CONFLICT (day, theme, plan, status) DO NOTHING
+        ''',
+        # Новые пользователи по дням - отчёты берут их из stats, а не COUNT(*) по users
+        '''
+        INSERT INTO stats (date, new_users)
+        SELECT COALESCE(created_at, CURRENT_TIMESTAMP)::date, COUNT(*)
+        FROM users
+        GROUP BY 1
+        ON CONFLICT (date) DO UPDATE SET new_users = EXCLUDED.new_users
+        ''',
+    ]),
+
+    (5, "Журнал событий воронки analytics_events", [
+        '''
+        CREATE TABLE IF NOT EXISTS analytics_events (
+            id BIGSERIAL PRIMARY KEY,
+            event VARCHAR(50) NOT NULL,
+            user_id BIGINT,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        # Воронка за последние N дней: WHERE created_at > ... GROUP BY event
+        'CREATE INDEX IF NOT EXISTS idx_analytics_events_created ON analytics_events (created_at, event)',
+    ]),
+
+    (6, "Состояние бота: user_data, chat_data, bot_data, разговоры", [
+        '''
+        CREATE TABLE IF NOT EXISTS bot_persistence (
+            kind VARCHAR(100) NOT NULL,
+            key TEXT NOT NULL,
+            data BYTEA NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (kind, key)
+        )
+        ''',
+    ]),
+
+    (7, "Бесплатные кредиты credits", [
+        # Без FOREIGN KEY на users: /gift может подарить книгу тому, кто ещё не запускал бота
+        '''
+        CREATE TABLE IF NOT EXISTS credits (
+            user_id BIGINT PRIMARY KEY,
+            balance INTEGER NOT NULL DEFAULT 0 CHECK (balance >= 0),
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+
+    (8, "Очередь генерации generation_jobs", [
+        # queued -> running (воркер) -> done/failed; delivered_at - бот отправил результат
+        '''
+        CREATE TABLE IF NOT EXISTS generation_jobs (
+            job_id BIGSERIAL PRIMARY KEY,
+            order_id INTEGER UNIQUE,
+            chat_id BIGINT NOT NULL,
+            status_message_id BIGINT,
+            params JSONB NOT NULL,
+            status VARCHAR(20) NOT NULL DEFAULT 'queued',
+            worker TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            pdf_path TEXT,
+            error TEXT,
+            overloaded BOOLEAN NOT NULL DEFAULT FALSE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            delivered_at TIMESTAMP,
+            FOREIGN KEY (order_id) REFERENCES orders(order_id)
+        )
+        ''',
+        # Воркеры ищут следующее задание, бот - неотправленные результаты
+        'CREATE INDEX IF NOT EXISTS idx_generation_jobs_status ON generation_jobs (status, job_id)',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_generation_jobs_undelivered ON generation_jobs (job_id)
+        WHERE delivered_at IS NULL AND status IN ('done', 'failed')
+        ''',
+    ]),
+
+    (9, "Фото ребёнка в заказе (генерация по уведомлению об оплате)", [
+        'ALTER TABLE orders ADD COLUMN IF NOT EXISTS photo_path TEXT',
+    ]),
+]
+
+
+def apply_migrations(db):
+    """
+    Применяет новые миграции
+
+    Returns:
+        список применённых номеров (пустой, если схема актуальна)
+    """
+    applied = []
+    with db.transaction() as cursor:
+        cursor.execute('SELECT pg_advisory_xact_lock(%s)', (MIGRATION_LOCK_ID,))
+
+        cursor.execute("SELECT to_regclass('schema_version')")
+        if cursor.fetchone()[0] is None:
+            cursor.execute('''
+                CREATE TABLE schema_version (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+        cursor.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+        current = cursor.fetchone()[0]
+
+        for version, name, statements in MIGRATIONS:
+            if version <= current:
+                continue
+            for statement in statements:
+                cursor.execute(statement)
+            cursor.execute('INSERT INTO schema_version (version, name) VALUES (%s, %s)', (version, name))
+            applied.append(version)
+            print(f"🗄️ Миграция {version}: {name}")
+
+    return applied
+
+
+def current_version(db):
+    """Номер последней применённой миграции (0 - ни одной)"""
+    with db.transaction() as cursor:
+        cursor.execute("SELECT to_regclass('schema_version')")
+        if cursor.fetchone()[0] is None:
+            return 0
+        cursor.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+        return cursor.fetchone()[0]
+
+
+if __name__ == "__main__":
+    from database import db, DATABASE_URL
+
+    if not DATABASE_URL:
+        print("⚠️ DATABASE_URL не установлен!")
+    else:
+        # Database() уже применил миграции при импорте
+        print(f"✅ Версия схемы: {current_version(db)} (последняя миграция: {MIGRATIONS[-1][0]})")
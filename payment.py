@@ -3,16 +3,32 @@
 """
 Модуль для работы с YooKassa
 Создание платежей, проверка статуса
+
+create_payment/check_payment - синхронный SDK yookassa (для скриптов и теста ниже).
+Бот работает через AsyncYooKassaClient (yookassa_client): запросы не блокируют
+event loop, HTTPS-подключения к API переиспользуются, при сетевой ошибке или
+5xx запрос повторяется с тем же Idempotence-Key (повтор не создаст второй платёж).
 """
 
+import asyncio
 import os
 from yookassa import Configuration, Payment
 import uuid
 
+import httpx
+
 # Настройки YooKassa
 SHOP_ID = os.environ.get("YOOKASSA_SHOP_ID", "")
 SECRET_KEY = os.environ.get("YOOKASSA_SECRET_KEY", "")
 
+YOOKASSA_API_URL = "https://api.yookassa.ru/v3"
+YOOKASSA_TIMEOUT = float(os.environ.get("YOOKASSA_TIMEOUT", "10"))
+YOOKASSA_RETRIES = int(os.environ.get("YOOKASSA_RETRIES", "3"))
+YOOKASSA_MAX_CONNECTIONS = int(os.environ.get("YOOKASSA_MAX_CONNECTIONS", "10"))
+
+# Дольше не ждём, даже если YooKassa просит (retry_after)
+YOOKASSA_MAX_RETRY_DELAY = 5.0
+
 # Настраиваем YooKassa
 if SHOP_ID and SECRET_KEY:
     Configuration.account_id = SHOP_ID
@@ -22,29 +38,9 @@ else:
     print("⚠️ YooKassa НЕ настроена (нет ключей)")
 
 
-def create_payment(amount: int, description: str, return_url: str = None, customer_email: str = None) -> dict:
-    """
-    Создать платеж
-    
-    Args:
-        amount: Сумма в рублях
-        description: Описание платежа
-        return_url: URL для возврата после оплаты
-        customer_email: Email покупателя (для чека)
+def payment_request(amount: int, description: str, return_url: str = None, customer_email: str = None) -> dict:
+    """Тело запроса на создание платежа (общее для SDK и AsyncYooKassaClient)"""
     
-    Returns:
-        {
-            'id': 'payment_id',
-            'status': 'pending',
-            'confirmation_url': 'https://...',
-            'paid': False
-        }
-    """
-    
-    # Генерируем уникальный ключ идемпотентности
-    idempotence_key = str(uuid.uuid4())
-    
-    # Подготавливаем данные платежа
     payment_data = {
         "amount": {
             "value": str(amount),
@@ -82,6 +78,32 @@ def create_payment(amount: int, description: str, return_url: str = None, custom
             ]
         }
     
+    return payment_data
+
+
+def create_payment(amount: int, description: str, return_url: str = None, customer_email: str = None) -> dict:
+    """
+    Создать платеж
+    
+    Args:
+        amount: Сумма в рублях
+        description: Описание платежа
+        return_url: URL для возврата после оплаты
+        customer_email: Email покупателя (для чека)
+    
+    Returns:
+        {
+            'id': 'payment_id',
+            'status': 'pending',
+            'confirmation_url': 'https://...',
+            'paid': False
+        }
+    """
+    
+    # Генерируем уникальный ключ идемпотентности
+    idempotence_key = str(uuid.uuid4())
+    payment_data = payment_request(amount, description, return_url, customer_email)
+    
     try:
         # Создаём платеж
         payment = Payment.create(payment_data, idempotence_key)
@@ -148,6 +170,126 @@ def is_payment_successful(payment_id: str) -> bool:
     return False
 
 
+class YooKassaRetry(Exception):
+    """Ответ, после которого запрос стоит повторить (сеть, 5xx, 429, 202)"""
+
+    def __init__(self, message, delay=None):
+        super().__init__(message)
+        self.delay = delay
+
+
+class AsyncYooKassaClient:
+    """
+    Асинхронный клиент API YooKassa поверх httpx.AsyncClient
+
+    create_payment/check_payment/is_payment_successful возвращают то же,
+    что одноимённые функции модуля (None при ошибке).
+    """
+
+    def __init__(self, shop_id=SHOP_ID, secret_key=SECRET_KEY, timeout=YOOKASSA_TIMEOUT, retries=YOOKASSA_RETRIES):
+        self.shop_id = shop_id
+        self.secret_key = secret_key
+        self.timeout = timeout
+        self.retries = retries
+        self._client = None
+
+    def _http(self):
+        # Создаём при первом запросе - уже внутри event loop бота
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=YOOKASSA_API_URL,
+                auth=(self.shop_id, self.secret_key),
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=YOOKASSA_MAX_CONNECTIONS,
+                                    max_keepalive_connections=YOOKASSA_MAX_CONNECTIONS),
+            )
+        return self._client
+
+    async def _send(self, method, path, body=None, idempotence_key=None):
+        headers = {'Idempotence-Key': idempotence_key} if idempotence_key else {}
+        try:
+            response = await self._http().request(method, path, json=body, headers=headers)
+        except httpx.TransportError as e:
+            raise YooKassaRetry(f"{type(e).__name__}: {e}")
+
+        if response.status_code == 202:
+            # YooKassa ещё обрабатывает запрос - просит повторить через retry_after мс
+            retry_after = response.json().get('retry_after', 1000) / 1000
+            raise YooKassaRetry("202 processing", delay=retry_after)
+        if response.status_code == 429 or response.status_code >= 500:
+            raise YooKassaRetry(f"HTTP {response.status_code}")
+        response.raise_for_status()
+        return response.json()
+
+    async def _request(self, method, path, body=None, idempotence_key=None):
+        """Запрос к API с повторами (тот же Idempotence-Key - тот же результат)"""
+        for attempt in range(self.retries):
+            try:
+                return await self._send(method, path, body, idempotence_key)
+            except YooKassaRetry as e:
+                if attempt == self.retries - 1:
+                    raise
+                delay = e.delay if e.delay is not None else 0.5 * 2 ** attempt
+                print(f"⚠️ YooKassa {method} {path}: {e}, повтор через {min(delay, YOOKASSA_MAX_RETRY_DELAY):.1f} сек")
+                await asyncio.sleep(min(delay, YOOKASSA_MAX_RETRY_DELAY))
+
+    async def create_payment(self, amount: int, description: str, return_url: str = None,
+                             customer_email: str = None) -> dict:
+        """Создать платеж (см. create_payment)"""
+        idempotence_key = str(uuid.uuid4())
+        payment_data = payment_request(amount, description, return_url, customer_email)
+
+        try:
+            payment = await self._request('POST', '/payments', payment_data, idempotence_key)
+
+            print(f"✅ Создан платеж {payment['id']} на {amount}₽")
+
+            return {
+                'id': payment['id'],
+                'status': payment['status'],
+                'confirmation_url': payment['confirmation']['confirmation_url'],
+                'paid': payment['paid']
+            }
+
+        except Exception as e:
+            print(f"❌ Ошибка создания платежа: {e}")
+            return None
+
+    async def check_payment(self, payment_id: str) -> dict:
+        """Проверить статус платежа (см. check_payment)"""
+        try:
+            payment = await self._request('GET', f'/payments/{payment_id}')
+
+            return {
+                'id': payment['id'],
+                'status': payment['status'],
+                'paid': payment['paid']
+            }
+
+        except Exception as e:
+            print(f"❌ Ошибка проверки платежа: {e}")
+            return None
+
+    async def is_payment_successful(self, payment_id: str) -> bool:
+        """Проверить успешно ли оплачен платёж"""
+        payment = await self.check_payment(payment_id)
+
+        if payment:
+            return payment['status'] == 'succeeded' and payment['paid']
+
+        return False
+
+    async def close(self):
+        """Закрыть HTTP-подключения (при остановке бота)"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+# Клиент для бота: одно подключение на процесс
+yookassa_client = AsyncYooKassaClient()
+
+
 # Тестирование
 if __name__ == "__main__":
     print("🧪 Тестирование YooKassa модуля...")
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Автопроверка оплаты - одна задача job_queue на все неоплаченные платежи
+
+Раньше на каждый платёж заводилась своя задача, которая спрашивала
+YooKassa каждые 10 секунд - сотня открытых оплат давала сотню запросов
+каждые 10 секунд. Теперь раз в PAYMENT_POLL_TICK секунд poller берёт из
+таблицы payments все платежи в статусе pending и проверяет только те,
+чья очередь подошла:
+- первая проверка через min_delay после создания платежа, дальше интервал
+  удваивается до PAYMENT_POLL_MAX_DELAY (свежие оплаты - быстро, забытые - редко)
+- за один проход - не больше PAYMENT_POLL_BATCH проверок,
+  одновременно - не больше PAYMENT_POLL_CONCURRENCY запросов к YooKassa
+- через PAYMENT_POLL_DEADLINE_MINUTES платёж помечается expired и больше
+  не проверяется (если его всё-таки оплатят - сработает уведомление или /check)
+"""
+
+import asyncio
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+PAYMENT_POLL_TICK = int(os.environ.get("PAYMENT_POLL_TICK", "5"))
+PAYMENT_POLL_MIN_DELAY = int(os.environ.get("PAYMENT_POLL_MIN_DELAY", "5"))
+# Первая проверка, когда работают уведомления YooKassa (poller - только подстраховка)
+PAYMENT_POLL_NOTIFIED_DELAY = int(os.environ.get("PAYMENT_POLL_NOTIFIED_DELAY", "60"))
+PAYMENT_POLL_MAX_DELAY = int(os.environ.get("PAYMENT_POLL_MAX_DELAY", "300"))
+PAYMENT_POLL_DEADLINE_MINUTES = int(os.environ.get("PAYMENT_POLL_DEADLINE_MINUTES", "60"))
+PAYMENT_POLL_CONCURRENCY = int(os.environ.get("PAYMENT_POLL_CONCURRENCY", "5"))
+PAYMENT_POLL_BATCH = int(os.environ.get("PAYMENT_POLL_BATCH", "50"))
+
+
+class PaymentPoller:
+    """Проверяет неоплаченные платежи пачками, с нарастающим интервалом"""
+
+    def __init__(self, adb, check_payment, min_delay=PAYMENT_POLL_MIN_DELAY):
+        self.adb = adb
+        self.check_payment = check_payment
+        self.min_delay = min_delay
+        self.on_paid = None
+        self.on_canceled = None
+        self._schedule = {}  # payment_id -> (когда проверять, текущий интервал)
+        self._poll_lock = asyncio.Lock()
+        self._background = set()  # обработка оплаченных/отменённых платежей
+
+    def _next_delay(self, delay):
+        return min(delay * 2, max(PAYMENT_POLL_MAX_DELAY, self.min_delay))
+
+    def _due_payments(self, rows, now):
+        """Платежи, которые пора проверить (самые просроченные - первыми)"""
+        pending = {row['payment_id']: row for row in rows}
+
+        # Оплаченные, отменённые и просроченные больше не отслеживаем
+        for payment_id in set(self._schedule) - set(pending):
+            del self._schedule[payment_id]
+
+        for payment_id, row in pending.items():
+            if payment_id not in self._schedule:
+                # Новый платёж (или бот перезапущен) - интервал по возрасту платежа
+                delay = self.min_delay
+                while delay * 2 <= row['age'] and delay < PAYMENT_POLL_MAX_DELAY:
+                    delay = self._next_delay(delay)
+                self._schedule[payment_id] = (now + max(0, self.min_delay - row['age']), delay)
+
+        due = sorted((check_at, payment_id) for payment_id, (check_at, _) in self._schedule.items() if check_at <= now)
+        return [payment_id for _, payment_id in due[:PAYMENT_POLL_BATCH]]
+
+    async def _check(self, bot, payment_id, semaphore):
+        async with semaphore:
+            payment = await self.check_payment(payment_id)
+
+        status = payment['status'] if payment else None
+        if status == 'succeeded' and payment['paid']:
+            self._handle(self.on_paid, bot, payment_id)
+            return
+        if status == 'canceled':
+            self._handle(self.on_canceled, bot, payment_id)
+            return
+
+        # Ещё не оплачен (или YooKassa не ответила) - следующая проверка позже
+        if payment_id in self._schedule:
+            _, delay = self._schedule[payment_id]
+            delay = self._next_delay(delay)
+            self._schedule[payment_id] = (time.monotonic() + delay, delay)
+
+    def _handle(self, callback, bot, payment_id):
+        """
+        Обработка платежа - в фоне: on_paid шлёт сообщения и пишет в БД,
+        а следующие проходы не должны ждать его (иначе остальные платежи не проверяются)
+        """
+        self._schedule.pop(payment_id, None)
+
+        async def run():
+            try:
+                await callback(bot, payment_id)
+            except Exception as e:
+                logger.error(f"Ошибка обработки платежа {payment_id}: {e}", exc_info=True)
+
+        task = asyncio.get_running_loop().create_task(run())
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def poll(self, bot):
+        """Один проход: просрочить старые платежи, проверить те, чья очередь подошла"""
+        if self._poll_lock.locked():
+            return  # предыдущий проход ещё идёт
+        async with self._poll_lock:
+            for payment_id in await self.adb.expire_pending_payments(PAYMENT_POLL_DEADLINE_MINUTES):
+                logger.info(f"⏱️ Платёж {payment_id} не оплачен за {PAYMENT_POLL_DEADLINE_MINUTES} мин - автопроверка остановлена")
+
+            rows = await self.adb.get_pending_payments()
+            due = self._due_payments(rows, time.monotonic())
+            if not due:
+                return
+
+            semaphore = asyncio.Semaphore(PAYMENT_POLL_CONCURRENCY)
+            await asyncio.gather(*(self._check(bot, payment_id, semaphore) for payment_id in due))
+
+    async def poll_job(self, context):
+        """Callback для job_queue"""
+        try:
+            await self.poll(context.bot)
+        except Exception as e:
+            logger.error(f"Ошибка автопроверки оплаты: {e}")
+
+    def start(self, job_queue, on_paid, on_canceled, interval=PAYMENT_POLL_TICK):
+        """
+        Запускает автопроверку через job_queue
+
+        Args:
+            on_paid: async callback(bot, payment_id) - платёж оплачен
+            on_canceled: async callback(bot, payment_id) - платёж отменён
+        """
+        self.on_paid = on_paid
+        self.on_canceled = on_canceled
+        job_queue.run_repeating(self.poll_job, interval=interval, first=interval, name='payment_poller')
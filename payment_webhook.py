@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Приём HTTP-уведомлений YooKassa (payment.succeeded / payment.canceled)
+
+Генерация запускается сразу после оплаты, без опроса YooKassa каждые 10 секунд.
+Уведомления YooKassa не подписаны, поэтому каждое проверяется дважды:
+1. запрос пришёл с IP из YOOKASSA_WEBHOOK_IPS (адреса YooKassa)
+2. статус платежа перезапрашивается в API YooKassa - верим только ему
+
+Настройки (переменные окружения):
+    YOOKASSA_WEBHOOK_ENABLED=true
+    YOOKASSA_WEBHOOK_PORT=8080          (по умолчанию - PORT; при USE_WEBHOOK=true нужен
+                                         другой порт - PORT занят Telegram webhook)
+    YOOKASSA_WEBHOOK_PATH=/yookassa/webhook
+    YOOKASSA_TRUST_PROXY=true           (IP брать из X-Forwarded-For - за прокси Railway)
+    YOOKASSA_WEBHOOK_ALLOW_LOCAL=true   (принимать с 127.0.0.1 - для send_test_notification)
+
+URL для личного кабинета YooKassa: https://<домен><YOOKASSA_WEBHOOK_PATH>
+
+Проверка локально (платёж должен существовать в тестовом магазине):
+    python payment_webhook.py <payment_id> [payment.succeeded|payment.canceled]
+"""
+
+import asyncio
+import ipaddress
+import json
+import logging
+import os
+import urllib.error
+import urllib.request
+
+logger = logging.getLogger(__name__)
+
+YOOKASSA_WEBHOOK_ENABLED = os.environ.get("YOOKASSA_WEBHOOK_ENABLED", "false").lower() == "true"
+YOOKASSA_WEBHOOK_PORT = int(os.environ.get("YOOKASSA_WEBHOOK_PORT", os.environ.get("PORT", "8080")))
+YOOKASSA_WEBHOOK_PATH = os.environ.get("YOOKASSA_WEBHOOK_PATH", "/yookassa/webhook")
+YOOKASSA_TRUST_PROXY = os.environ.get("YOOKASSA_TRUST_PROXY", "false").lower() == "true"
+YOOKASSA_WEBHOOK_ALLOW_LOCAL = os.environ.get("YOOKASSA_WEBHOOK_ALLOW_LOCAL", "false").lower() == "true"
+
+# Адреса, с которых YooKassa отправляет уведомления (документация YooKassa)
+YOOKASSA_WEBHOOK_IPS = os.environ.get(
+    "YOOKASSA_WEBHOOK_IPS",
+    "185.71.76.0/27,185.71.77.0/27,77.75.153.0/25,77.75.156.11,77.75.156.35,77.75.154.128/25,2a02:5180::/32"
+)
+
+LOCAL_NETWORKS = "127.0.0.1/32,::1/128"
+
+HANDLED_EVENTS = ('payment.succeeded', 'payment.canceled')
+
+
+def allowed_networks():
+    """Сети, с которых принимаются уведомления"""
+    networks = YOOKASSA_WEBHOOK_IPS
+    if YOOKASSA_WEBHOOK_ALLOW_LOCAL:
+        networks += "," + LOCAL_NETWORKS
+    return [ipaddress.ip_network(net.strip()) for net in networks.split(",") if net.strip()]
+
+
+def is_allowed_ip(ip, networks):
+    """IP входит в одну из сетей"""
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return False
+    return any(address in network for network in networks)
+
+
+def client_ip(request):
+    """IP отправителя (за прокси - первый адрес из X-Forwarded-For)"""
+    if YOOKASSA_TRUST_PROXY:
+        forwarded = request.headers.get('X-Forwarded-For', '')
+        if forwarded:
+            return forwarded.split(',')[0].strip()
+    return request.remote
+
+
+async def start_payment_webhook(on_payment, check_payment, port=YOOKASSA_WEBHOOK_PORT, path=YOOKASSA_WEBHOOK_PATH):
+    """
+    Запускает HTTP-сервер для уведомлений YooKassa в текущем event loop
+
+    Args:
+        on_payment: async callback(payment_id, status) - вызывается для проверенного платежа
+            (в фоне, после ответа YooKassa)
+        check_payment: async yookassa_client.check_payment - статус платежа из API YooKassa
+
+    Returns:
+        aiohttp AppRunner (остановить - await runner.cleanup())
+    """
+    from aiohttp import web
+
+    networks = allowed_networks()
+    background = set()
+
+    async def handle(request):
+        ip = client_ip(request)
+        if not is_allowed_ip(ip, networks):
+            logger.warning(f"🚫 Уведомление YooKassa с чужого IP {ip} отклонено")
+            return web.Response(status=403)
+
+        try:
+            notification = await request.json()
+            event = notification['event']
+            payment_id = notification['object']['id']
+        except (ValueError, KeyError, TypeError):
+            return web.Response(status=400)
+
+        if event not in HANDLED_EVENTS:
+            return web.Response(status=200)
+
+        # Не верим телу уведомления - спрашиваем статус у YooKassa
+        payment = await check_payment(payment_id)
+        if payment is None:
+            # YooKassa недоступна - ответим ошибкой, она повторит уведомление позже
+            return web.Response(status=503)
+
+        status = payment['status']
+        if status == 'succeeded' and not payment['paid']:
+            return web.Response(status=200)
+        logger.info(f"🔔 Уведомление YooKassa: {event}, платёж {payment_id} → {status}")
+
+        if status in ('succeeded', 'canceled'):
+            # Генерация долгая - отвечаем YooKassa сразу, обрабатываем в фоне
+            task = asyncio.create_task(on_payment(payment_id, status))
+            background.add(task)
+            task.add_done_callback(background.discard)
+        return web.Response(status=200)
+
+    app = web.Application()
+    app.router.add_post(path, handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host='0.0.0.0', port=port).start()
+    logger.info(f"🔔 Уведомления YooKassa принимаются на :{port}{path}")
+    return runner
+
+
+def send_test_notification(payment_id, event='payment.succeeded',
+                           url=f"http://127.0.0.1:{YOOKASSA_WEBHOOK_PORT}{YOOKASSA_WEBHOOK_PATH}"):
+    """
+    Отправляет уведомление как YooKassa - для проверки без личного кабинета
+
+    Бот всё равно перепроверит платёж в API, поэтому нужен настоящий
+    (тестовый) платёж и YOOKASSA_WEBHOOK_ALLOW_LOCAL=true у бота.
+
+    Returns:
+        HTTP-код ответа бота
+    """
+    body = json.dumps({
+        'type': 'notification',
+        'event': event,
+        'object': {'id': payment_id, 'status': event.split('.', 1)[1]},
+    }).encode()
+    request = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) < 2:
+        print("Использование: python payment_webhook.py <payment_id> [payment.succeeded|payment.canceled]")
+        sys.exit(1)
+
+    status_code = send_test_notification(sys.argv[1], *sys.argv[2:3])
+    print(f"{'✅' if status_code == 200 else '❌'} Ответ бота: {status_code}")
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк PDF генератора
+Рендерит книги из фиксированных тестовых картинок и показывает:
+время по типам страниц, размер PDF, число объектов и пиковую память
+
+Запуск:
+    python pdf_benchmark.py
+    python pdf_benchmark.py --runs 5 --scenes 10
+    python pdf_benchmark.py --outline stroke
+"""
+
+import argparse
+import os
+import random
+import re
+import shutil
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+from PIL import Image, ImageDraw
+
+from pdf_generator import create_book_from_data, OUTLINE_MODES
+
+# Размер как у иллюстраций Flux в формате 3:4
+SAMPLE_IMAGE_SIZE = (768, 1024)
+
+SAMPLE_TEXT = (
+    "Маша проснулась рано утром и увидела, что за окном сияет огромная радуга. "
+    "Она быстро оделась, взяла любимого плюшевого зайца и выбежала во двор. "
+    "Там её уже ждал маленький робот с блестящими глазами, который махал ей рукой "
+    "и приглашал отправиться в самое удивительное путешествие в её жизни!"
+)
+
+
+def make_sample_images(folder, count=10, size=SAMPLE_IMAGE_SIZE, seed=42):
+    """
+    Создаёт детерминированные тестовые картинки (градиент + фигуры + шум)
+
+    Сохраняются как JPEG качества 90 - так же, как в generate_storybook_v2.py
+    Возвращает: список путей
+    """
+    os.makedirs(folder, exist_ok=True)
+    rnd = random.Random(seed)
+    width, height = size
+    paths = []
+
+    for n in range(count):
+        img = Image.new('RGB', size)
+        draw = ImageDraw.Draw(img)
+
+        # Фон - вертикальный градиент своего цвета для каждой сцены
+        top = (rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255))
+        bottom = (rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255))
+        for y in range(height):
+            t = y / height
+            color = tuple(int(top[k] + (bottom[k] - top[k]) * t) for k in range(3))
+            draw.line([(0, y), (width, y)], fill=color)
+
+        # Фигуры - чтобы JPEG был похож по размеру на настоящую иллюстрацию
+        for _ in range(60):
+            x0, y0 = rnd.randint(0, width), rnd.randint(0, height)
+            x1, y1 = x0 + rnd.randint(10, 200), y0 + rnd.randint(10, 200)
+            color = (rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255))
+            draw.ellipse([x0, y0, x1, y1], fill=color)
+
+        # Шум
+        noise = Image.effect_noise(size, 40).convert('RGB')
+        img = Image.blend(img, noise, 0.15)
+
+        path = os.path.join(folder, f"scene_{n + 1:02d}.jpg")
+        img.save(path, 'JPEG', quality=90, optimize=True)
+        paths.append(path)
+
+    return paths
+
+
+def count_pdf_objects(pdf_path):
+    """Количество косвенных объектов в PDF (строки вида «12 0 obj»)"""
+    with open(pdf_path, 'rb') as f:
+        return len(re.findall(rb'\d+ \d+ obj\b', f.read()))
+
+
+def benchmark_book(image_paths, output_dir, runs=3, **book_options):
+    """
+    Рендерит книгу runs раз и собирает замеры
+
+    Args:
+        image_paths: картинки сцен
+        output_dir: куда сохранять PDF
+        runs: количество прогонов
+        book_options: дополнительные параметры для create_book_from_data
+
+    Returns:
+        {
+            'cover': сек, 'scene': сек (на одну страницу), 'final': сек,
+            'save': сек, 'total': сек, 'size': байт, 'objects': шт,
+            'peak_memory': байт
+        }
+    """
+    scenes_data = [
+        {"number": n + 1, "title": f"Сцена {n + 1}", "text": SAMPLE_TEXT, "image": path}
+        for n, path in enumerate(image_paths)
+    ]
+
+    samples = {'cover': [], 'scene': [], 'final': [], 'save': [], 'total': []}
+    pdf_path = os.path.join(output_dir, "benchmark.pdf")
+
+    def render(stats):
+        create_book_from_data("Маша", 5, scenes_data, pdf_path, "В ГОРОДЕ\nРОБОТОВ",
+                              stats=stats, **book_options)
+
+    for _ in range(runs):
+        stats = {}
+        started = time.perf_counter()
+        render(stats)
+        samples['total'].append(time.perf_counter() - started)
+
+        samples['cover'].append(stats['cover'])
+        samples['scene'].append(statistics.mean(stats['scenes']))
+        samples['final'].append(stats['final'])
+        samples['save'].append(stats['save'])
+
+    result = {key: statistics.median(values) for key, values in samples.items()}
+
+    # Память меряем отдельным прогоном - tracemalloc сильно замедляет Python
+    tracemalloc.start()
+    render({})
+    result['peak_memory'] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    result['size'] = os.path.getsize(pdf_path)
+    result['objects'] = count_pdf_objects(pdf_path)
+    return result
+
+
+def print_report(title, result):
+    """Печатает результаты одного бенчмарка"""
+    print()
+    print("=" * 60)
+    print(f"📊 {title}")
+    print("=" * 60)
+    print(f"⏱️ Титульная:       {result['cover'] * 1000:8.1f} мс")
+    print(f"⏱️ Сцена (1 стр.):  {result['scene'] * 1000:8.1f} мс")
+    print(f"⏱️ Финальная:       {result['final'] * 1000:8.1f} мс")
+    print(f"⏱️ Сохранение:      {result['save'] * 1000:8.1f} мс")
+    print(f"⏱️ Всего:           {result['total'] * 1000:8.1f} мс")
+    print(f"💾 Размер PDF:      {result['size'] / 1024:8.1f} KB")
+    print(f"🧩 Объектов в PDF:  {result['objects']:8d}")
+    print(f"🧠 Пиковая память:  {result['peak_memory'] / 1024 / 1024:8.1f} MB")
+
+
+def print_comparison(base_title, base, title, result):
+    """Печатает разницу двух бенчмарков в процентах"""
+    def diff(key):
+        return (result[key] / base[key] - 1) * 100 if base[key] else 0.0
+
+    print()
+    print(f"⚖️ {title} против {base_title}:")
+    print(f"   Сцена: {diff('scene'):+.0f}%  Всего: {diff('total'):+.0f}%  "
+          f"Размер: {diff('size'):+.1f}%  Память: {diff('peak_memory'):+.0f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк PDF генератора")
+    parser.add_argument('--runs', type=int, default=3, help="количество прогонов (медиана)")
+    parser.add_argument('--scenes', type=int, default=10, help="количество сцен в книге")
+    parser.add_argument('--outline', choices=OUTLINE_MODES + ('all',), default='all',
+                        help="режим обводки текста (all - сравнить все)")
+    parser.add_argument('--keep', action='store_true', help="не удалять временную папку с PDF")
+    args = parser.parse_args()
+
+    modes = OUTLINE_MODES if args.outline == 'all' else (args.outline,)
+
+    work_dir = tempfile.mkdtemp(prefix="pdf_benchmark_")
+    try:
+        print(f"🖼️ Готовлю {args.scenes} тестовых картинок в {work_dir}...")
+        images = make_sample_images(os.path.join(work_dir, "images"), count=args.scenes)
+
+        results = {}
+        for mode in modes:
+            mode_dir = os.path.join(work_dir, mode)
+            os.makedirs(mode_dir, exist_ok=True)
+            results[mode] = benchmark_book(images, mode_dir, runs=args.runs, outline_mode=mode)
+
+        for mode in modes:
+            print_report(f"Книга: {args.scenes} сцен, обводка {mode}, {args.runs} прогонов (медиана)",
+                         results[mode])
+
+        base = modes[0]
+        for mode in modes[1:]:
+            print_comparison(base, results[base], mode, results[mode])
+    finally:
+        if args.keep:
+            print(f"\n📁 Файлы сохранены: {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
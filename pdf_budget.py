@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Контроль размера PDF под бюджет (например, лимит Telegram)
+Подбирает для каждой картинки разрешение и качество JPEG так,
+чтобы собранный PDF получился чуть меньше заданного размера
+"""
+
+import io
+import os
+
+from PIL import Image
+
+# Лимит, под который сейчас сжимаются книги (см. generate_storybook_v2.py)
+TELEGRAM_PDF_LIMIT_MB = 20
+
+# Всё, что в PDF кроме картинок сцен: шрифты, оверлеи, текст, служебные объекты
+PDF_OVERHEAD_BYTES = 300 * 1024
+
+# Запас, чтобы не упереться в бюджет из-за погрешности оценки
+SAFETY_MARGIN = 0.03
+
+# Ступени (масштаб, качество JPEG) - от лучшей к худшей
+QUALITY_LADDER = [
+    (1.0, 95), (1.0, 90), (1.0, 85), (1.0, 80), (1.0, 75),
+    (0.85, 75), (0.85, 70), (0.7, 70), (0.7, 60), (0.55, 60), (0.55, 50),
+]
+
+# Исходная ступень - так сжимает generate_illustration (JPEG 90, без масштабирования)
+BASE_LEVEL = (1.0, 90)
+
+# Во сколько раз уменьшать картинку для оценки размера
+SAMPLE_SCALE = 0.25
+
+
+def to_rgb(img):
+    """Переводит картинку в RGB для JPEG (прозрачность - на белом фоне)"""
+    if img.mode in ('RGBA', 'LA', 'P'):
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        if img.mode == 'P':
+            img = img.convert('RGBA')
+        background.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
+        return background
+    if img.mode != 'RGB':
+        return img.convert('RGB')
+    return img
+
+
+def resize(img, scale):
+    """Масштабирует картинку (scale=1.0 - без изменений)"""
+    if scale >= 1.0:
+        return img
+    size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+    return img.resize(size, Image.LANCZOS)
+
+
+def jpeg_size(img, quality):
+    """Размер картинки в JPEG заданного качества (кодирование в память)"""
+    buffer = io.BytesIO()
+    img.save(buffer, 'JPEG', quality=quality, optimize=True)
+    return buffer.tell()
+
+
+def estimate_sizes(source_path, anchor_path, ladder=QUALITY_LADDER):
+    """
+    Оценивает размер картинки на каждой ступени без полного перекодирования
+
+    Кодируется только уменьшенная копия (SAMPLE_SCALE), а результат
+    масштабируется по известному размеру файла anchor_path, который уже
+    сжат на ступени BASE_LEVEL:
+        оценка(ступень) = размер(anchor) * мини(ступень) / мини(BASE_LEVEL)
+
+    Returns:
+        список оценок в байтах - по одной на ступень
+    """
+    anchor_size = os.path.getsize(anchor_path)
+    with Image.open(source_path) as img:
+        sample = resize(to_rgb(img), SAMPLE_SCALE)
+
+    base_scale, base_quality = BASE_LEVEL
+    base = jpeg_size(resize(sample, base_scale), base_quality)
+
+    samples = {}
+    estimates = []
+    for scale, quality in ladder:
+        if scale not in samples:
+            samples[scale] = resize(sample, scale)
+        estimates.append(anchor_size * jpeg_size(samples[scale], quality) / base)
+    return estimates
+
+
+def plan_levels(estimates, available_bytes):
+    """
+    Выбирает ступень для каждой картинки так, чтобы сумма влезла в бюджет
+
+    Жадно: пока не влезаем, опускаем на ступень ту картинку,
+    у которой этот шаг экономит больше всего байт
+
+    Returns:
+        (список индексов ступеней, оценка суммарного размера)
+    """
+    levels = [0] * len(estimates)
+    total = sum(sizes[0] for sizes in estimates)
+
+    while total > available_bytes:
+        best, best_saving = None, 0
+        for i, sizes in enumerate(estimates):
+            if levels[i] + 1 < len(sizes):
+                saving = sizes[levels[i]] - sizes[levels[i] + 1]
+                if saving > best_saving:
+                    best, best_saving = i, saving
+        if best is None:
+            break  # Ниже некуда - отдаём лучшее, что есть
+        levels[best] += 1
+        total -= best_saving
+
+    return levels, total
+
+
+def encode_level(source_path, output_path, level):
+    """Сохраняет картинку на выбранной ступени (масштаб, качество)"""
+    scale, quality = level
+    with Image.open(source_path) as img:
+        resize(to_rgb(img), scale).save(output_path, 'JPEG', quality=quality, optimize=True)
+
+
+def correct_estimates(estimates, observed):
+    """
+    Уточняет оценки по уже закодированным картинкам
+
+    Для закодированных пар (сцена, ступень) берётся точный размер, для
+    остальных - оценка, умноженная на среднюю ошибку оценки на этой ступени
+    (или на ближайшей ступени, где есть замеры)
+    """
+    errors = {}
+    for (i, level_index), size in observed.items():
+        errors.setdefault(level_index, []).append(size / estimates[i][level_index])
+    ratios = {level_index: sum(values) / len(values) for level_index, values in errors.items()}
+
+    corrected = []
+    for i, sizes in enumerate(estimates):
+        row = []
+        for level_index, size in enumerate(sizes):
+            if (i, level_index) in observed:
+                row.append(observed[(i, level_index)])
+            elif ratios:
+                nearest = min(ratios, key=lambda known: abs(known - level_index))
+                row.append(size * ratios[nearest])
+            else:
+                row.append(size)
+        corrected.append(row)
+    return corrected
+
+
+def pdf_size(pdf):
+    """Размер PDF: путь к файлу или буфер в памяти (io.BytesIO)"""
+    if isinstance(pdf, str):
+        return os.path.getsize(pdf)
+    return pdf.getbuffer().nbytes
+
+
+def fit_scenes_to_budget(scenes_data, budget_bytes, output_dir, overhead=PDF_OVERHEAD_BYTES,
+                         max_passes=4, build_pdf=None):
+    """
+    Подгоняет картинки сцен под бюджет размера PDF
+
+    Оценки по миниатюрам неточны, поэтому после каждого прохода размеры
+    закодированных картинок (и PDF, если задан build_pdf) запоминаются,
+    оценки уточняются и ступени подбираются заново - пока PDF не окажется
+    в бюджете, но не дальше 2 * SAFETY_MARGIN от него
+
+    Args:
+        scenes_data: сцены (image - сжатый JPEG 90, source - исходник, если сохранён)
+        budget_bytes: целевой размер PDF
+        output_dir: куда сохранять перекодированные картинки
+        overhead: оценка размера PDF без картинок (уточняется по готовому PDF)
+        max_passes: максимум проходов подбора
+        build_pdf: функция(scenes) -> путь к PDF или io.BytesIO; если задана -
+                   PDF собирается на каждом проходе и его размер учитывается
+
+    Returns:
+        новый список сцен (image указывает на подобранные картинки)
+    """
+    # Без исходника качество выше исходного JPEG 90 не поднять
+    ladders, estimates = [], []
+    for scene in scenes_data:
+        source = scene.get('source') or scene['image']
+        ladder = QUALITY_LADDER if scene.get('source') else QUALITY_LADDER[QUALITY_LADDER.index(BASE_LEVEL):]
+        ladders.append(ladder)
+        estimates.append(estimate_sizes(source, scene['image'], ladder))
+
+    encoded = {}   # (номер сцены, ступень) -> путь, чтобы не кодировать дважды
+    observed = {}  # (номер сцены, индекс ступени) -> реальный размер
+    best = None    # (размер PDF, сцены) - самый крупный вариант, который влез
+
+    for attempt in range(max_passes):
+        available = budget_bytes * (1 - SAFETY_MARGIN) - overhead
+        levels, estimated_total = plan_levels(correct_estimates(estimates, observed), available)
+
+        fitted = []
+        for i, (scene, ladder, level_index) in enumerate(zip(scenes_data, ladders, levels)):
+            level = ladder[level_index]
+            if level == BASE_LEVEL:
+                # Уже сжато как надо - перекодировать незачем
+                fitted.append(scene)
+            else:
+                if (i, level) not in encoded:
+                    scale, quality = level
+                    base_name = os.path.splitext(os.path.basename(scene['image']))[0]
+                    image_path = os.path.join(output_dir, f"{base_name}_{int(scale * 100)}_q{quality}.jpg")
+                    encode_level(scene.get('source') or scene['image'], image_path, level)
+                    encoded[(i, level)] = image_path
+                fitted.append(dict(scene, image=encoded[(i, level)]))
+            observed[(i, level_index)] = os.path.getsize(fitted[-1]['image'])
+
+        images_total = sum(os.path.getsize(scene['image']) for scene in fitted)
+        total = images_total + overhead
+        if build_pdf is not None:
+            total = pdf_size(build_pdf(fitted))
+            overhead = total - images_total
+
+        print(f"🎯 Бюджет PDF {budget_bytes / 1024 / 1024:.1f} MB, проход {attempt + 1}: "
+              f"PDF {total / 1024 / 1024:.2f} MB (оценка картинок {estimated_total / 1024 / 1024:.2f} MB, "
+              f"факт {images_total / 1024 / 1024:.2f} MB)")
+
+        if total <= budget_bytes:
+            if best is None or total > best[0]:
+                best = (total, fitted)
+            at_best = all(level_index == 0 for level_index in levels)
+            if at_best or budget_bytes - total <= budget_bytes * SAFETY_MARGIN * 2:
+                break
+
+    if best is None:
+        print(f"⚠️ Не удалось уложиться в бюджет: PDF {total / 1024 / 1024:.2f} MB")
+        return fitted
+
+    total, best_fitted = best
+    if build_pdf is not None and best_fitted is not fitted:
+        # Последний проход не влез - пересобираем лучший вариант
+        build_pdf(best_fitted)
+    print(f"✅ PDF {total / 1024 / 1024:.2f} MB - в бюджете")
+    return best_fitted
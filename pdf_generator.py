@@ -10,9 +10,24 @@ from reportlab.pdfgen import canvas
 from reportlab.lib.colors import HexColor
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.lib.utils import ImageReader
+from reportlab import rl_config
+from PIL import Image
+from functools import lru_cache
+import random
 import textwrap
+import time
 import os
 
+# Бинарные потоки вместо ASCII85: картинки сцен (уже JPEG) не раздуваются на 25%
+# и не кодируются медленным питоновским base85 при каждом drawImage.
+# Настройка глобальная на весь процесс: у Canvas нет такого параметра, а reportlab
+# читает rl_config.useA85 в момент отрисовки и сохранения. Включать/выключать её
+# вокруг одной книги нельзя - варианты собираются параллельно в потоках
+# (book_formats.render_variants). Глобально это безопасно: reportlab в процессе
+# используется только здесь, а бинарные потоки - обычный PDF, его читают все просмотрщики
+rl_config.useA85 = 0
+
 # Регистрируем шрифт с поддержкой кириллицы
 fonts_registered = False
 font_regular = 'Helvetica'
@@ -77,22 +92,85 @@ if not fonts_registered:
     print("   2. Загрузите их в корень репозитория на GitHub")
     print("   3. Удалите ComicNeue файлы (они не поддерживают кириллицу!)")
 
-def draw_smooth_gradient(c, width, height, overlay_height):
-    """Плавный ТЁМНЫЙ градиент для хорошей читаемости"""
+def compose_strips_overlay(strips, bottom, top, rows=600):
+    """
+    Предрендеренный оверлей из полупрозрачных чёрных полос: картинка 1 x rows
+    с альфа-каналом. В строке пикселей - итоговая прозрачность всех полос,
+    которые её накрывают (полосы перекрываются, как и при отрисовке по одной)
+    
+    strips: список (y, высота, alpha) в координатах страницы
+    bottom, top: какой диапазон по высоте покрывает картинка
+    """
+    alpha_row = bytearray()
+    row_height = (top - bottom) / rows
+    for row in range(rows):
+        y = top - (row + 0.5) * row_height  # строка 0 - верх картинки
+        transparency = 1.0
+        for y_pos, strip_height, alpha in strips:
+            if y_pos <= y < y_pos + strip_height:
+                transparency *= 1 - alpha
+        alpha_row.append(round((1 - transparency) * 255))
+    
+    black = Image.new('L', (1, rows), 0)
+    alpha = Image.frombytes('L', (1, rows), bytes(alpha_row))
+    return ImageReader(Image.merge('RGBA', (black, black, black, alpha)))
+
+@lru_cache(maxsize=None)
+def smooth_gradient_overlay(overlay_height):
+    """Нижний градиент сцен - считается один раз на процесс"""
+    strips = []
     for i in range(300):
         y_pos = (overlay_height / 300) * i
         strip_height = (overlay_height / 300) + 0.5
         progress = i / 300
         alpha = 0.95 * (1 - progress) ** 1.2  # Было 0.85, стало 0.95 - ТЕМНЕЕ!
-        
-        c.setFillColor(HexColor('#000000'))
-        c.setFillAlpha(alpha)
-        c.rect(0, y_pos, width, strip_height, fill=1, stroke=0)
+        strips.append((y_pos, strip_height, alpha))
+    return compose_strips_overlay(strips, 0, overlay_height)
+
+@lru_cache(maxsize=None)
+def top_gradient_overlay(height, gradient_height):
+    """Верхний градиент обложки - считается один раз на процесс"""
+    strips = []
+    for i in range(300):
+        y_pos = height - (i * (gradient_height / 300))
+        strip_height = (gradient_height / 300) + 0.5
+        progress = i / 300
+        alpha = 0.75 * (progress ** 1.5)
+        strips.append((y_pos, strip_height, alpha))
+    bottom = min(y_pos for y_pos, _, _ in strips)
+    return bottom, compose_strips_overlay(strips, bottom, height)
+
+def draw_smooth_gradient(c, width, height, overlay_height):
+    """
+    Плавный ТЁМНЫЙ градиент для хорошей читаемости
     
-    c.setFillAlpha(1.0)
+    Рисуется одной картинкой с альфа-каналом вместо 300 полос: reportlab
+    встраивает одинаковую картинку в PDF один раз, а страницы на неё ссылаются
+    """
+    c.drawImage(smooth_gradient_overlay(overlay_height), 0, 0,
+                width=width, height=overlay_height,
+                mask='auto', preserveAspectRatio=False)
+
+def draw_top_gradient(c, width, height, gradient_height):
+    """Градиент сверху обложки - под заголовком (одной картинкой, как и нижний)"""
+    bottom, overlay = top_gradient_overlay(height, gradient_height)
+    c.drawImage(overlay, 0, bottom,
+                width=width, height=height - bottom,
+                mask='auto', preserveAspectRatio=False)
+
+# Режимы обводки текста:
+# - overdraw: текст рисуется 15 раз (14 чёрных смещений + белый) - исходный вариант
+# - stroke: 2 операции на строку - контур штрихом PDF (render mode 1) и белая заливка
+OUTLINE_MODES = ('overdraw', 'stroke')
+OUTLINE_MODE = os.environ.get("PDF_OUTLINE_MODE", "overdraw")
+OUTLINE_WIDTH = 3  # Толщина обводки в пунктах (как у смещений ±3 в overdraw)
 
-def draw_text_with_outline(c, x, y, text, font, size):
+def draw_text_with_outline(c, x, y, text, font, size, outline_mode='overdraw', outline_width=OUTLINE_WIDTH):
     """Текст с ТОЛСТОЙ обводкой для детской книги"""
+    if outline_mode == 'stroke':
+        draw_text_with_stroke(c, x, y, text, font, size, outline_width)
+        return
+    
     c.setFont(font, size)
     
     # Обводка - ТОЛЩЕ для лучшей читаемости!
@@ -111,60 +189,48 @@ def draw_text_with_outline(c, x, y, text, font, size):
     c.setFillColor(HexColor('#ffffff'))
     c.drawCentredString(x, y, text)
 
-def create_book_from_data(child_name, child_age, scenes_data, output_path, theme_title="ГОРОДЕ РОБОТОВ"):
+def draw_text_with_stroke(c, x, y, text, font, size, outline_width=OUTLINE_WIDTH):
     """
-    Создаёт PDF из готовых данных
-    
-    Параметры:
-    - child_name: имя ребёнка
-    - child_age: возраст
-    - scenes_data: список сцен с image, text
-    - output_path: путь для сохранения PDF
-    - theme_title: название темы для обложки (например, "ГОРОДЕ РОБОТОВ")
+    Обводка средствами PDF: сначала только контур букв (render mode 1)
+    линией двойной толщины - половина линии уходит внутрь буквы и потом
+    закрывается белой заливкой (render mode 0). Одна строка - 2 вывода текста
     """
+    text_width = pdfmetrics.stringWidth(text, font, size)
+    x_start = x - text_width / 2
     
-    print(f"📄 Создаю PDF: {output_path}")
-    print(f"🔤 Используемый шрифт: {font_regular}")
+    c.saveState()
+    c.setLineWidth(outline_width * 2)
+    c.setLineJoin(1)  # Скруглённые углы - без «шипов» на острых буквах
     
-    # Проверяем что все файлы существуют
-    from PIL import Image
-    for scene in scenes_data:
-        if not os.path.exists(scene['image']):
-            raise FileNotFoundError(f"Файл не найден: {scene['image']}")
-        
-        # Проверяем что файл валидный
-        try:
-            img = Image.open(scene['image'])
-            img.verify()
-        except Exception as e:
-            raise ValueError(f"Повреждён файл {scene['image']}: {e}")
+    t = c.beginText(x_start, y)
+    t.setFont(font, size)
     
-    c = canvas.Canvas(output_path, pagesize=A4)
-    width, height = A4
+    # Контур - чёрный
+    t.setTextRenderMode(1)
+    t.setStrokeColor(HexColor('#000000'))
+    t.textOut(text)
     
-    # ========================================================================
-    # ТИТУЛЬНАЯ
-    # ========================================================================
+    # Основной текст - белый, поверх внутренней половины контура
+    t.setTextOrigin(x_start, y)
+    t.setTextRenderMode(0)
+    t.setFillColor(HexColor('#ffffff'))
+    t.textOut(text)
+    
+    c.drawText(t)
+    c.restoreState()
+
+def draw_cover_page(c, width, height, cover_image, child_name, theme_title, outline_mode='overdraw'):
+    """Титульная страница: первая иллюстрация, градиент сверху, имя и тема"""
     
     # Фон - первая иллюстрация (растянуть на всю страницу БЕЗ серых полос!)
     # preserveAspectRatio=False безопасен т.к. изображения генерируются в пропорциях A4 (950x1344)
-    c.drawImage(scenes_data[0]['image'], 0, 0, 
+    c.drawImage(cover_image, 0, 0, 
                 width=width, height=height,
                 preserveAspectRatio=False)
     
     # Градиент сверху (УМЕНЬШЕН с 12см до 8см - не закрывает лицо!)
     gradient_height = 8*cm  # Было 12*cm
-    for i in range(300):
-        y_pos = height - (i * (gradient_height / 300))
-        strip_height = (gradient_height / 300) + 0.5
-        progress = i / 300
-        alpha = 0.75 * (progress ** 1.5)
-        
-        c.setFillColor(HexColor('#000000'))
-        c.setFillAlpha(alpha)
-        c.rect(0, y_pos, width, strip_height, fill=1, stroke=0)
-    
-    c.setFillAlpha(1.0)
+    draw_top_gradient(c, width, height, gradient_height)
     
     # Заголовок - ДИНАМИЧЕСКИЙ!
     # Разбиваем theme_title на строки (если длинный)
@@ -174,61 +240,72 @@ def create_book_from_data(child_name, child_age, scenes_data, output_path, theme
     
     # Первая строка - имя
     draw_text_with_outline(c, width/2, y_start, f"{child_name.upper()}", 
-                          font_bold, 56)
+                          font_bold, 56, outline_mode)
     
     # Остальные строки - название темы
     for i, line in enumerate(title_lines):
         y_pos = y_start - (1.8*cm * (i + 1))
         draw_text_with_outline(c, width/2, y_pos, line.upper(),
-                              font_bold, 56)
-    
-    # ========================================================================
-    # СЦЕНЫ
-    # ========================================================================
+                              font_bold, 56, outline_mode)
+
+def draw_scene_page(c, width, height, scene, outline_mode='overdraw'):
+    """Страница сцены: иллюстрация на всю страницу, градиент снизу и текст"""
     
-    for scene in scenes_data:
-        c.showPage()
-        
-        # Фон - растягиваем на всю страницу БЕЗ серых полос!
-        # preserveAspectRatio=False безопасен т.к. изображения генерируются в пропорциях A4 (950x1344)
-        c.drawImage(scene['image'], 0, 0, 
-                   width=width, height=height,
-                   preserveAspectRatio=False)
-        
-        # Градиент снизу (выше чтобы текст было видно лучше)
-        draw_smooth_gradient(c, width, height, 10*cm)  # Было 9cm, стало 10cm
-        
-        # Текст с обводкой (КРУПНЫЙ детский шрифт!)
-        lines = textwrap.wrap(scene['text'], width=40)  # Было 45, стало 40 для крупного шрифта
-        
-        y_offset = 10*cm - 2.5*cm  # Было 9cm
-        for line in lines[:7]:  # Было 8, стало 7 строк из-за крупного шрифта
-            draw_text_with_outline(c, width/2, y_offset, line, font_regular, 22)  # Было 20, стало 22!
-            y_offset -= 1.1*cm  # Увеличил межстрочный интервал (было 1.0cm)
+    # Фон - растягиваем на всю страницу БЕЗ серых полос!
+    # preserveAspectRatio=False безопасен т.к. изображения генерируются в пропорциях A4 (950x1344)
+    c.drawImage(scene['image'], 0, 0, 
+               width=width, height=height,
+               preserveAspectRatio=False)
     
-    # ========================================================================
-    # ФИНАЛ
-    # ========================================================================
+    # Градиент снизу (выше чтобы текст было видно лучше)
+    draw_smooth_gradient(c, width, height, 10*cm)  # Было 9cm, стало 10cm
     
-    c.showPage()
+    # Текст с обводкой (КРУПНЫЙ детский шрифт!)
+    lines = textwrap.wrap(scene['text'], width=40)  # Было 45, стало 40 для крупного шрифта
     
-    # Градиент
+    y_offset = 10*cm - 2.5*cm  # Было 9cm
+    for line in lines[:7]:  # Было 8, стало 7 строк из-за крупного шрифта
+        draw_text_with_outline(c, width/2, y_offset, line, font_regular, 22, outline_mode)  # Было 20, стало 22!
+        y_offset -= 1.1*cm  # Увеличил межстрочный интервал (было 1.0cm)
+
+@lru_cache(maxsize=None)
+def final_page_geometry(width, height):
+    """
+    Геометрия финальной страницы (полосы градиента и звёзды)
+    Одинакова для всех книг - считается один раз на процесс
+    """
+    gradient = []
     for i in range(100):
         progress = i / 100
         r = int(10 + (30 - 10) * progress)
         g = int(20 + (50 - 20) * progress)
         b = int(40 + (80 - 40) * progress)
-        c.setFillColor(HexColor(f'#{r:02x}{g:02x}{b:02x}'))
-        c.rect(0, height * (1 - progress), width, height/100, fill=1, stroke=0)
+        gradient.append((HexColor(f'#{r:02x}{g:02x}{b:02x}'), height * (1 - progress)))
+    
+    # Свой генератор с тем же seed - не сбиваем глобальный random
+    # (им выбирается история в generate_storybook_v2.py)
+    rnd = random.Random(42)
+    stars = []
+    for _ in range(30):
+        x = rnd.randint(0, int(width))
+        y = rnd.randint(0, int(height))
+        stars.append((x, y, rnd.choice([2, 3, 4])))
+    
+    return tuple(gradient), tuple(stars)
+
+def draw_final_page(c, width, height):
+    """Финальная страница «Конец сказки!» - ночное небо со звёздами и месяцем"""
+    gradient, stars = final_page_geometry(width, height)
+    
+    # Градиент
+    for color, y_pos in gradient:
+        c.setFillColor(color)
+        c.rect(0, y_pos, width, height/100, fill=1, stroke=0)
     
     # Звёзды
     c.setFillColor(HexColor('#FFD700'))
-    import random
-    random.seed(42)
-    for _ in range(30):
-        x = random.randint(0, int(width))
-        y = random.randint(0, int(height))
-        c.circle(x, y, random.choice([2, 3, 4]), fill=1, stroke=0)
+    for x, y, radius in stars:
+        c.circle(x, y, radius, fill=1, stroke=0)
     
     # Месяц
     c.setFillColor(HexColor('#FFE5B4'))
@@ -241,6 +318,81 @@ def create_book_from_data(child_name, child_age, scenes_data, output_path, theme
     c.setFont(font_bold, 52)
     c.drawCentredString(width/2, height/2 + 1*cm, "Конец")
     c.drawCentredString(width/2, height/2 - 1.5*cm, "сказки!")
+
+def create_book_from_data(child_name, child_age, scenes_data, output_path, theme_title="ГОРОДЕ РОБОТОВ",
+                          stats=None, outline_mode=None):
+    """
+    Создаёт PDF из готовых данных
+    
+    Параметры:
+    - child_name: имя ребёнка
+    - child_age: возраст
+    - scenes_data: список сцен с image, text
+    - output_path: путь для сохранения PDF или файловый объект (например, io.BytesIO -
+      тогда PDF собирается в памяти, без записи на диск)
+    - theme_title: название темы для обложки (например, "ГОРОДЕ РОБОТОВ")
+    - stats: словарь для замеров (опционально) - заполняется временем
+      отрисовки по типам страниц: cover, scenes (список), final, save
+    - outline_mode: обводка текста 'overdraw' или 'stroke'
+      (по умолчанию - из переменной окружения PDF_OUTLINE_MODE)
+    """
+    
+    outline_mode = outline_mode or OUTLINE_MODE
+    if outline_mode not in OUTLINE_MODES:
+        raise ValueError(f"Неизвестный режим обводки: {outline_mode} (доступны: {', '.join(OUTLINE_MODES)})")
+    
+    target = output_path if isinstance(output_path, str) else "в памяти"
+    print(f"📄 Создаю PDF: {target}")
+    print(f"🔤 Используемый шрифт: {font_regular}, обводка: {outline_mode}")
+    
+    # Проверяем что все файлы существуют
+    for scene in scenes_data:
+        if not os.path.exists(scene['image']):
+            raise FileNotFoundError(f"Файл не найден: {scene['image']}")
+        
+        # Проверяем что файл валидный
+        try:
+            img = Image.open(scene['image'])
+            img.verify()
+        except Exception as e:
+            raise ValueError(f"Повреждён файл {scene['image']}: {e}")
+    
+    if stats is None:
+        stats = {}
+    stats['scenes'] = []
+    
+    c = canvas.Canvas(output_path, pagesize=A4)
+    width, height = A4
+    
+    # ========================================================================
+    # ТИТУЛЬНАЯ
+    # ========================================================================
+    
+    started = time.perf_counter()
+    draw_cover_page(c, width, height, scenes_data[0]['image'], child_name, theme_title, outline_mode)
+    stats['cover'] = time.perf_counter() - started
+    
+    # ========================================================================
+    # СЦЕНЫ
+    # ========================================================================
+    
+    for scene in scenes_data:
+        c.showPage()
+        started = time.perf_counter()
+        draw_scene_page(c, width, height, scene, outline_mode)
+        stats['scenes'].append(time.perf_counter() - started)
+    
+    # ========================================================================
+    # ФИНАЛ
+    # ========================================================================
+    
+    c.showPage()
+    started = time.perf_counter()
+    draw_final_page(c, width, height)
+    stats['final'] = time.perf_counter() - started
     
+    # Сохранение - здесь reportlab сжимает потоки и встраивает картинки и шрифты
+    started = time.perf_counter()
     c.save()
-    print(f"✅ PDF готов: {output_path}")
+    stats['save'] = time.perf_counter() - started
+    print(f"✅ PDF готов: {target}")
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Хранение состояния бота в PostgreSQL (persistence для python-telegram-bot)
+
+user_data, chat_data, bot_data и состояния ConversationHandler лежат в
+таблице bot_persistence (pickle в BYTEA), поэтому редеплой больше не
+сбрасывает покупателей посреди оформления заказа.
+
+Чтобы не писать в БД на каждое обновление:
+- PTB отдаёт user_data/chat_data раз в PERSISTENCE_INTERVAL секунд
+- пишутся только изменившиеся записи (сравнивается хэш pickle)
+- всё накопленное уходит одной транзакцией через PERSISTENCE_WRITE_DELAY
+  секунд после первого изменения; при остановке бота - сразу (flush)
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import pickle
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+# Как часто PTB сохраняет user_data/chat_data/bot_data (сек)
+PERSISTENCE_INTERVAL = float(os.environ.get("PERSISTENCE_INTERVAL", "10"))
+
+# Сколько ждать после первого изменения, чтобы записать изменения пачкой (сек)
+PERSISTENCE_WRITE_DELAY = 1.0
+
+# Виды записей в bot_persistence.kind
+USER, CHAT, BOT = 'user', 'chat', 'bot'
+CONVERSATION_PREFIX = 'conv:'
+
+
+class PostgresPersistence(BasePersistence):
+    """BasePersistence поверх asyncpg-пула AsyncDatabase"""
+
+    def __init__(self, adb, update_interval=PERSISTENCE_INTERVAL):
+        # callback_data не храним - кнопки бота не используют arbitrary_callback_data
+        super().__init__(
+            store_data=PersistenceInput(bot_data=True, chat_data=True, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.adb = adb
+        self._written = {}   # (kind, key) -> хэш последнего записанного pickle
+        self._pending = {}   # (kind, key) -> pickle или None (удалить)
+        self._write_task = None
+        self._write_lock = asyncio.Lock()
+
+    # ===== ЧТЕНИЕ (один раз при запуске) =====
+
+    async def _load(self, kind):
+        rows = await self.adb.fetch('SELECT key, data FROM bot_persistence WHERE kind = $1', kind)
+        result = {}
+        for row in rows:
+            data = bytes(row['data'])
+            self._written[(kind, row['key'])] = hashlib.sha1(data).hexdigest()
+            result[row['key']] = pickle.loads(data)
+        return result
+
+    async def get_user_data(self):
+        return {int(key): value for key, value in (await self._load(USER)).items()}
+
+    async def get_chat_data(self):
+        return {int(key): value for key, value in (await self._load(CHAT)).items()}
+
+    async def get_bot_data(self):
+        return (await self._load(BOT)).get('', {})
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        rows = await self._load(CONVERSATION_PREFIX + name)
+        return {tuple(json.loads(key)): state for key, state in rows.items()}
+
+    # ===== ЗАПИСЬ (копится и уходит пачкой) =====
+
+    def _stage(self, kind, key, value):
+        """Ставит запись в очередь, если она изменилась с последней записи"""
+        item = (kind, str(key))
+        if value is None:
+            if item in self._written or item in self._pending:
+                self._pending[item] = None
+        else:
+            data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            digest = hashlib.sha1(data).hexdigest()
+            if self._written.get(item) == digest and item not in self._pending:
+                return
+            self._pending[item] = data
+        self._schedule_write()
+
+    def _schedule_write(self):
+        if self._pending and (self._write_task is None or self._write_task.done()):
+            self._write_task = asyncio.get_running_loop().create_task(self._delayed_write())
+
+    async def _delayed_write(self):
+        await asyncio.sleep(PERSISTENCE_WRITE_DELAY)
+        await self._write_pending()
+
+    async def _write_pending(self):
+        """Пишет все накопленные изменения одной транзакцией"""
+        async with self._write_lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+            upserts = [(kind, key, data) for (kind, key), data in pending.items() if data is not None]
+            deletes = [(kind, key) for (kind, key), data in pending.items() if data is None]
+            try:
+                async with self.adb.transaction() as conn:
+                    if upserts:
+                        await conn.executemany('''
+                            INSERT INTO bot_persistence (kind, key, data)
+                            VALUES ($1, $2, $3)
+                            ON CONFLICT (kind, key) DO UPDATE SET
+                                data = EXCLUDED.data,
+                                updated_at = CURRENT_TIMESTAMP
+                        ''', upserts)
+                    if deletes:
+                        await conn.executemany('DELETE FROM bot_persistence WHERE kind = $1 AND key = $2', deletes)
+            except Exception as e:
+                # Более новые изменения, пришедшие во время записи, важнее неудавшихся
+                for item, data in pending.items():
+                    self._pending.setdefault(item, data)
+                logger.error(f"💾 Состояние бота не сохранено ({len(pending)} записей), повторю позже: {e}")
+                return
+
+            for kind, key, data in upserts:
+                self._written[(kind, key)] = hashlib.sha1(data).hexdigest()
+            for item in deletes:
+                self._written.pop(item, None)
+
+    async def update_user_data(self, user_id, data):
+        self._stage(USER, user_id, data)
+
+    async def update_chat_data(self, chat_id, data):
+        self._stage(CHAT, chat_id, data)
+
+    async def update_bot_data(self, data):
+        self._stage(BOT, '', data)
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name, key, new_state):
+        # new_state=None - разговор закончен, запись удаляется
+        self._stage(CONVERSATION_PREFIX + name, json.dumps(list(key)), new_state)
+
+    async def drop_user_data(self, user_id):
+        self._stage(USER, user_id, None)
+
+    async def drop_chat_data(self, chat_id):
+        self._stage(CHAT, chat_id, None)
+
+    # Данные живут в памяти процесса - перечитывать из БД нечего
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        """Остановка бота: записать всё сразу, не дожидаясь задержки"""
+        await self._write_pending()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Обновление сообщений с прогрессом без упора в лимиты Telegram
+
+Генерация может сообщать о прогрессе сколько угодно часто и из любого потока:
+update() только запоминает последний текст, а flush() (по job_queue) правит
+каждое сообщение не чаще раза в min_interval секунд на чат.
+Ошибки "message is not modified" и flood-wait обрабатываются здесь же.
+"""
+
+import logging
+import threading
+import time
+
+from telegram import InputMediaPhoto
+from telegram.error import BadRequest, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Не чаще одного редактирования в чат за столько секунд
+PROGRESS_MIN_INTERVAL = 5
+
+# Как часто job_queue проверяет очередь обновлений
+PROGRESS_FLUSH_INTERVAL = 1
+
+
+class ProgressReporter:
+    """Склеивает частые обновления прогресса в редкие edit_message_*"""
+
+    def __init__(self, min_interval=PROGRESS_MIN_INTERVAL):
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._pending = {}     # (chat_id, message_id) -> (текст, фото, parse_mode)
+        self._last_edit = {}   # chat_id -> время последнего редактирования
+        self._blocked_until = 0.0  # flood-wait от Telegram
+
+    def update(self, chat_id, message_id, text, photo=None, parse_mode=None):
+        """
+        Запоминает новое состояние сообщения (можно вызывать из любого потока)
+
+        Args:
+            text: новый текст (или подпись, если задано photo)
+            photo: байты картинки - заменить фото в сообщении
+        """
+        with self._lock:
+            key = (chat_id, message_id)
+            if photo is None and key in self._pending:
+                # Не теряем ещё не показанную картинку, если обновился только текст
+                photo = self._pending[key][1]
+            self._pending[key] = (text, photo, parse_mode)
+
+    def forget(self, chat_id, message_id):
+        """Отменяет неотправленные обновления (например, сообщение удалено)"""
+        with self._lock:
+            self._pending.pop((chat_id, message_id), None)
+
+    def _take_due(self):
+        """Забирает обновления, которые уже можно отправить"""
+        now = time.monotonic()
+        with self._lock:
+            if now < self._blocked_until:
+                return []
+            due = []
+            for key in list(self._pending):
+                chat_id = key[0]
+                if now - self._last_edit.get(chat_id, 0.0) < self.min_interval:
+                    continue
+                due.append((key, self._pending.pop(key)))
+                self._last_edit[chat_id] = now
+            return due
+
+    def _requeue(self, key, update):
+        """Возвращает обновление в очередь, если его не вытеснило более новое"""
+        with self._lock:
+            self._pending.setdefault(key, update)
+
+    async def flush(self, context):
+        """Отправляет накопленные обновления (callback для job_queue)"""
+        for key, update in self._take_due():
+            chat_id, message_id = key
+            text, photo, parse_mode = update
+            try:
+                if photo is not None:
+                    await context.bot.edit_message_media(
+                        chat_id=chat_id,
+                        message_id=message_id,
+                        media=InputMediaPhoto(photo, caption=text, parse_mode=parse_mode)
+                    )
+                else:
+                    await context.bot.edit_message_text(
+                        chat_id=chat_id,
+                        message_id=message_id,
+                        text=text,
+                        parse_mode=parse_mode
+                    )
+            except RetryAfter as e:
+                logger.warning(f"⏳ Flood-wait {e.retry_after} сек - откладываю обновления прогресса")
+                with self._lock:
+                    self._blocked_until = time.monotonic() + e.retry_after
+                self._requeue(key, update)
+            except BadRequest as e:
+                if "not modified" not in str(e).lower():
+                    # Сообщение удалено или его нельзя редактировать - больше не пытаемся
+                    logger.warning(f"⚠️ Прогресс для chat_id={chat_id} не обновлён: {e}")
+            except Exception as e:
+                logger.warning(f"⚠️ Ошибка обновления прогресса для chat_id={chat_id}: {e}")
+
+    def start(self, job_queue, interval=PROGRESS_FLUSH_INTERVAL):
+        """Запускает периодическую отправку через job_queue"""
+        job_queue.run_repeating(self.flush, interval=interval, first=interval, name='progress_flush')
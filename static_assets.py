@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Реестр статичных картинок бота (welcome.jpg и т.п.)
+
+Каждая картинка загружается в Telegram один раз, её file_id сохраняется
+в БД по хэшу файла - дальше отправляется только file_id.
+Если файл поменялся, у него другой хэш - он загрузится заново.
+"""
+
+import hashlib
+import logging
+import os
+import threading
+
+from telegram.error import BadRequest
+
+logger = logging.getLogger(__name__)
+
+
+class StaticAssetRegistry:
+    """Кэш file_id статичных картинок: в памяти и в таблице static_assets"""
+
+    def __init__(self, adb):
+        self.adb = adb
+        self._lock = threading.Lock()
+        self._hashes = {}    # путь -> (mtime, size, sha256)
+        self._file_ids = {}  # sha256 -> file_id
+
+    def file_hash(self, path):
+        """SHA-256 файла (пересчитывается только если файл изменился)"""
+        stat = os.stat(path)
+        with self._lock:
+            cached = self._hashes.get(path)
+            if cached and cached[:2] == (stat.st_mtime, stat.st_size):
+                return cached[2]
+
+        with open(path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+
+        with self._lock:
+            self._hashes[path] = (stat.st_mtime, stat.st_size, digest)
+        return digest
+
+    async def get_file_id(self, file_hash):
+        """file_id из памяти или из БД (None - ещё не загружалась)"""
+        with self._lock:
+            if file_hash in self._file_ids:
+                return self._file_ids[file_hash]
+
+        try:
+            file_id = await self.adb.get_static_asset_file_id(file_hash)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось прочитать static_assets: {e}")
+            return None
+
+        if file_id:
+            with self._lock:
+                self._file_ids[file_hash] = file_id
+        return file_id
+
+    async def remember(self, file_hash, path, file_id):
+        """Запоминает file_id в памяти и в БД"""
+        with self._lock:
+            self._file_ids[file_hash] = file_id
+        try:
+            await self.adb.save_static_asset_file_id(file_hash, path, file_id)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось сохранить file_id {path}: {e}")
+
+    async def forget(self, file_hash):
+        """Удаляет file_id, который Telegram больше не принимает"""
+        with self._lock:
+            self._file_ids.pop(file_hash, None)
+        try:
+            await self.adb.delete_static_asset(file_hash)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось удалить file_id из static_assets: {e}")
+
+    async def send_photo(self, send, path, **kwargs):
+        """
+        Отправляет картинку по file_id, а если его нет - загружает файл
+
+        Args:
+            send: метод отправки фото, например update.message.reply_photo
+                  или functools.partial(bot.send_photo, chat_id)
+            path: путь к картинке
+            kwargs: остальные параметры send (caption, reply_markup, ...)
+        """
+        file_hash = self.file_hash(path)
+        file_id = await self.get_file_id(file_hash)
+
+        if file_id:
+            try:
+                return await send(photo=file_id, **kwargs)
+            except BadRequest as e:
+                logger.warning(f"⚠️ file_id {path} не принят ({e}) - загружаю заново")
+                await self.forget(file_hash)
+
+        with open(path, 'rb') as photo:
+            message = await send(photo=photo, **kwargs)
+
+        if message.photo:
+            # Самый большой размер - он соответствует исходной картинке
+            await self.remember(file_hash, path, message.photo[-1].file_id)
+            logger.info(f"📌 {path} загружен в Telegram, file_id сохранён")
+        return message
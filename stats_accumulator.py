@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Накопление счётчиков дневной статистики (таблица stats)
+
+Каждая оплата или готовая книга раньше делала свой UPSERT в одну и ту же
+строку stats за сегодня - под нагрузкой все писатели ждали друг друга на ней.
+Теперь add() только складывает приращения в памяти, а flush() раз в
+STATS_FLUSH_INTERVAL секунд (и при остановке бота) пишет их одним UPSERT
+на день. Если запись не удалась, приращения возвращаются в накопитель.
+"""
+
+import asyncio
+import logging
+import os
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+STATS_FLUSH_INTERVAL = int(os.environ.get("STATS_FLUSH_INTERVAL", "30"))
+
+STATS_FIELDS = ('new_users', 'total_orders', 'completed_orders', 'revenue')
+
+
+class StatsAccumulator:
+    """Склеивает приращения update_daily_stats в редкие UPSERT'ы"""
+
+    def __init__(self, adb):
+        self.adb = adb
+        self._pending = {}  # день -> {поле: приращение}
+        self._flush_lock = asyncio.Lock()
+
+    def add(self, **deltas):
+        """Прибавить к статистике за сегодня: add(revenue=290), add(completed_orders=1)"""
+        unknown = set(deltas) - set(STATS_FIELDS)
+        if unknown:
+            raise ValueError(f"Неизвестные поля статистики: {', '.join(sorted(unknown))}")
+        self._merge(datetime.now().date(), deltas)
+
+    def _merge(self, day, deltas):
+        counters = self._pending.setdefault(day, dict.fromkeys(STATS_FIELDS, 0))
+        for field, value in deltas.items():
+            counters[field] += value
+
+    async def flush(self):
+        """Записывает накопленное в stats. Возвращает True, если всё записано"""
+        async with self._flush_lock:
+            pending, self._pending = self._pending, {}
+            for day, counters in sorted(pending.items()):
+                if not any(counters.values()):
+                    continue
+                try:
+                    await self.adb.update_daily_stats(day=day, **counters)
+                except Exception as e:
+                    # Не теряем приращения - вернём их и допишем в следующий раз
+                    for rest_day, rest in pending.items():
+                        if rest_day >= day:
+                            self._merge(rest_day, rest)
+                    logger.error(f"📈 Статистика за {day} не записана, повторю позже: {e}")
+                    return False
+            return True
+
+    async def drain(self, attempts=3, delay=1.0):
+        """Финальная запись при остановке: несколько попыток, иначе приращения - в лог"""
+        for attempt in range(attempts):
+            if await self.flush():
+                return True
+            await asyncio.sleep(delay * (attempt + 1))
+        logger.error(f"📈 Статистика не записана при остановке: {self._pending}")
+        return False
+
+    async def flush_job(self, context):
+        """Callback для job_queue"""
+        await self.flush()
+
+    def start(self, job_queue, interval=STATS_FLUSH_INTERVAL):
+        """Запускает периодическую запись через job_queue"""
+        job_queue.run_repeating(self.flush_job, interval=interval, first=interval, name='stats_flush')
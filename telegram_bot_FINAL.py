@@ -7,16 +7,20 @@ Telegram бот для персональных сказок - ИСПРАВЛЕ
 ✅ Добавлена дедупликация уведомлений по order_id
 """
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, InputMediaPhoto
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, 
     CallbackQueryHandler, ContextTypes, filters, ConversationHandler
 )
 import os
 import json
+import io
+import asyncio
 import logging
+import threading
 import traceback
 from telegram.request import HTTPXRequest
+from telegram.error import BadRequest
 
 # ✅ ПАТЧ: Отключаем шумные логи httpx
 logging.getLogger("httpx").setLevel(logging.WARNING)
@@ -38,33 +42,50 @@ def get_main_keyboard():
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
 # Импортируем модули
-from generate_storybook_v2 import create_storybook_v2
-from payment import create_payment, is_payment_successful
+from book_formats import BOOK_VARIANTS, MissingSourcesError, render_variant, restore_book
+from artifact_store import get_artifact_store
+from janitor import janitor_job, JANITOR_INTERVAL
+from workspace import new_photo_path, remove_photo
+from generation_jobs import (
+    GENERATION_MODE, PDF_IN_MEMORY, JOBS_CHANNEL, PROGRESS_CHANNEL, DONE_CHANNEL,
+    order_plan, job_params, order_params, build_book, publish_order_book, upload_photo, load_order_pdf
+)
+from payment import yookassa_client
+from payment_webhook import YOOKASSA_WEBHOOK_ENABLED, YOOKASSA_WEBHOOK_PORT, start_payment_webhook
 from database import db
+from async_database import adb
+from event_log import EventLog
+from stats_accumulator import StatsAccumulator
+from pg_persistence import PostgresPersistence
+from payment_poller import PaymentPoller, PAYMENT_POLL_NOTIFIED_DELAY
+from progress import ProgressReporter
+from static_assets import StaticAssetRegistry
 
-# 📊 АНАЛИТИКА: Счетчики событий
-analytics_cache = {
-    'start': 0,
-    'show_examples': 0, 
-    'how_it_works': 0,
-    'create_story': 0,
-    'theme_chosen': 0,
-    'gender_chosen': 0,
-    'name_entered': 0,
-    'age_entered': 0,
-    'photo_uploaded': 0,
-    'photo_skipped': 0,
-    'payment_created': 0,
-    'payment_completed': 0
-}
+# 🖼️ Общий для всех чатов редактор сообщений с прогрессом (лимиты Telegram)
+progress_reporter = ProgressReporter()
+
+# 📌 Статичные картинки загружаются в Telegram один раз, дальше - по file_id
+static_assets = StaticAssetRegistry(adb)
+
+# ☁️ Книги сохраняются в хранилище артефактов - переживают редеплой
+artifact_store = get_artifact_store()
+
+# 📊 АНАЛИТИКА: события воронки копятся в памяти и пачками пишутся в analytics_events
+event_log = EventLog(adb)
+
+# 📈 Дневная статистика (stats) копится в памяти и пишется одним UPSERT раз в STATS_FLUSH_INTERVAL
+daily_stats = StatsAccumulator(adb)
+
+# 💳 Автопроверка оплаты - одна задача на все платежи (замедляется, если запустились уведомления YooKassa)
+payment_poller = PaymentPoller(adb, yookassa_client.check_payment)
+
+# За сколько дней показывать воронку в /analytics
+FUNNEL_DAYS = 7
 
-# ✅ ПАТЧ: Кеш отправленных уведомлений админу (чтобы не дублировать)
-notified_orders = set()
 
 def log_event(event_name, user_id=None):
-    """Логирование события для аналитики"""
-    analytics_cache[event_name] = analytics_cache.get(event_name, 0) + 1
-    logger.info(f"📊 ANALYTICS: {event_name} | user={user_id}")
+    """Логирование события для аналитики (без запроса к БД - см. event_log.py)"""
+    event_log.log(event_name, user_id)
 
 
 # НАСТРОЙКИ
@@ -86,6 +107,8 @@ BOOK_PRICE_PREMIUM = 390 # Премиум с анализом фото
 
 # 🎁 БЕСПЛАТНЫЕ КРЕДИТЫ ДЛЯ КОМПЕНСАЦИИ
 # Формат: {user_id: количество_бесплатных_книг}
+# Начисляются в таблицу credits при запуске, только если у пользователя ещё нет записи -
+# дальше баланс живёт в БД (/gift, компенсация за 529, списание при заказе)
 FREE_CREDITS = {
     380684465: 1,   # Клиент 1 - 1 бесплатная книга
     1050991384: 1,  # Клиент 2 - 1 бесплатная книга  
@@ -98,6 +121,9 @@ TEST_UNLIMITED_ACCOUNTS = [
     610820340  # Дима - тестирование (неограниченно)
 ]
 
+# 🖼️ Прогресс генерации: миниатюра последней готовой страницы
+THUMBNAIL_SIZE = 512
+
 # Состояния разговора
 CHOOSING_THEME, CHOOSING_GENDER, GETTING_NAME, GETTING_AGE, CHOOSING_VERSION, GETTING_PHOTO, PAYMENT = range(7)
 
@@ -126,21 +152,14 @@ def decline_name_accusative(name, gender):
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Начало работы бота - КРАСИВОЕ ПРИВЕТСТВИЕ"""
     
-    # ✅ ПАТЧ: Останавливаем старые jobs проверки оплаты если есть
-    payment_id = context.user_data.get('payment_id')
-    if payment_id:
-        job_name = f"payment_{payment_id}"
-        current_jobs = context.job_queue.get_jobs_by_name(job_name)
-        for job in current_jobs:
-            job.schedule_removal()
-            logger.info(f"⏹️ Остановлен job проверки платежа {payment_id} при /start")
-    
     # ✅ ПАТЧ: Очищаем user_data для нового флоу
     context.user_data.clear()
     
     # Регистрируем пользователя в БД
     user = update.effective_user
-    db.add_user(user.id, user.username, user.first_name, user.last_name)
+    if await adb.add_user(user.id, user.username, user.first_name, user.last_name):
+        # Новый пользователь - +1 в stats.new_users (отчёты не считают COUNT(*) по users)
+        daily_stats.add(new_users=1)
     log_event('start', user.id)
     
     # Кнопки - ПО ОДНОЙ В РЯД!
@@ -158,26 +177,26 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Отправляем welcome картинку С КНОПКАМИ
     welcome_path = 'welcome.jpg'
     if os.path.exists(welcome_path):
-        with open(welcome_path, 'rb') as photo:
-            await update.message.reply_photo(
-                photo=photo,
-                caption=(
-                    "✨ *Персональная сказка про вашего ребёнка!*\n\n"
-                    "Я создам красочную книгу с AI-иллюстрациями Disney/Pixar качества, "
-                    "где ваш малыш — главный герой волшебного приключения!\n\n"
-                    "📖 *Что вы получите:*\n"
-                    "• 10 страниц с иллюстрациями\n"
-                    "• 8 увлекательных тем на выбор\n"
-                    "• Персонаж похож на вашего ребёнка\n"
-                    "• Профессиональное качество\n"
-                    "• PDF файл для печати\n\n"
-                    f"💰 Цена: {BOOK_PRICE_BASE}₽\n"
-                    "⏱️ Готово за 5 минут\n\n"
-                    "*Выберите действие:*"
-                ),
-                parse_mode='Markdown',
-                reply_markup=main_keyboard  # Постоянная клавиатура
-            )
+        await static_assets.send_photo(
+            update.message.reply_photo,
+            welcome_path,
+            caption=(
+                "✨ *Персональная сказка про вашего ребёнка!*\n\n"
+                "Я создам красочную книгу с AI-иллюстрациями Disney/Pixar качества, "
+                "где ваш малыш — главный герой волшебного приключения!\n\n"
+                "📖 *Что вы получите:*\n"
+                "• 10 страниц с иллюстрациями\n"
+                "• 8 увлекательных тем на выбор\n"
+                "• Персонаж похож на вашего ребёнка\n"
+                "• Профессиональное качество\n"
+                "• PDF файл для печати\n\n"
+                f"💰 Цена: {BOOK_PRICE_BASE}₽\n"
+                "⏱️ Готово за 5 минут\n\n"
+                "*Выберите действие:*"
+            ),
+            parse_mode='Markdown',
+            reply_markup=main_keyboard  # Постоянная клавиатура
+        )
         # Отправляем inline кнопки отдельным сообщением
         await update.message.reply_text(
             "👇 Или используйте кнопки ниже:",
@@ -852,9 +871,10 @@ async def photo_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
     file = await context.bot.get_file(photo.file_id)
     
     # Сохраняем во временную папку
-    photo_path = f"temp_photos/{update.effective_user.id}.jpg"
-    os.makedirs("temp_photos", exist_ok=True)
-    await file.download_to_drive(photo_path)
+    # Уникальное имя на каждое фото, файл появляется только полностью скачанным
+    photo_path = new_photo_path(update.effective_user.id)
+    await file.download_to_drive(photo_path + '.part')
+    os.replace(photo_path + '.part', photo_path)
     
     context.user_data['photo_path'] = photo_path
     
@@ -892,41 +912,53 @@ async def create_payment_step(update: Update, context: ContextTypes.DEFAULT_TYPE
         )
         
         # Создаём заказ в БД
-        order_id = db.create_order(
+        order_id = await adb.create_order(
             user_id=user_id,
             theme=theme,
             child_name=name,
             child_age=age,
             gender=context.user_data['gender'],
-            photo_description=context.user_data.get('photo_description')
+            photo_description=context.user_data.get('photo_description'),
+            plan=order_plan(context.user_data),
+            photo_path=context.user_data.get('photo_path')
         )
         context.user_data['order_id'] = order_id
-        db.update_order_status(order_id, 'paid')
+        await adb.update_order_status(order_id, 'paid')
         
         # Сразу запускаем генерацию
         return await start_generation(update, context)
     
-    elif user_id in FREE_CREDITS and FREE_CREDITS[user_id] > 0:
-        # Есть бесплатный кредит
-        FREE_CREDITS[user_id] -= 1
-        
-        await context.bot.send_message(
-            chat_id=user_id,
-            text=f"🎁 *У вас есть бесплатная книга!*\n\nОсталось: {FREE_CREDITS[user_id]}\n\nЗапускаю создание...",
-            parse_mode='Markdown'
-        )
-        
-        # Создаём заказ в БД
-        order_id = db.create_order(
-            user_id=user_id,
-            theme=theme,
-            child_name=name,
-            child_age=age,
-            gender=context.user_data['gender'],
-            photo_description=context.user_data.get('photo_description')
-        )
-        context.user_data['order_id'] = order_id
-        db.update_order_status(order_id, 'paid')
+    # Атомарно списываем бесплатный кредит (None - кредитов нет)
+    remaining_credits = await adb.redeem_credit(user_id)
+    if remaining_credits is not None:
+        # Есть бесплатный кредит - он уже списан: если оплаченный заказ не создался, возвращаем его
+        try:
+            await context.bot.send_message(
+                chat_id=user_id,
+                text=f"🎁 *У вас есть бесплатная книга!*\n\nОсталось: {remaining_credits}\n\nЗапускаю создание...",
+                parse_mode='Markdown'
+            )
+            
+            # Создаём заказ в БД
+            order_id = await adb.create_order(
+                user_id=user_id,
+                theme=theme,
+                child_name=name,
+                child_age=age,
+                gender=context.user_data['gender'],
+                photo_description=context.user_data.get('photo_description'),
+                plan=order_plan(context.user_data),
+                photo_path=context.user_data.get('photo_path')
+            )
+            context.user_data['order_id'] = order_id
+            await adb.update_order_status(order_id, 'paid')
+        except Exception as e:
+            logger.error(f"❌ Заказ по бесплатному кредиту не создан (user {user_id}): {e} - возвращаю кредит")
+            try:
+                await adb.add_credits(user_id, 1)
+            except Exception as refund_error:
+                logger.error(f"❌ Кредит user {user_id} не возвращён - начислите вручную (/gift): {refund_error}")
+            raise
         
         # Сразу запускаем генерацию
         return await start_generation(update, context)
@@ -940,19 +972,21 @@ async def create_payment_step(update: Update, context: ContextTypes.DEFAULT_TYPE
         return ConversationHandler.END
     
     # Создаём заказ в БД
-    order_id = db.create_order(
+    order_id = await adb.create_order(
         user_id=user_id,
         theme=theme,
         child_name=name,
         child_age=age,
         gender=context.user_data['gender'],
-        photo_description=context.user_data.get('photo_description')
+        photo_description=context.user_data.get('photo_description'),
+        plan=order_plan(context.user_data),
+        photo_path=context.user_data.get('photo_path')
     )
     
     context.user_data['order_id'] = order_id
     
     # Создаём платеж
-    payment_data = create_payment(
+    payment_data = await yookassa_client.create_payment(
         amount=price,
         description=f"Персональная сказка - {theme_name}",
         return_url=f"https://t.me/{BOT_USERNAME}"
@@ -969,7 +1003,7 @@ async def create_payment_step(update: Update, context: ContextTypes.DEFAULT_TYPE
     context.user_data['payment_id'] = payment_data['id']
     
     # Сохраняем платёж в БД
-    db.create_payment(
+    await adb.create_payment(
         payment_id=payment_data['id'],
         order_id=order_id,
         user_id=user_id,
@@ -1013,112 +1047,136 @@ async def create_payment_step(update: Update, context: ContextTypes.DEFAULT_TYPE
         )
     )
     
-    # ✅ ПАТЧ: Запускаем автопроверку с уникальным именем
-    job_name = f"payment_{payment_data['id']}"
-    
-    # Удаляем старую задачу если она есть
-    current_jobs = context.job_queue.get_jobs_by_name(job_name)
-    for job in current_jobs:
-        job.schedule_removal()
-    
-    # Создаём новую задачу автопроверки
-    context.job_queue.run_repeating(
-        check_payment_status,
-        interval=10,
-        first=10,
-        data={
-            'payment_id': payment_data['id'],
-            'chat_id': user_id,
-            'user_data': context.user_data.copy(),
-            'order_id': order_id,
-            'attempts': 0,  # ✅ ПАТЧ: Счётчик попыток
-            'max_attempts': 60  # ✅ ПАТЧ: Максимум 10 минут (60 * 10 сек)
-        },
-        name=job_name
-    )
-    
     return PAYMENT
 
 
-async def check_payment_status(context: ContextTypes.DEFAULT_TYPE):
-    """Автоматическая проверка статуса платежа"""
-    from telegram.error import Forbidden
+async def confirm_payment(bot, payment_id):
+    """
+    Оплата прошла: заказ -> paid, уведомление админу, генерация книги
+    
+    Одну оплату могут подтвердить уведомление YooKassa, автопроверка и /check -
+    обрабатывает её только тот, кто первым перевёл платёж в succeeded.
+    
+    Returns:
+        True, если оплата обработана этим вызовом
+    """
+    payment = await adb.get_payment(payment_id)
+    if not payment:
+        logger.warning(f"⚠️ Платёж {payment_id} не найден в БД")
+        return False
     
-    job = context.job
-    payment_id = job.data['payment_id']
-    chat_id = job.data['chat_id']
-    user_data = job.data['user_data']
-    order_id = job.data['order_id']
+    if not await adb.update_payment_status(payment_id, 'succeeded'):
+        logger.info(f"⏭️ Платёж {payment_id} уже обработан")
+        return False
     
-    # ✅ ПАТЧ: Проверяем таймаут
-    attempts = job.data.get('attempts', 0)
-    max_attempts = job.data.get('max_attempts', 60)
+    order_id, user_id, amount = payment['order_id'], payment['user_id'], payment['amount']
+    await adb.update_order_status(order_id, 'paid')
+    daily_stats.add(revenue=amount)
+    log_event('payment_completed', user_id)
     
-    # Увеличиваем счётчик
-    job.data['attempts'] = attempts + 1
+    # Платёж уже succeeded - повторно его никто не обработает, поэтому сбой
+    # уведомлений (пользователь заблокировал бота, сеть) не должен остановить генерацию
+    try:
+        await bot.send_message(
+            chat_id=user_id,
+            text="✅ *Оплата получена!*\n\nЗапускаю генерацию книги...",
+            parse_mode='Markdown'
+        )
+    except Exception as e:
+        logger.error(f"Не удалось сообщить об оплате пользователю {user_id}: {e}")
+    
+    try:
+        user = await adb.get_user(user_id) or {}
+        user_name = user.get('first_name') or user.get('username') or "Аноним"
+        await notify_admin_payment(bot, user_id, user_name, order_id, amount)
+    except Exception as e:
+        logger.error(f"Не удалось уведомить админа о заказе #{order_id}: {e}")
     
-    # Если превышен таймаут - останавливаем
-    if attempts >= max_attempts:
-        logger.info(f"⏱️ Таймаут автопроверки для payment_id={payment_id} (превышено {max_attempts} попыток)")
-        job.schedule_removal()
+    order = await adb.get_order(order_id)
+    logger.info(f"📤 Запускаю генерацию для заказа #{order_id}, user={user_id}")
+    await start_generation_for_order(bot, user_id, order_id, order_params(order))
+    return True
+
+
+async def cancel_payment(bot, payment_id):
+    """Платёж отменён (не оплачен вовремя или отклонён банком)"""
+    payment = await adb.get_payment(payment_id)
+    if not payment or not await adb.update_payment_status(payment_id, 'canceled'):
         return
     
+    await adb.update_order_status(payment['order_id'], 'canceled')
     try:
-        # Проверяем статус
-        if is_payment_successful(payment_id):
-            # Оплата прошла!
-            await context.bot.send_message(
+        await bot.send_message(
+            chat_id=payment['user_id'],
+            text="❌ Оплата не прошла или была отменена.\n\nНажмите /start, чтобы попробовать ещё раз."
+        )
+    except Exception as e:
+        logger.error(f"Не удалось сообщить об отмене платежа {payment_id}: {e}")
+
+
+async def on_payment_notification(bot, payment_id, status):
+    """Проверенное уведомление YooKassa (см. payment_webhook.py)"""
+    try:
+        if status == 'succeeded':
+            await confirm_payment(bot, payment_id)
+        elif status == 'canceled':
+            await cancel_payment(bot, payment_id)
+    except Exception as e:
+        logger.error(f"❌ Ошибка обработки уведомления о платеже {payment_id}: {e}", exc_info=True)
+
+
+def make_thumbnail(image_path):
+    """Уменьшенная копия страницы для показа прогресса (JPEG в памяти)"""
+    from PIL import Image
+    with Image.open(image_path) as img:
+        img.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        buffer = io.BytesIO()
+        img.convert('RGB').save(buffer, 'JPEG', quality=80)
+    return buffer.getvalue()
+
+
+async def send_order_pdf(bot, chat_id, pdf_path, order_id=None, file_id=None, filename=None,
+                         caption=None, parse_mode=None, pdf_buffer=None):
+    """
+    Отправляет PDF заказа
+    
+    Если есть file_id от прошлой отправки - файл не загружается заново.
+    Иначе (или если Telegram не принял file_id) PDF загружается из pdf_buffer
+    (io.BytesIO, если книга собрана в памяти) или с диска, а новый file_id
+    сохраняется в заказе
+    """
+    if file_id:
+        try:
+            return await bot.send_document(chat_id=chat_id, document=file_id,
+                                           caption=caption, parse_mode=parse_mode)
+        except BadRequest as e:
+            logger.warning(f"⚠️ file_id заказа #{order_id} не принят ({e}) - загружаю PDF заново")
+    
+    if pdf_buffer is not None:
+        pdf_buffer.seek(0)
+        message = await bot.send_document(
+            chat_id=chat_id,
+            document=pdf_buffer,
+            filename=filename or os.path.basename(pdf_path),
+            caption=caption,
+            parse_mode=parse_mode
+        )
+    else:
+        with open(pdf_path, 'rb') as pdf_file:
+            message = await bot.send_document(
                 chat_id=chat_id,
-                text="✅ *Оплата получена!*\n\nЗапускаю генерацию книги...",
-                parse_mode='Markdown'
+                document=pdf_file,
+                filename=filename or os.path.basename(pdf_path),
+                caption=caption,
+                parse_mode=parse_mode
             )
-            
-            # Обновляем статусы в БД
-            db.update_payment_status(payment_id, 'succeeded')
-            db.update_order_status(order_id, 'paid')
-            db.update_daily_stats(revenue=BOOK_PRICE_BASE)
-            
-            # ✅ ПАТЧ: Уведомляем админа ТОЛЬКО ОДИН РАЗ
-            if order_id not in notified_orders:
-                user_name = user_data.get('name', 'Аноним')
-                user_id = chat_id
-                await notify_admin_payment(context, user_id, user_name, order_id, BOOK_PRICE_BASE)
-                notified_orders.add(order_id)  # Помечаем что уведомление отправлено
-                logger.info(f"✅ Админ уведомлён о заказе #{order_id}")
-            else:
-                logger.info(f"⏭️ Пропускаю дублирующее уведомление для заказа #{order_id}")
-            
-            # Останавливаем проверку
-            job.schedule_removal()
-            logger.info(f"⏹️ Автопроверка остановлена для payment_id={payment_id}")
-            
-            # Запускаем генерацию
-            # Создаём временный объект для передачи в start_generation
-            class TempUpdate:
-                def __init__(self, chat_id):
-                    self.effective_user = type('obj', (object,), {'id': chat_id})
-                    self.callback_query = None
-                    self.message = type('obj', (object,), {'chat_id': chat_id})
-            
-            class TempContext:
-                def __init__(self, bot, user_data):
-                    self.bot = bot
-                    self.user_data = user_data
-            
-            temp_update = TempUpdate(chat_id)
-            temp_context = TempContext(context.bot, user_data)
-            
-            logger.info(f"📤 Запускаю генерацию для заказа #{order_id}, user={user_id}")
-            await start_generation(temp_update, temp_context)
-            logger.info(f"✅ Генерация завершена для заказа #{order_id}")
-    
-    except Forbidden:
-        # Пользователь заблокировал бота - останавливаем проверку
-        logger.info(f"Пользователь {chat_id} заблокировал бота. Останавливаем проверку оплаты {payment_id}")
-        job.schedule_removal()
-    except Exception as e:
-        # Другие ошибки - логируем
-        logger.error(f"Ошибка проверки оплаты {payment_id}: {e}")
+    
+    if order_id and message.document:
+        try:
+            await adb.set_order_pdf_file_id(order_id, message.document.file_id)
+        except Exception as e:
+            logger.error(f"Не удалось сохранить file_id заказа #{order_id}: {e}")
+    return message
 
 
 async def start_generation(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1126,22 +1184,6 @@ async def start_generation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     logger.info("🚀 start_generation вызвана")
     
-    # Получаем данные
-    name = context.user_data['name']
-    age = context.user_data['age']
-    gender = context.user_data['gender']
-    theme = context.user_data['theme']
-    photo_path = context.user_data.get('photo_path')
-    order_id = context.user_data.get('order_id')
-    
-    # Склоняем имя
-    name_accusative = decline_name_accusative(name, gender)
-    
-    # Загружаем название темы
-    with open('all_themes_stories.json', 'r', encoding='utf-8') as f:
-        themes = json.load(f)
-    theme_name = themes[theme]["name"]
-    
     # Определяем chat_id
     if hasattr(update, 'callback_query') and update.callback_query:
         chat_id = update.callback_query.message.chat_id
@@ -1150,138 +1192,314 @@ async def start_generation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         chat_id = update.effective_user.id
     
-    status_message = await context.bot.send_message(
-        chat_id=chat_id,
-        text=f"⏳ *Создаю сказку про {name_accusative}...*\n\n"
-             f"📖 Тема: {theme_name}\n"
-             f"✅ Выбрана история\n"
-             f"🎨 Рисую 10 иллюстраций...\n"
-             f"📄 Соберу PDF книгу\n\n"
-             f"_Это займёт примерно 5 минут_",
-        parse_mode='Markdown'
-    )
+    # Получаем данные
+    params = job_params(context.user_data, context.user_data.get('user_id') or chat_id)
+    order_id = context.user_data.get('order_id')
+    await start_generation_for_order(context.bot, chat_id, order_id, params)
+
+
+async def start_generation_for_order(bot, chat_id, order_id, params):
+    """
+    Запускает книгу заказа: ставит в очередь или начинает сборку в фоне
+    
+    Возвращается сразу - результат придёт в chat_id
+    """
+    
+    # Склоняем имя
+    name_accusative = decline_name_accusative(params['name'], params['gender'])
+    theme_name = get_theme_name(params['theme'])
     
     try:
-        # Определяем plan из user_data
-        version = context.user_data.get('version', 'base')
-        plan = 'premium' if version == 'premium' else 'standard'
-        
-        logger.info(f"🎨 Генерация: plan={plan}, photo={'есть' if photo_path else 'нет'}")
-        
-        # ГЕНЕРИРУЕМ КНИГУ
-        pdf_path = create_storybook_v2(
-            child_name=name,
-            child_age=age,
-            gender=gender,
-            theme_id=theme,
-            photo_path=photo_path,
-            plan=plan  # ✅ ПЕРЕДАЁМ ПЛАН ДЛЯ PREMIUM ПЕРСОНАЖА
+        status_message = await bot.send_message(
+            chat_id=chat_id,
+            text=f"⏳ *Создаю сказку про {name_accusative}...*\n\n"
+                 f"📖 Тема: {theme_name}\n"
+                 f"✅ Выбрана история\n"
+                 f"🎨 Рисую 10 иллюстраций...\n"
+                 f"📄 Соберу PDF книгу\n\n"
+                 f"_Это займёт примерно 5 минут_",
+            parse_mode='Markdown'
         )
-        
-        # Обновляем заказ в БД
-        if order_id:
-            db.update_order_status(order_id, 'completed', pdf_path)
-            db.update_daily_stats(completed_orders=1)
-        
-        # Удаляем статусное сообщение
-        logger.info(f"🗑️ Удаляю статусное сообщение для chat_id={chat_id}")
-        await status_message.delete()
-        
-        # Отправляем PDF
-        logger.info(f"📤 Отправляю PDF: {pdf_path} для chat_id={chat_id}")
-        with open(pdf_path, 'rb') as pdf_file:
-            await context.bot.send_document(
-                chat_id=chat_id,
-                document=pdf_file,
+        status_message_id = status_message.message_id
+    except Exception as e:
+        # Книгу всё равно собираем - она сохранится в заказе (админ отправит через /getpdf)
+        logger.error(f"Не удалось отправить статус генерации в чат {chat_id}: {e}")
+        status_message_id = None
+    
+    if GENERATION_MODE == 'queue':
+        # 🏭 Книгу соберёт generation_worker.py, результат придёт через NOTIFY generation_done
+        await enqueue_generation(chat_id, order_id, status_message_id, params)
+        return
+    
+    # Сборка идёт ~5 минут - в фоне, чтобы хендлер сразу вернулся (PTB обрабатывает апдейты по очереди)
+    run_in_background(build_and_deliver(bot, chat_id, order_id, params, status_message_id))
+
+
+# Фоновые задачи бота (сборка книг) - держим ссылки, чтобы их не собрал GC
+background_tasks = set()
+
+
+def run_in_background(coro):
+    """Запускает корутину в фоне, ошибки - в лог"""
+    async def run():
+        try:
+            await coro
+        except Exception as e:
+            logger.error(f"❌ Ошибка фоновой задачи: {e}", exc_info=True)
+    
+    task = asyncio.get_running_loop().create_task(run())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+async def build_and_deliver(bot, chat_id, order_id, params, status_message_id):
+    """Собирает книгу в этом процессе (GENERATION_MODE=inline) и отправляет её"""
+    
+    # 🖼️ Показываем готовые страницы по мере генерации: "3/10 готово" + миниатюра
+    # state: idle -> sending -> sent (или failed - прогресс не показываем)
+    progress = {'state': 'idle', 'message_id': None, 'latest': None}
+    progress_lock = threading.Lock()
+    loop = asyncio.get_running_loop()
+    
+    def on_progress_sent(future):
+        # Event loop: первое фото прогресса отправлено (или нет)
+        with progress_lock:
+            if future.cancelled() or future.exception() is not None:
+                logger.warning(f"⚠️ Прогресс генерации для chat_id={chat_id} не показан: "
+                               f"{None if future.cancelled() else future.exception()}")
+                progress['state'] = 'failed'
+                return
+            progress['state'] = 'sent'
+            progress['message_id'] = future.result().message_id
+            latest, progress['latest'] = progress['latest'], None
+        if latest:
+            progress_reporter.update(chat_id, progress['message_id'], latest[0],
+                                     photo=latest[1], parse_mode='Markdown')
+    
+    def on_scene_ready(done, total, image_path):
+        # Вызывается из потока генерации и никогда не ждёт Telegram: первое фото уходит
+        # через event loop, дальше новое состояние получает progress_reporter
+        caption = progress_caption(done, total)
+        thumbnail = make_thumbnail(image_path)
+        
+        with progress_lock:
+            state = progress['state']
+            if state == 'idle':
+                progress['state'] = 'sending'
+            elif state == 'sending':
+                progress['latest'] = (caption, thumbnail)
+        
+        if state == 'idle':
+            future = asyncio.run_coroutine_threadsafe(
+                bot.send_photo(chat_id=chat_id, photo=thumbnail, caption=caption, parse_mode='Markdown'),
+                loop
+            )
+            future.add_done_callback(on_progress_sent)
+        elif state == 'sent':
+            progress_reporter.update(chat_id, progress['message_id'], caption,
+                                     photo=thumbnail, parse_mode='Markdown')
+    
+    # ГЕНЕРИРУЕМ КНИГУ (в отдельном потоке - event loop свободен для других пользователей)
+    pdf_buffer = io.BytesIO() if PDF_IN_MEMORY else None
+    result = await build_book(adb, order_id, params,
+                              on_scene_ready=on_scene_ready, pdf_buffer=pdf_buffer)
+    publish = None
+    if result['ok'] and order_id:
+        daily_stats.add(completed_orders=1)
+        # ☁️ В хранилище загружаем параллельно с отправкой - пользователь её не ждёт
+        publish = asyncio.create_task(
+            publish_order_book(adb, artifact_store, order_id, result['pdf_path'], pdf_buffer))
+    
+    message_ids = [status_message_id] if status_message_id else []
+    if progress['message_id']:
+        message_ids.append(progress['message_id'])
+    await deliver_generation_result(bot, chat_id, order_id, params, result,
+                                    message_ids=message_ids, pdf_buffer=pdf_buffer)
+    if publish is not None:
+        await publish
+
+
+def get_theme_name(theme):
+    """Название темы для сообщений"""
+    with open('all_themes_stories.json', 'r', encoding='utf-8') as f:
+        themes = json.load(f)
+    return themes[theme]["name"]
+
+
+def progress_caption(done, total):
+    """Подпись прогресса генерации: 3/10 готово"""
+    if done < total:
+        return f"🎨 *{done}/{total} готово*\n\n_Рисую следующие страницы..._"
+    return f"🎨 *{done}/{total} готово*\n\n📄 _Собираю PDF книгу..._"
+
+
+async def deliver_generation_result(bot, chat_id, order_id, params, result, message_ids=(), pdf_buffer=None):
+    """
+    Отправляет пользователю готовую книгу или сообщение об ошибке
+    
+    Args:
+        result: результат generation_jobs.build_book
+        message_ids: статусные сообщения и прогресс - удаляются
+        pdf_buffer: PDF, если он собран в памяти этого процесса
+    """
+    name = params['name']
+    
+    # Удаляем статусное сообщение и прогресс
+    logger.info(f"🗑️ Удаляю статусное сообщение для chat_id={chat_id}")
+    for message_id in message_ids:
+        progress_reporter.forget(chat_id, message_id)
+        try:
+            await bot.delete_message(chat_id=chat_id, message_id=message_id)
+        except Exception:
+            pass
+    
+    if result['ok']:
+        pdf_path = result['pdf_path']
+        try:
+            if pdf_buffer is None:
+                # Книгу собрал воркер на другой машине - PDF берём из хранилища артефактов
+                pdf_buffer = await load_order_pdf(adb, artifact_store, order_id, pdf_path)
+            
+            # Отправляем PDF
+            logger.info(f"📤 Отправляю PDF: {pdf_path} для chat_id={chat_id}")
+            await send_order_pdf(
+                bot,
+                chat_id,
+                pdf_path,
+                order_id=order_id,
                 filename=f"{name}_сказка.pdf",
                 caption=f"🎉 *Ваша сказка готова!*\n\n"
-                        f"📖 \"{name} - {theme_name}\"\n\n"
+                        f"📖 \"{name} - {get_theme_name(params['theme'])}\"\n\n"
                         f"Расскажите друзьям! 🎁",
-                parse_mode='Markdown'
+                parse_mode='Markdown',
+                pdf_buffer=pdf_buffer
             )
-        logger.info(f"✅ PDF отправлен успешно для chat_id={chat_id}")
-        
-        # Удаляем временное фото если было
-        if photo_path and os.path.exists(photo_path):
-            os.remove(photo_path)
-        
-    except Exception as e:
-        logger.error(f"❌ Ошибка в start_generation: {e}")
-        logger.error(f"Traceback:", exc_info=True)
-        
-        error_details = str(e)
-        is_overloaded = "529" in error_details or "overloaded" in error_details.lower()
-        
-        # ✅ ВАЖНО: Помечаем заказ как неудачный
-        if order_id:
-            db.update_order_status(order_id, 'failed')
-            logger.info(f"❌ Заказ #{order_id} помечен как failed")
-        
-        # ✅ Если ошибка 529 - автоматически даём бесплатный кредит
-        if is_overloaded:
-            user_id = context.user_data.get('user_id') or chat_id
-            if user_id in FREE_CREDITS:
-                FREE_CREDITS[user_id] += 1
+            logger.info(f"✅ PDF отправлен успешно для chat_id={chat_id}")
+            return
+        except Exception as e:
+            # Книга готова и лежит в заказе - админ может отправить её через /getpdf
+            logger.error(f"❌ Не удалось отправить PDF заказа #{order_id}: {e}", exc_info=True)
+            result = {'ok': False, 'error': f"PDF не отправлен: {e}", 'overloaded': False}
+    
+    error_details = result['error']
+    is_overloaded = result['overloaded']
+    
+    # ✅ Уведомляем админа о проблеме
+    if ADMIN_ID and ADMIN_ID > 0:
+        try:
+            if is_overloaded:
+                admin_message = (
+                    f"⚠️ *ОШИБКА: СЕРВЕР ПЕРЕГРУЖЕН (529)*\n\n"
+                    f"👤 Пользователь: {name}\n"
+                    f"📝 Заказ: #{order_id}\n"
+                    f"❌ Ошибка: Anthropic API перегружен\n\n"
+                    f"✅ *Автоматически выдан бесплатный кредит*\n"
+                    f"Пользователь может попробовать позже бесплатно."
+                )
             else:
-                FREE_CREDITS[user_id] = 1
-            logger.info(f"🎁 Автоматически выдан бесплатный кредит пользователю {user_id} из-за перегрузки")
-        
-        # ✅ Уведомляем админа о проблеме
-        if ADMIN_ID and ADMIN_ID > 0:
-            try:
-                if is_overloaded:
-                    admin_message = (
-                        f"⚠️ *ОШИБКА: СЕРВЕР ПЕРЕГРУЖЕН (529)*\n\n"
-                        f"👤 Пользователь: {name}\n"
-                        f"📝 Заказ: #{order_id}\n"
-                        f"❌ Ошибка: Anthropic API перегружен\n\n"
-                        f"✅ *Автоматически выдан бесплатный кредит*\n"
-                        f"Пользователь может попробовать позже бесплатно."
-                    )
-                else:
-                    admin_message = (
-                        f"⚠️ *ОШИБКА ГЕНЕРАЦИИ*\n\n"
-                        f"👤 Пользователь: {name}\n"
-                        f"📝 Заказ: #{order_id}\n"
-                        f"❌ Ошибка: `{error_details[:200]}`\n\n"
-                        f"_Нужно вернуть деньги вручную!_"
-                    )
-                
-                await context.bot.send_message(
-                    chat_id=ADMIN_ID,
-                    text=admin_message,
-                    parse_mode='Markdown'
+                admin_message = (
+                    f"⚠️ *ОШИБКА ГЕНЕРАЦИИ*\n\n"
+                    f"👤 Пользователь: {name}\n"
+                    f"📝 Заказ: #{order_id}\n"
+                    f"❌ Ошибка: `{error_details[:200]}`\n\n"
+                    f"_Нужно вернуть деньги вручную!_"
                 )
-            except Exception as notify_error:
-                logger.error(f"Ошибка уведомления админа: {notify_error}")
-        
-        # Удаляем статусное сообщение
-        try:
-            await status_message.delete()
-        except:
-            pass
-        
-        # Сообщаем пользователю
-        if is_overloaded:
-            user_message = (
-                f"⚠️ *Сервер временно перегружен*\n\n"
-                f"Извините! Наши серверы не смогли обработать запрос.\n\n"
-                f"🎁 *Мы подарили вам бесплатную книгу!*\n\n"
-                f"Попробуйте создать книгу ещё раз через 5-10 минут.\n"
-                f"Оплата не потребуется!"
-            )
-        else:
-            user_message = (
-                f"❌ Произошла ошибка при создании книги:\n\n`{error_details}`\n\n"
-                f"⚠️ *Мы вернём вам деньги в течение 24 часов.*\n\n"
-                f"Извините за неудобства! Напишите в поддержку если есть вопросы."
+            
+            await bot.send_message(
+                chat_id=ADMIN_ID,
+                text=admin_message,
+                parse_mode='Markdown'
             )
-        
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text=user_message,
-            parse_mode='Markdown'
+        except Exception as notify_error:
+            logger.error(f"Ошибка уведомления админа: {notify_error}")
+    
+    # Сообщаем пользователю
+    if is_overloaded:
+        user_message = (
+            f"⚠️ *Сервер временно перегружен*\n\n"
+            f"Извините! Наши серверы не смогли обработать запрос.\n\n"
+            f"🎁 *Мы подарили вам бесплатную книгу!*\n\n"
+            f"Попробуйте создать книгу ещё раз через 5-10 минут.\n"
+            f"Оплата не потребуется!"
         )
+    else:
+        user_message = (
+            f"❌ Произошла ошибка при создании книги:\n\n`{error_details}`\n\n"
+            f"⚠️ *Мы вернём вам деньги в течение 24 часов.*\n\n"
+            f"Извините за неудобства! Напишите в поддержку если есть вопросы."
+        )
+    
+    await bot.send_message(
+        chat_id=chat_id,
+        text=user_message,
+        parse_mode='Markdown'
+    )
+
+
+# ===== ОЧЕРЕДЬ ГЕНЕРАЦИИ (GENERATION_MODE=queue) =====
+
+async def enqueue_generation(chat_id, order_id, status_message_id, params):
+    """Ставит книгу в очередь generation_jobs (воркеры просыпаются по NOTIFY)"""
+    params = dict(params)
+    photo_path = params.get('photo_path')
+    if photo_path and artifact_store is not None:
+        # Воркер может работать на другой машине - фото передаём через хранилище
+        params['photo_hash'] = await asyncio.to_thread(upload_photo, artifact_store, photo_path)
+        params['photo_path'] = None
+        remove_photo(photo_path)
+    
+    job_id = await adb.enqueue_generation_job(order_id, chat_id, status_message_id, params, JOBS_CHANNEL)
+    if job_id is None:
+        logger.info(f"⏭️ Заказ #{order_id} уже в очереди генерации")
+    else:
+        logger.info(f"🏭 Заказ #{order_id} поставлен в очередь генерации (задание #{job_id})")
+
+
+async def deliver_generation_job(bot, job_id):
+    """Отправляет результат задания (ровно один раз - даже если пришло и NOTIFY, и проверка)"""
+    job = await adb.claim_generation_delivery(job_id)
+    if not job:
+        return
+    
+    result = {'ok': job['status'] == 'done', 'pdf_path': job['pdf_path'],
+              'error': job['error'] or 'Неизвестная ошибка', 'overloaded': job['overloaded']}
+    message_ids = [job['status_message_id']] if job['status_message_id'] else []
+    await deliver_generation_result(bot, job['chat_id'], job['order_id'], job['params'], result,
+                                    message_ids=message_ids)
+
+
+generation_listener = {'conn': None}
+
+
+async def listen_generation_events(application):
+    """LISTEN на прогресс и готовность заданий (отдельное подключение к БД)"""
+    def on_progress(payload):
+        event = json.loads(payload)
+        progress_reporter.update(event['chat_id'], event['message_id'],
+                                 progress_caption(event['done'], event['total']), parse_mode='Markdown')
+    
+    def on_done(payload):
+        application.create_task(deliver_generation_job(application.bot, int(payload)))
+    
+    generation_listener['conn'] = await adb.listen({PROGRESS_CHANNEL: on_progress, DONE_CHANNEL: on_done})
+    logger.info("🏭 Жду результатов от воркеров генерации")
+
+
+async def generation_results_job(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Страховка для NOTIFY: отправляет результаты, пропущенные, пока бот
+    был остановлен, и переподключает LISTEN, если подключение потеряно
+    """
+    conn = generation_listener['conn']
+    if conn is None or conn.is_closed():
+        try:
+            await listen_generation_events(context.application)
+        except Exception as e:
+            logger.error(f"❌ Не удалось подписаться на события генерации: {e}")
+    
+    for job_id in await adb.get_undelivered_generation_jobs():
+        await deliver_generation_job(context.bot, job_id)
 
 
 async def check_payment_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1293,35 +1511,16 @@ async def check_payment_command(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.reply_text("❌ Нет активного платежа")
         return
     
-    if is_payment_successful(payment_id):
-        await update.message.reply_text(
-            "✅ Оплата получена! Запускаю генерацию..."
-        )
-        
-        # Обновляем БД
-        order_id = context.user_data.get('order_id')
-        if order_id:
-            db.update_payment_status(payment_id, 'succeeded')
-            db.update_order_status(order_id, 'paid')
-            db.update_daily_stats(revenue=BOOK_PRICE_BASE)
-            
-            # ✅ ПАТЧ: Уведомляем админа ТОЛЬКО ОДИН РАЗ
-            if order_id not in notified_orders:
-                user_name = update.effective_user.first_name or update.effective_user.username or "Аноним"
-                await notify_admin_payment(context, update.effective_user.id, user_name, order_id, BOOK_PRICE_BASE)
-                notified_orders.add(order_id)
-                logger.info(f"✅ Админ уведомлён о заказе #{order_id} (manual check)")
-            else:
-                logger.info(f"⏭️ Пропускаю дублирующее уведомление для заказа #{order_id} (manual check)")
-        
-        await start_generation(update, context)
+    if await yookassa_client.is_payment_successful(payment_id):
+        if not await confirm_payment(context.bot, payment_id):
+            await update.message.reply_text("✅ Оплата уже получена - книга создаётся!")
     else:
         await update.message.reply_text(
             "⏳ Платёж ещё не завершён. Пожалуйста, завершите оплату."
         )
 
 
-async def notify_admin_payment(context, user_id, user_name, order_id, amount):
+async def notify_admin_payment(bot, user_id, user_name, order_id, amount):
     """Отправить уведомление админу о новой покупке"""
     if ADMIN_ID and ADMIN_ID > 0:
         try:
@@ -1336,7 +1535,7 @@ async def notify_admin_payment(context, user_id, user_name, order_id, amount):
 
 🎨 Генерация началась автоматически!"""
             
-            await context.bot.send_message(
+            await bot.send_message(
                 chat_id=ADMIN_ID,
                 text=notification_text,
                 parse_mode='Markdown'
@@ -1355,34 +1554,14 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     try:
-        # Подключаемся к БД
-        conn = db.get_connection()
-        cursor = conn.cursor()
-        
-        # Статистика пользователей
-        cursor.execute("SELECT COUNT(*) FROM users")
-        total_users = cursor.fetchone()[0]
-        
-        # Статистика заказов
-        cursor.execute("SELECT COUNT(*) FROM orders")
-        total_orders = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM orders WHERE status = 'paid' OR status = 'completed'")
-        paid_orders = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM orders WHERE status = 'pending'")
-        pending_orders = cursor.fetchone()[0]
-        
-        # ✅ НОВОЕ: Проблемные заказы
-        cursor.execute("SELECT COUNT(*) FROM orders WHERE status = 'failed'")
-        failed_orders = cursor.fetchone()[0]
-        
-        # Доход - считаем количество оплаченных × цена
-        # Предполагаем что все заказы по базовой цене 290₽
-        revenue = paid_orders * BOOK_PRICE_BASE
-        
-        cursor.close()
-        conn.close()
+        # Одна сводка по stats_rollup вместо COUNT(*) по таблицам
+        total = (await adb.get_stats_report())['total']
+        total_users = total['total_users']
+        total_orders = total['total_orders']
+        paid_orders = total['paid_orders']
+        pending_orders = total['pending_orders']
+        failed_orders = total['failed_orders']
+        revenue = total['revenue']
         
         # Конверсии
         conv_order = (total_orders / total_users * 100) if total_users > 0 else 0
@@ -1399,6 +1578,7 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • Оплачено: {paid_orders}
 • Ожидают оплату: {pending_orders}
 • ⚠️ Проблемные: {failed_orders}
+• Сегодня: {total['orders_today']}
 
 💰 *Доход:* {revenue:,.0f}₽
 
@@ -1443,22 +1623,7 @@ async def view_failed_orders_callback(update: Update, context: ContextTypes.DEFA
         return
     
     try:
-        conn = db.get_connection()
-        cursor = conn.cursor()
-        
-        # Получаем failed заказы
-        cursor.execute("""
-            SELECT o.id, o.user_id, o.created_at, u.first_name
-            FROM orders o
-            LEFT JOIN users u ON o.user_id = u.id
-            WHERE o.status = 'failed'
-            ORDER BY o.created_at DESC
-            LIMIT 10
-        """)
-        
-        failed_orders = cursor.fetchall()
-        cursor.close()
-        conn.close()
+        failed_orders = await adb.get_failed_orders(limit=10)
         
         if not failed_orders:
             await query.message.reply_text("✅ Нет проблемных заказов!")
@@ -1469,11 +1634,13 @@ async def view_failed_orders_callback(update: Update, context: ContextTypes.DEFA
         text += "_Нужно вернуть деньги вручную:_\n\n"
         
         for order in failed_orders:
-            order_id, user_id, created_at, user_name = order
+            order_id, user_id, created_at, user_name = (
+                order['order_id'], order['user_id'], order['created_at'], order['first_name']
+            )
             text += f"📝 Заказ #{order_id}\n"
             text += f"👤 {user_name or 'Аноним'} (ID: {user_id})\n"
             text += f"💰 {BOOK_PRICE_BASE}₽\n"
-            text += f"📅 {created_at[:16]}\n"
+            text += f"📅 {str(created_at)[:16]}\n"
             text += f"_Команда:_ `/refund {order_id}`\n\n"
         
         await query.message.reply_text(text, parse_mode='Markdown')
@@ -1497,36 +1664,21 @@ async def refund_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         order_id = int(context.args[0])
         
-        # Обновляем статус заказа
-        conn = db.get_connection()
-        cursor = conn.cursor()
-        
-        # Проверяем что заказ существует и failed
-        cursor.execute("SELECT user_id, status FROM orders WHERE id = ?", (order_id,))
-        result = cursor.fetchone()
+        # Проверяем что заказ существует и failed, и помечаем как возвращено - одной транзакцией
+        result = await adb.refund_failed_order(order_id)
         
         if not result:
             await update.message.reply_text(f"❌ Заказ #{order_id} не найден")
-            cursor.close()
-            conn.close()
             return
         
-        user_id_order, status = result
+        user_id_order, status = result['user_id'], result['status']
         # Используем базовую цену
         price = BOOK_PRICE_BASE
         
         if status != 'failed':
             await update.message.reply_text(f"❌ Заказ #{order_id} не в статусе 'failed' (текущий: {status})")
-            cursor.close()
-            conn.close()
             return
         
-        # Помечаем как возвращено
-        cursor.execute("UPDATE orders SET status = 'refunded' WHERE id = ?", (order_id,))
-        conn.commit()
-        cursor.close()
-        conn.close()
-        
         # Уведомляем админа
         await update.message.reply_text(
             f"✅ Заказ #{order_id} помечен как возвращён!\n\n"
@@ -1556,35 +1708,39 @@ async def refund_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def getpdf_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Команда /getpdf <order_id> - получить PDF файл заказа (для админа)"""
+    """Команда /getpdf <order_id> [screen|print|preview] - получить книгу заказа (для админа)"""
     user_id = update.effective_user.id
     
     if user_id != ADMIN_ID:
         return
     
     if not context.args:
-        await update.message.reply_text("❌ Используйте: /getpdf <order_id>\n\nПример: /getpdf 270")
+        await update.message.reply_text(
+            "❌ Используйте: /getpdf <order_id> [screen|print|preview]\n\n"
+            "Пример: /getpdf 270\n"
+            "print - PDF для печати, preview - страницы альбомом"
+        )
+        return
+    
+    variant = context.args[1].lower() if len(context.args) > 1 else 'screen'
+    if variant not in BOOK_VARIANTS:
+        await update.message.reply_text(f"❌ Неизвестный вариант: {variant}\n\nДоступны: {', '.join(BOOK_VARIANTS)}")
         return
     
     try:
         order_id = int(context.args[0])
         
         # Ищем заказ в БД
-        conn = db.get_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT user_id, child_name, theme, status, pdf_path FROM orders WHERE order_id = %s",
-            (order_id,)
-        )
-        result = cursor.fetchone()
-        cursor.close()
-        conn.close()
+        order = await adb.get_order(order_id)
         
-        if not result:
+        if not order:
             await update.message.reply_text(f"❌ Заказ #{order_id} не найден")
             return
         
-        user_id_order, child_name, theme, status, pdf_path = result
+        user_id_order, child_name, theme, status, pdf_path, pdf_file_id = (
+            order['user_id'], order['child_name'], order['theme'],
+            order['status'], order['pdf_path'], order['pdf_file_id']
+        )
         
         # Проверяем что PDF путь указан в БД
         if not pdf_path:
@@ -1595,9 +1751,58 @@ async def getpdf_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
         
+        # Файлов нет на диске (редеплой) - восстанавливаем папку книги из хранилища
+        book_dir = os.path.dirname(pdf_path)
+        need_files = variant != 'screen' or not (pdf_file_id or os.path.exists(pdf_path))
+        if need_files and not os.path.exists(os.path.join(book_dir, 'book.json')):
+            artifacts = await adb.get_order_artifacts(order_id)
+            if artifacts and artifact_store is not None:
+                await update.message.reply_text(f"☁️ Загружаю книгу #{order_id} из хранилища...")
+                await asyncio.to_thread(restore_book, artifact_store, artifacts, book_dir)
+        
+        if variant != 'screen':
+            # Остальные варианты собираются из book.json (без Replicate) и кэшируются в папке заказа
+            await update.message.reply_text(f"⏳ Готовлю вариант {variant} для заказа #{order_id}...")
+            try:
+                paths = await asyncio.to_thread(render_variant, os.path.dirname(pdf_path), variant)
+            except MissingSourcesError:
+                await update.message.reply_text(
+                    f"❌ Вариант {variant} для заказа #{order_id} недоступен - исходные иллюстрации уже удалены"
+                )
+                return
+            except FileNotFoundError:
+                await update.message.reply_text(
+                    f"❌ Нет book.json для заказа #{order_id} - книга создана до появления вариантов"
+                )
+                return
+            
+            if variant == 'preview':
+                # В альбоме не больше 10 фото
+                for start_index in range(0, len(paths), 10):
+                    media = []
+                    for page_path in paths[start_index:start_index + 10]:
+                        with open(page_path, 'rb') as page_file:
+                            media.append(InputMediaPhoto(page_file.read()))
+                    if start_index == 0:
+                        media[0] = InputMediaPhoto(media[0].media, caption=f"📚 Заказ #{order_id}: {child_name} - {theme}")
+                    await context.bot.send_media_group(chat_id=ADMIN_ID, media=media)
+                logger.info(f"✅ Превью заказа #{order_id} отправлено админу")
+                return
+            
+            pdf_path = paths
+        
+        # Screen PDF уже загружался в Telegram - переотправляем по file_id
+        file_id = pdf_file_id if variant == 'screen' else None
+        
+        if not file_id and not os.path.exists(pdf_path) and variant == 'screen':
+            # PDF собирался в памяти (PDF_IN_MEMORY) - пересобираем из book.json
+            try:
+                await asyncio.to_thread(render_variant, os.path.dirname(pdf_path), 'screen')
+            except FileNotFoundError:
+                pass
+        
         # Проверяем существование файла
-        import os
-        if not os.path.exists(pdf_path):
+        if not file_id and not os.path.exists(pdf_path):
             await update.message.reply_text(
                 f"❌ PDF не найден!\n\n"
                 f"Заказ: #{order_id}\n"
@@ -1607,26 +1812,27 @@ async def getpdf_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         
         # Отправляем PDF
-        file_size_mb = os.path.getsize(pdf_path) / 1024 / 1024
-        pdf_filename = os.path.basename(pdf_path)
         await update.message.reply_text(f"📤 Отправляю PDF заказа #{order_id}...")
         
-        with open(pdf_path, 'rb') as pdf_file:
-            await context.bot.send_document(
-                chat_id=ADMIN_ID,
-                document=pdf_file,
-                filename=pdf_filename,
-                caption=f"📚 Заказ #{order_id}\n"
-                        f"👤 User: {user_id_order}\n"
-                        f"📖 {child_name} - {theme}\n"
-                        f"💾 Размер: {file_size_mb:.1f} MB\n"
-                        f"📊 Статус: {status}"
-            )
+        caption = (f"📚 Заказ #{order_id}\n"
+                   f"👤 User: {user_id_order}\n"
+                   f"📖 {child_name} - {theme}\n")
+        if os.path.exists(pdf_path):
+            caption += f"💾 Размер: {os.path.getsize(pdf_path) / 1024 / 1024:.1f} MB\n"
+        caption += f"📊 Статус: {status}"
+        await send_order_pdf(
+            context.bot,
+            ADMIN_ID,
+            pdf_path,
+            order_id=order_id if variant == 'screen' else None,
+            file_id=file_id,
+            caption=caption
+        )
         
-        logger.info(f"✅ PDF заказа #{order_id} отправлен админу")
+        logger.info(f"✅ PDF заказа #{order_id} ({variant}) отправлен админу")
         
     except ValueError:
-        await update.message.reply_text("❌ Неверный формат. Используйте: /getpdf <order_id>")
+        await update.message.reply_text("❌ Неверный формат. Используйте: /getpdf <order_id> [screen|print|preview]")
     except Exception as e:
         logger.error(f"Ошибка в getpdf_command: {e}")
         await update.message.reply_text(f"❌ Ошибка: {e}")
@@ -1640,20 +1846,7 @@ async def dbinfo_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     try:
-        conn = db.get_connection()
-        cursor = conn.cursor()
-        
-        # Получаем структуру таблицы orders
-        cursor.execute("""
-            SELECT column_name, data_type 
-            FROM information_schema.columns 
-            WHERE table_name = 'orders'
-            ORDER BY ordinal_position
-        """)
-        
-        columns = cursor.fetchall()
-        cursor.close()
-        conn.close()
+        columns = await adb.get_table_columns('orders')
         
         if not columns:
             await update.message.reply_text("❌ Таблица orders не найдена")
@@ -1661,8 +1854,8 @@ async def dbinfo_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # Форматируем вывод
         text = "📋 Структура таблицы orders:\n\n"
-        for col_name, col_type in columns:
-            text += f"• {col_name}: {col_type}\n"
+        for col in columns:
+            text += f"• {col['column_name']}: {col['data_type']}\n"
         
         await update.message.reply_text(text)
         
@@ -1691,16 +1884,13 @@ async def gift_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         target_user_id = int(context.args[0])
         
         # Добавляем бесплатный кредит
-        if target_user_id in FREE_CREDITS:
-            FREE_CREDITS[target_user_id] += 1
-        else:
-            FREE_CREDITS[target_user_id] = 1
+        balance = await adb.add_credits(target_user_id)
         
         # Уведомляем админа
         await update.message.reply_text(
             f"🎁 *Бесплатный кредит выдан!*\n\n"
             f"👤 Пользователь: {target_user_id}\n"
-            f"✨ Бесплатных книг: {FREE_CREDITS[target_user_id]}\n\n"
+            f"✨ Бесплатных книг: {balance}\n\n"
             f"Пользователь может создать книгу без оплаты.",
             parse_mode='Markdown'
         )
@@ -1712,7 +1902,7 @@ async def gift_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 text=f"🎁 *Подарок от администрации!*\n\n"
                      f"Вам подарена **бесплатная книга**!\n\n"
                      f"Нажмите /start и создайте книгу - оплата не потребуется.\n\n"
-                     f"Доступно бесплатных книг: {FREE_CREDITS[target_user_id]} 📚",
+                     f"Доступно бесплатных книг: {balance} 📚",
                 parse_mode='Markdown'
             )
             logger.info(f"🎁 Выдан бесплатный кредит пользователю {target_user_id}")
@@ -1742,34 +1932,31 @@ async def analytics_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     try:
-        # Подключаемся к БД
-        conn = db.get_connection()
-        cursor = conn.cursor()
-        
-        # Статистика пользователей
-        cursor.execute("SELECT COUNT(*) FROM users")
-        total_users = cursor.fetchone()[0]
-        
-        # Статистика заказов
-        cursor.execute("SELECT COUNT(*) FROM orders")
-        total_orders = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM orders WHERE status = 'paid' OR status = 'completed'")
-        paid_orders = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM orders WHERE status = 'pending'")
-        pending_orders = cursor.fetchone()[0]
-        
-        # Доход - считаем количество оплаченных × цена
-        revenue = paid_orders * BOOK_PRICE_BASE
-        
-        cursor.close()
-        conn.close()
+        # Одна сводка по stats_rollup: итог + разбивка по планам
+        report = await adb.get_stats_report()
+        
+        # Воронка из analytics_events (сначала дописываем ещё не сброшенные события)
+        await event_log.flush()
+        funnel = await adb.get_event_funnel(FUNNEL_DAYS)
+        
+        def users(event):
+            return funnel.get(event, {}).get('users', 0)
+        total = report['total']
+        total_users = total['total_users']
+        total_orders = total['total_orders']
+        paid_orders = total['paid_orders']
+        pending_orders = total['pending_orders']
+        revenue = total['revenue']
         
         # Конверсии
         conv_order = (total_orders / total_users * 100) if total_users > 0 else 0
         conv_payment = (paid_orders / total_orders * 100) if total_orders > 0 else 0
         
+        plans_text = "\n".join(
+            f"• {plan}: {row['total_orders']} заказов, оплачено {row['paid_orders']}, {row['revenue']:,.0f}₽"
+            for plan, row in sorted(report['by_plan'].items())
+        ) or "• Нет заказов"
+        
         # Формируем текст
         stats_text = f"""📊 *АНАЛИТИКА БОТА*
 
@@ -1780,47 +1967,44 @@ async def analytics_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • Ожидают оплату: {pending_orders}
 • Доход: {revenue:,.0f}₽
 
+📦 *По планам:*
+{plans_text}
+
 📈 *Конверсия:*
 • Пользователи → Заказы: {conv_order:.1f}%
 • Заказы → Оплата: {conv_payment:.1f}%
 
-🔥 *Текущая сессия:*
-• /start: {analytics_cache.get('start', 0)}
-• 📚 Примеры: {analytics_cache.get('show_examples', 0)}
-• ❓ Как работает: {analytics_cache.get('how_it_works', 0)}
-• ⭐ Начали создание: {analytics_cache.get('create_story', 0)}
-• 🎨 Выбрали тему: {analytics_cache.get('theme_chosen', 0)}
-• 👦👧 Выбрали пол: {analytics_cache.get('gender_chosen', 0)}
-• ✍️ Ввели имя: {analytics_cache.get('name_entered', 0)}
-• 🔢 Ввели возраст: {analytics_cache.get('age_entered', 0)}
-• 📸 Загрузили фото: {analytics_cache.get('photo_uploaded', 0)}
-• ⏭️ Пропустили фото: {analytics_cache.get('photo_skipped', 0)}
-• 💰 Создали платеж: {analytics_cache.get('payment_created', 0)}
-
-💡 *Воронка (текущая сессия):*
+🔥 *За {FUNNEL_DAYS} дней (пользователей):*
+• /start: {users('start')}
+• 📚 Примеры: {users('show_examples')}
+• ❓ Как работает: {users('how_it_works')}
+• ⭐ Начали создание: {users('create_story')}
+• 🎨 Выбрали тему: {users('theme_chosen')}
+• 👦👧 Выбрали пол: {users('gender_chosen')}
+• ✍️ Ввели имя: {users('name_entered')}
+• 🔢 Ввели возраст: {users('age_entered')}
+• 📸 Загрузили фото: {users('photo_uploaded')}
+• ⏭️ Пропустили фото: {users('photo_skipped')}
+• 💰 Создали платеж: {users('payment_created')}
+• ✅ Оплатили: {users('payment_completed')}
+
+💡 *Воронка (за {FUNNEL_DAYS} дней):*
 """
         
         # Воронка конверсии
-        funnel_start = analytics_cache.get('start', 0)
+        funnel_start = users('start')
         if funnel_start > 0:
             stats_text += f"• {funnel_start} открыли бота (100%)\n"
             
-            examples = analytics_cache.get('show_examples', 0)
-            if examples > 0:
-                stats_text += f"• {examples} посмотрели примеры ({examples/funnel_start*100:.0f}%)\n"
-            
-            create = analytics_cache.get('create_story', 0)
-            if create > 0:
-                stats_text += f"• {create} начали создание ({create/funnel_start*100:.0f}%)\n"
-            
-            payment = analytics_cache.get('payment_created', 0)
-            if payment > 0:
-                stats_text += f"• {payment} дошли до оплаты ({payment/funnel_start*100:.0f}%)\n"
-            
-            if paid_orders > 0:
-                stats_text += f"• {paid_orders} оплатили (всего)\n"
+            for event, label in (('show_examples', 'посмотрели примеры'),
+                                 ('create_story', 'начали создание'),
+                                 ('payment_created', 'дошли до оплаты'),
+                                 ('payment_completed', 'оплатили')):
+                count = users(event)
+                if count > 0:
+                    stats_text += f"• {count} {label} ({count/funnel_start*100:.0f}%)\n"
         else:
-            stats_text += "• Нет данных в текущей сессии\n"
+            stats_text += "• Нет данных за этот период\n"
         
         await update.message.reply_text(stats_text, parse_mode='Markdown')
         
@@ -1854,12 +2038,58 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return
 
 
+payment_webhook = {'runner': None}
+
+
+async def on_startup(application):
+    """Запуск бота: в режиме queue подписываемся на результаты воркеров, принимаем уведомления YooKassa"""
+    if GENERATION_MODE == 'queue':
+        await listen_generation_events(application)
+    
+    if YOOKASSA_WEBHOOK_ENABLED and PAYMENT_ENABLED:
+        telegram_webhook = (os.environ.get('USE_WEBHOOK', 'false').lower() == 'true'
+                            and os.environ.get('RAILWAY_PUBLIC_DOMAIN'))
+        if telegram_webhook and YOOKASSA_WEBHOOK_PORT == int(os.environ.get('PORT', '8080')):
+            # Порт занят Telegram webhook - платежи ловит только автопроверка (с обычной частотой)
+            logger.warning("⚠️ YOOKASSA_WEBHOOK_PORT совпадает с портом Telegram webhook - "
+                           "уведомления YooKassa выключены, задайте другой YOOKASSA_WEBHOOK_PORT")
+            return
+        
+        async def on_payment(payment_id, status):
+            await on_payment_notification(application.bot, payment_id, status)
+        
+        try:
+            payment_webhook['runner'] = await start_payment_webhook(on_payment, yookassa_client.check_payment)
+        except OSError as e:
+            logger.error(f"❌ Не удалось запустить приём уведомлений YooKassa: {e}")
+            return
+        # Уведомления работают - автопроверка остаётся редкой подстраховкой
+        payment_poller.min_delay = PAYMENT_POLL_NOTIFIED_DELAY
+
+
+async def on_shutdown(application):
+    """Остановка бота: дописываем события аналитики и статистику, закрываем подключения к БД"""
+    await event_log.flush()
+    await daily_stats.drain()
+    if payment_webhook['runner'] is not None:
+        await payment_webhook['runner'].cleanup()
+    if generation_listener['conn'] is not None:
+        await generation_listener['conn'].close()
+    await yookassa_client.close()
+    db.close()
+    await adb.close()
+    logger.info("🔌 Подключения к БД закрыты")
+
+
 def main():
     """Запуск бота"""
     
     print("🤖 Запускаю Telegram бота...")
     print(f"💳 Оплата: {'✅ ВКЛЮЧЕНА' if PAYMENT_ENABLED else '⚠️ ВЫКЛЮЧЕНА'}")
     
+    # 🎁 Стартовые бесплатные кредиты (уже начисленные не трогаем)
+    db.seed_credits(FREE_CREDITS)
+    
     # Получаем настройки для webhook
     PORT = int(os.environ.get('PORT', '8080'))
     USE_WEBHOOK = os.environ.get('USE_WEBHOOK', 'false').lower() == 'true'
@@ -1884,7 +2114,36 @@ def main():
         pool_timeout=15.0            # Таймаут получения соединения
     )
     
-    application = Application.builder().token(BOT_TOKEN).request(request).build()
+    # 💾 user_data и шаги разговора хранятся в Postgres - редеплой не сбрасывает оформление заказа
+    persistence = PostgresPersistence(adb)
+    
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(request)
+        .persistence(persistence)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+    
+    # 🖼️ Прогресс генерации отправляется пачками по job_queue
+    progress_reporter.start(application.job_queue)
+    
+    # 📊 События воронки пишутся в БД пачками
+    event_log.start(application.job_queue)
+    daily_stats.start(application.job_queue)
+    
+    # 💳 Автопроверка неоплаченных платежей
+    if PAYMENT_ENABLED:
+        payment_poller.start(application.job_queue, on_paid=confirm_payment, on_canceled=cancel_payment)
+    
+    # 🧹 Уборка диска: квота на папки книг и забытые фото
+    application.job_queue.run_repeating(janitor_job, interval=JANITOR_INTERVAL, first=60, name='janitor')
+    
+    # 🏭 Книги собирают generation_worker.py - страховка на случай пропущенного NOTIFY
+    if GENERATION_MODE == 'queue':
+        application.job_queue.run_repeating(generation_results_job, interval=60, first=30, name='generation_results')
     
     # ✅ ПАТЧ: Handler для постоянных кнопок клавиатуры (group=-2, самый первый!)
     application.add_handler(
@@ -1931,7 +2190,9 @@ def main():
         fallbacks=[
             CommandHandler('cancel', cancel),
             CommandHandler('start', start)  # ✅ ПАТЧ: Позволяет начать заново в любой момент
-        ]
+        ],
+        name='story',
+        persistent=True
     )
     
     application.add_handler(conv_handler)
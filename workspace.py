@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Изолированные рабочие папки заказов
+
+Каждая попытка генерации заказа пишет в свою папку
+storybook_order_<order_id>_<attempt>, поэтому одинаковые имя и тема у разных
+родителей больше не перезаписывают файлы друг друга.
+
+Книга собирается в <папка>.partial и переименовывается в итоговую папку
+одним os.replace только целиком - недособранная книга никогда не лежит
+по итоговому пути. Фото детей сохраняются под уникальными именами.
+"""
+
+import os
+import shutil
+import uuid
+
+WORKSPACE_PREFIX = "storybook_order"
+PARTIAL_SUFFIX = ".partial"
+TEMP_PHOTOS_DIR = "temp_photos"
+
+
+def workspace_path(order_id=None, attempt=1):
+    """Итоговая папка заказа (без order_id - уникальная папка на одну генерацию)"""
+    if order_id is None:
+        return f"{WORKSPACE_PREFIX}_adhoc_{uuid.uuid4().hex[:12]}"
+    return f"{WORKSPACE_PREFIX}_{order_id}_{attempt}"
+
+
+def partial_path(final_dir):
+    """Папка, в которой книга собирается до публикации"""
+    return final_dir + PARTIAL_SUFFIX
+
+
+def begin_workspace(final_dir):
+    """Создаёт чистую папку для сборки (остатки прошлой неудачной попытки удаляются)"""
+    work_dir = partial_path(final_dir)
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir)
+    return work_dir
+
+
+def publish_workspace(final_dir):
+    """Атомарно публикует собранную книгу: <папка>.partial -> <папка>"""
+    work_dir = partial_path(final_dir)
+    if os.path.exists(final_dir):
+        # Повторная публикация той же попытки - старую копию убираем
+        shutil.rmtree(final_dir)
+    os.replace(work_dir, final_dir)
+    return final_dir
+
+
+def discard_workspace(final_dir):
+    """Удаляет недособранную книгу (после ошибки генерации)"""
+    shutil.rmtree(partial_path(final_dir), ignore_errors=True)
+
+
+def new_photo_path(user_id):
+    """Уникальный путь для фото ребёнка - параллельные заказы не затрут друг друга"""
+    os.makedirs(TEMP_PHOTOS_DIR, exist_ok=True)
+    return os.path.join(TEMP_PHOTOS_DIR, f"{user_id}_{uuid.uuid4().hex[:12]}.jpg")
+
+
+def remove_photo(photo_path):
+    """Удаляет фото ребёнка, если оно ещё есть"""
+    if photo_path and os.path.exists(photo_path):
+        os.remove(photo_path)